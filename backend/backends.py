@@ -0,0 +1,237 @@
+import os
+import json
+import zipfile
+import cpu_config
+from calibration import artifact_fingerprint, load_calibration
+
+# Execution backends for the classifier. Each one takes a float32 NCHW numpy
+# batch that is already resized and normalized and returns raw logits as a
+# numpy array, so predict.py never has to touch torch unless the backend does.
+# Every backend also reports the preprocessing its model expects
+# (input_size, norm_mean, norm_std), the calibration fitted for it (see
+# calibration.py) and a rough resident memory estimate.
+
+BACKENDS = ("eager", "torchscript", "onnx", "quantized")
+
+DEFAULT_MODEL_PATHS = {
+    "eager": "resnet18_with_class_label_weights_best_acc.tar",
+    "torchscript": "resnet18_with_class_label_weights_best_acc.ts",
+    "onnx": "resnet18_with_class_label_weights_best_acc.onnx",
+    "quantized": "resnet18_with_class_label_weights_best_acc_int8.ts",
+}
+
+# Key used for the class mapping in TorchScript extra files and ONNX metadata
+CLASS_TO_IDX_KEY = "class_to_idx"
+# Extra file recording which quantized engine (fbgemm/qnnpack) an int8 model was built for
+QUANT_ENGINE_KEY = "quant_engine"
+# Optional metadata with the architecture, input size and normalization the model was trained with
+PREPROCESS_KEY = "preprocess"
+
+DEFAULT_PREPROCESS = {
+    "input_size": 224,
+    "norm_mean": [0.485, 0.456, 0.406],
+    "norm_std": [0.229, 0.224, 0.225],
+}
+
+def preprocess_from_checkpoint(checkpoint):
+    """Reads the preprocessing settings saved by core/finetune.py, falling back to ResNet18/ImageNet defaults"""
+    return {key: checkpoint.get(key, default) for key, default in DEFAULT_PREPROCESS.items()}
+
+def build_classifier(arch, num_classes, framework="torchvision"):
+    """Creates an untrained classifier with a num_classes head, from torchvision or timm"""
+    import torch.nn as nn
+
+    if framework == "timm":
+        import timm
+        return timm.create_model(arch, pretrained=False, num_classes=num_classes)
+
+    from torchvision import models
+    model = models.get_model(arch, weights=None)
+    model.fc = nn.Linear(model.fc.in_features, num_classes)
+    return model
+
+def load_classifier(checkpoint, device="cpu", strict=True):
+    """
+    Builds the classifier described by a .tar checkpoint and loads its weights
+
+    The module is created on the meta device and the checkpoint tensors are
+    assigned to it directly, which skips the random initialization of every
+    layer. If the checkpoint does not cover every parameter, the model is
+    built normally instead so the missing ones keep their initial values.
+    """
+    import torch
+
+    arch = checkpoint.get("model_name", "resnet18")
+    framework = checkpoint.get("framework", "torchvision")
+    num_classes = len(checkpoint["class_to_idx"])
+    state_dict = {key: value.to(device) for key, value in checkpoint["model"].items()}
+
+    with torch.device("meta"):
+        model = build_classifier(arch, num_classes, framework)
+    model.load_state_dict(state_dict, strict=strict, assign=True)
+    if any(t.is_meta for t in list(model.parameters()) + list(model.buffers())):
+        model = build_classifier(arch, num_classes, framework)
+        model.load_state_dict(state_dict, strict=strict)
+    return model.to(device).eval()
+
+class Backend:
+    """Metadata shared by all backends"""
+    name = None
+
+    def _set_metadata(self, model_path, class_to_idx, preprocess, arch=None):
+        self.model_path = model_path
+        self.fingerprint = artifact_fingerprint(model_path)
+        self.class_to_idx = class_to_idx
+        self.idx_to_class = {v: k for k, v in class_to_idx.items()}
+        self.num_classes = len(class_to_idx)
+        self.arch = arch
+        self.input_size = int(preprocess["input_size"])
+        self.norm_mean = [float(x) for x in preprocess["norm_mean"]]
+        self.norm_std = [float(x) for x in preprocess["norm_std"]]
+        self.memory_bytes = os.path.getsize(model_path)
+        calibration = load_calibration(model_path)
+        self.temperature = float(calibration["temperature"])
+        self.ood_method = calibration["ood_method"]
+        self.reject_threshold = calibration["reject_threshold"]
+
+    def describe(self):
+        return {"backend": self.name, "arch": self.arch, "path": self.model_path, "num_classes": self.num_classes,
+                "input_size": self.input_size, "memory_bytes": self.memory_bytes, "temperature": self.temperature,
+                "ood_method": self.ood_method, "reject_threshold": self.reject_threshold}
+
+class EagerBackend(Backend):
+    """
+    Runs a .tar checkpoint in eager PyTorch
+
+    The checkpoint holds 'model' (the state dict) and 'class_to_idx'. Ones
+    written by core/finetune.py also record the architecture ('model_name',
+    built with timm) and the preprocessing; older ones are torchvision ResNet18.
+    """
+    name = "eager"
+
+    def __init__(self, model_path):
+        import torch
+
+        cpu_config.configure_torch()
+        self.torch = torch
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        checkpoint = torch.load(model_path, map_location=self.device)
+        arch = checkpoint.get("model_name", "resnet18")
+        self._set_metadata(model_path, checkpoint["class_to_idx"], preprocess_from_checkpoint(checkpoint), arch)
+
+        model = self.model = load_classifier(checkpoint, self.device, strict=False)
+        self.memory_bytes = sum(t.numel() * t.element_size() for t in list(model.parameters()) + list(model.buffers()))
+
+    def run(self, batch):
+        with self.torch.no_grad():
+            output = self.model(self.torch.from_numpy(batch).to(self.device))
+        return output.cpu().numpy()
+
+class TorchScriptBackend(Backend):
+    """Runs a module written by export_model.py with torch.jit, no torchvision needed"""
+    name = "torchscript"
+
+    def __init__(self, model_path):
+        import torch
+
+        cpu_config.configure_torch()
+        self.torch = torch
+        self.device = torch.device("cpu")
+
+        extra_files = {f"{CLASS_TO_IDX_KEY}.json": "", f"{PREPROCESS_KEY}.json": ""}
+        self.model = torch.jit.load(model_path, map_location=self.device, _extra_files=extra_files)
+        self.model.eval()
+        preprocess = json.loads(extra_files[f"{PREPROCESS_KEY}.json"] or "{}")
+        self._set_metadata(model_path, json.loads(extra_files[f"{CLASS_TO_IDX_KEY}.json"]),
+                           {**DEFAULT_PREPROCESS, **preprocess}, preprocess.get("arch"))
+
+    def run(self, batch):
+        with self.torch.no_grad():
+            output = self.model(self.torch.from_numpy(batch))
+        return output.numpy()
+
+class QuantizedBackend(TorchScriptBackend):
+    """Runs the int8 TorchScript model written by quantize_model.py"""
+    name = "quantized"
+
+    def __init__(self, model_path):
+        import torch
+
+        # Packed int8 weights are unpacked for the active engine while loading, so
+        # the engine used for calibration has to be selected before torch.jit.load.
+        # TorchScript archives are zip files with extra files under <archive>/extra/
+        self.engine = None
+        with zipfile.ZipFile(model_path) as archive:
+            for entry in archive.namelist():
+                if entry.endswith(f"/extra/{QUANT_ENGINE_KEY}"):
+                    self.engine = archive.read(entry).decode()
+        if self.engine:
+            torch.backends.quantized.engine = self.engine
+        super().__init__(model_path)
+
+class OnnxBackend(Backend):
+    """Runs an exported ONNX graph through ONNX Runtime on CPU without importing torch"""
+    name = "onnx"
+
+    def __init__(self, model_path):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        cpu_config.configure_onnx_session(options)
+        self.session = ort.InferenceSession(model_path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+        metadata = self.session.get_modelmeta().custom_metadata_map
+        if CLASS_TO_IDX_KEY not in metadata:
+            raise ValueError(f"ONNX model '{model_path}' has no '{CLASS_TO_IDX_KEY}' metadata. Re-export it with export_model.py")
+        preprocess = json.loads(metadata.get(PREPROCESS_KEY, "{}"))
+        self._set_metadata(model_path, json.loads(metadata[CLASS_TO_IDX_KEY]),
+                           {**DEFAULT_PREPROCESS, **preprocess}, preprocess.get("arch"))
+
+    def run(self, batch):
+        return self.session.run(None, {self.input_name: batch})[0]
+
+# Backends loaded ahead of time by zygote.py, keyed by (backend name, absolute path).
+# Forked children share their weights copy-on-write instead of reading the file again
+_preloaded = {}
+
+def preload_backend(name="eager", model_path=None):
+    """Loads a backend now so later load_backend() calls for the same artifact reuse it"""
+    backend = load_backend(name, model_path)
+    _preloaded[(name, os.path.abspath(backend.model_path))] = backend
+    return backend
+
+def preloaded_backend(name, model_path):
+    """The preloaded backend for an artifact, or None if there is none or the file has changed since"""
+    backend = _preloaded.get((name, os.path.abspath(model_path)))
+    if backend is not None and backend.fingerprint == artifact_fingerprint(model_path):
+        return backend
+    return None
+
+def load_backend(name="eager", model_path=None):
+    """
+    Creates an execution backend
+
+    Args:
+        name (str): One of 'eager', 'torchscript', 'onnx' or 'quantized'
+        model_path (str, optional): The artifact to load. Defaults to the standard file name for the backend
+    """
+    if name not in BACKENDS:
+        raise ValueError(f"Unsupported backend: {name}. Choose from {', '.join(BACKENDS)}")
+    model_path = model_path or DEFAULT_MODEL_PATHS[name]
+    if not os.path.exists(model_path):
+        raise FileNotFoundError(f"Model file not found for backend '{name}': {model_path}")
+
+    backend = preloaded_backend(name, model_path)
+    if backend is not None:
+        return backend
+    if name == "eager":
+        return EagerBackend(model_path)
+    elif name == "torchscript":
+        return TorchScriptBackend(model_path)
+    elif name == "quantized":
+        return QuantizedBackend(model_path)
+    else:
+        return OnnxBackend(model_path)
@@ -0,0 +1,91 @@
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+class MicroBatcher:
+    """
+    Coalesces concurrent requests into batches for a single batched call
+
+    Items submitted from any thread are queued. A background thread collects
+    up to max_batch_size items, waiting at most max_wait_ms after the first
+    one arrives, calls run_batch(items) once and scatters its results back
+    to each caller's Future.
+
+    Args:
+        run_batch (function): Takes a list of items and returns a list of results in the same order
+        max_batch_size (int): The largest number of items passed to run_batch at once
+        max_wait_ms (float): How long to hold the first item while waiting for more
+    """
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=5.0):
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.batches = 0
+        self.items = 0
+        self._queue = queue.Queue()
+        self._closed = False
+        self._thread = threading.Thread(target=self._loop, name="micro-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Queues an item and returns a Future that resolves to its result"""
+        if self._closed:
+            raise RuntimeError("MicroBatcher is closed")
+        future = Future()
+        self._queue.put((item, future))
+        return future
+
+    def close(self, wait=True):
+        """Stops accepting items and, if wait is set, drains the queue before returning"""
+        if not self._closed:
+            self._closed = True
+            self._queue.put(None)
+        if wait:
+            self._thread.join()
+
+    def stats(self):
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "mean_batch_size": round(self.items / self.batches, 3) if self.batches else 0.0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000.0,
+        }
+
+    def _loop(self):
+        stopping = False
+        while not stopping:
+            first = self._queue.get()
+            if first is None:
+                break
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                try:
+                    entry = self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if entry is None:
+                    stopping = True
+                    break
+                batch.append(entry)
+            self._run(batch)
+
+    def _run(self, batch):
+        items = [item for item, _ in batch]
+        try:
+            results = self.run_batch(items)
+            if len(results) != len(items):
+                raise RuntimeError(f"run_batch returned {len(results)} results for {len(items)} items")
+        except Exception as e:
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        self.batches += 1
+        self.items += len(items)
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
@@ -0,0 +1,386 @@
+import os
+import sys
+import json
+import glob
+import time
+import platform
+import argparse
+import tempfile
+import subprocess
+import threading
+import numpy as np
+from PIL import Image
+import cpu_config
+from backends import BACKENDS, DEFAULT_MODEL_PATHS
+from predict import IMAGE_EXTENSIONS
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Runs each backend in its own process so startup time and peak RSS are
+# measured from a cold interpreter, then drives predict_batch() (or
+# compute_gradcam()) with synthetic and real images at several concurrency
+# levels. Results are written as JSON and can be compared against a
+# previous run with --compare. --sweep_threads instead runs several workers
+# side by side under different thread/pinning settings to pick the best
+# serving configuration for the host.
+
+TARGETS = BACKENDS + ("gradcam",)
+DEFAULT_RESOLUTIONS = ["640x480", "1920x1080", "4000x3000"]
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and kilobytes elsewhere
+    return round(rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024, 1)
+
+def percentiles(latencies_ms):
+    values = np.asarray(latencies_ms)
+    return {
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "mean_ms": round(float(values.mean()), 3),
+    }
+
+def make_synthetic_images(directory, resolutions, per_resolution=4, seed=0):
+    """Writes random-noise JPEGs (a worst case for the decoder) and returns {resolution: [paths]}"""
+    rng = np.random.default_rng(seed)
+    workloads = {}
+    for resolution in resolutions:
+        width, height = (int(x) for x in resolution.split("x"))
+        paths = []
+        for i in range(per_resolution):
+            pixels = rng.integers(0, 256, size=(height, width, 3), dtype=np.uint8)
+            path = os.path.join(directory, f"synthetic_{resolution}_{i}.jpg")
+            Image.fromarray(pixels).save(path, quality=90)
+            paths.append(path)
+        workloads[f"synthetic_{resolution}"] = paths
+    return workloads
+
+def collect_real_images(pattern, limit=32):
+    """Expands a directory or glob into up to limit image paths"""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "**", "*")
+    paths = sorted(p for p in glob.glob(pattern, recursive=True) if os.path.splitext(p)[1].lower() in IMAGE_EXTENSIONS)
+    return paths[:limit]
+
+def run_load(call, paths, concurrency, num_requests):
+    """Issues num_requests calls spread over concurrency threads and returns per-call latencies and wall time"""
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(num_requests))
+
+    def worker():
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            call(paths[i % len(paths)])
+            elapsed = (time.perf_counter() - start) * 1000.0
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    wall_start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return latencies, time.perf_counter() - wall_start
+
+def benchmark_worker(target, model_path, workloads, concurrency_levels, num_requests, warmup, batched, max_batch_size,
+                     wait_for_go=False, raw_latencies=False):
+    """
+    Child process body: loads one target, then reports results for every workload and concurrency level
+
+    With wait_for_go the worker blocks on a line from stdin after loading, so
+    the parent can start several workers at the same moment.
+    """
+    load_start = time.perf_counter()
+    if target == "gradcam":
+        import gradcam
+        model, _ = gradcam.load_model(model_path or gradcam.CHECKPOINT_PATH)
+
+        def call(path):
+            gradcam.compute_gradcam(model, gradcam.preprocess_image(path), 0, mode="cam")
+        # Autograd and the hooks are not meant to be shared across threads
+        concurrency_levels = [1]
+        variants = {"cam": call}
+    else:
+        import predict
+        from batcher import MicroBatcher
+        predict.load_model(target, model_path, check_interval=0)
+
+        def call(path):
+            result = predict.predict_batch([path])[0]
+            if isinstance(result, dict) and "error" in result:
+                raise RuntimeError(result["error"])
+        variants = {"direct": call}
+
+        if batched:
+            batcher = MicroBatcher(lambda paths: predict.predict_batch(paths), max_batch_size=max_batch_size)
+            variants["batched"] = lambda path: batcher.submit(path).result()
+    load_ms = (time.perf_counter() - load_start) * 1000.0
+    print(json.dumps({"status": "ready", "load_ms": round(load_ms, 3)}), flush=True)
+    if wait_for_go:
+        sys.stdin.readline()
+
+    results = []
+    for workload, paths in workloads.items():
+        for variant, variant_call in variants.items():
+            for _ in range(warmup):
+                variant_call(paths[0])
+            for concurrency in concurrency_levels:
+                latencies, wall = run_load(variant_call, paths, concurrency, num_requests)
+                results.append({
+                    "workload": workload,
+                    "variant": variant,
+                    "concurrency": concurrency,
+                    "requests": len(latencies),
+                    "images_per_sec": round(len(latencies) / wall, 2),
+                    **percentiles(latencies),
+                })
+                if raw_latencies:
+                    results[-1]["latencies"] = latencies
+    print(json.dumps({"status": "done", "results": results, "peak_rss_mb": peak_rss_mb()}), flush=True)
+
+def worker_command(target, model_path, workloads, concurrency, requests, warmup, max_batch_size, batched=True, extra=()):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", target,
+               "--workloads_json", json.dumps(workloads),
+               "--concurrency", *[str(c) for c in concurrency],
+               "--requests", str(requests), "--warmup", str(warmup),
+               "--max_batch_size", str(max_batch_size), *extra]
+    if model_path:
+        command += ["--model_path", f"{target}={model_path}"]
+    if not batched:
+        command.append("--no-batched")
+    return command
+
+def run_target(target, model_path, workloads, args):
+    """Spawns a cold worker process for one target and collects its report"""
+    command = worker_command(target, model_path, workloads, args.concurrency, args.requests, args.warmup,
+                             args.max_batch_size, args.batched, extra=["--workers", "1"])
+
+    # stderr goes to a file so warnings can't fill the pipe while stdout is being read
+    stderr_file = tempfile.TemporaryFile(mode="w+")
+    spawn = time.perf_counter()
+    proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file, text=True)
+    report = {"target": target, "model_path": model_path or DEFAULT_MODEL_PATHS.get(target, DEFAULT_MODEL_PATHS["eager"])}
+    for line in proc.stdout:
+        message = json.loads(line)
+        if message["status"] == "ready":
+            # Interpreter start, imports and model load, as a worker restart would see it
+            report["startup_ms"] = round((time.perf_counter() - spawn) * 1000.0, 3)
+            report["load_ms"] = message["load_ms"]
+        elif message["status"] == "done":
+            report["results"] = message["results"]
+            report["peak_rss_mb"] = message["peak_rss_mb"]
+    returncode = proc.wait()
+    stderr_file.seek(0)
+    stderr = stderr_file.read()
+    stderr_file.close()
+    if returncode != 0:
+        report["error"] = stderr.strip().splitlines()[-1] if stderr.strip() else f"exit code {proc.returncode}"
+    return report
+
+def sweep_configs(num_cpus, can_pin):
+    """(workers, intra_op_threads, pinned) combinations to try, including the oversubscribed default"""
+    worker_counts = sorted({w for w in (1, 2, 4, 8, 16, 32, num_cpus) if w <= num_cpus})
+    configs = []
+    for workers in worker_counts:
+        threads = max(1, num_cpus // workers)
+        configs.append((workers, threads, False))
+        if can_pin and workers > 1:
+            configs.append((workers, threads, True))
+        if workers > 1 and threads != num_cpus:
+            # What every worker gets without any configuration
+            configs.append((workers, num_cpus, False))
+    return configs
+
+def run_sweep_config(target, model_path, paths, workers, threads, pinned, requests_per_worker, warmup):
+    """Starts workers side by side with the given settings and measures their combined throughput and latency"""
+    workloads = {"sweep": paths}
+    procs = []
+    for index in range(workers):
+        extra = ["--workers", str(workers), "--worker_index", str(index), "--intra_op_threads", str(threads),
+                 "--inter_op_threads", "1", "--wait_for_go", "--raw_latencies"]
+        if pinned:
+            extra += ["--cpu_set", "auto"]
+        command = worker_command(target, model_path, workloads, [1], requests_per_worker, warmup, 1, batched=False, extra=extra)
+        # stderr goes to a file so warnings can't fill the pipe while stdout is being read
+        stderr_file = tempfile.TemporaryFile(mode="w+")
+        procs.append((subprocess.Popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=stderr_file, text=True), stderr_file))
+
+    def worker_failed(proc, stderr_file, what):
+        for other, _ in procs:
+            if other.poll() is None:
+                other.kill()
+        returncode = proc.wait()
+        stderr_file.seek(0)
+        stderr = stderr_file.read().strip()
+        return RuntimeError(f"Sweep worker {what} (exit code {returncode}, {workers} worker(s) x {threads} thread(s))"
+                            + (f":\n{stderr}" if stderr else ""))
+
+    try:
+        for proc, stderr_file in procs:
+            line = proc.stdout.readline()
+            try:
+                json.loads(line)  # ready
+            except ValueError:
+                raise worker_failed(proc, stderr_file, "exited before it was ready") from None
+        start = time.perf_counter()
+        for proc, _ in procs:
+            proc.stdin.write("go\n")
+            proc.stdin.flush()
+
+        latencies = []
+        for proc, stderr_file in procs:
+            for line in proc.stdout:
+                message = json.loads(line)
+                if message["status"] == "done":
+                    latencies.extend(message["results"][0]["latencies"])
+            if proc.wait() != 0:
+                raise worker_failed(proc, stderr_file, "failed")
+        wall = time.perf_counter() - start
+    finally:
+        for _, stderr_file in procs:
+            stderr_file.close()
+    return {
+        "workers": workers,
+        "intra_op_threads": threads,
+        "pinned": pinned,
+        "requests": len(latencies),
+        "images_per_sec": round(len(latencies) / wall, 2),
+        **percentiles(latencies),
+    }
+
+def sweep_threads(target, model_path, paths, requests_per_worker=32, warmup=3):
+    """Runs every sweep configuration and recommends the one with the best throughput (ties broken by p99)"""
+    num_cpus = len(cpu_config.available_cpus())
+    results = []
+    for workers, threads, pinned in sweep_configs(num_cpus, hasattr(os, "sched_setaffinity")):
+        print(f"Sweeping {workers} worker(s) x {threads} thread(s){' pinned' if pinned else ''}", file=sys.stderr)
+        results.append(run_sweep_config(target, model_path, paths, workers, threads, pinned, requests_per_worker, warmup))
+
+    best = max(results, key=lambda r: (r["images_per_sec"], -r["p99_ms"]))
+    flags = f"--workers {best['workers']} --intra_op_threads {best['intra_op_threads']}"
+    if best["pinned"]:
+        flags += " --cpu_set auto"
+    node_env = f"PREDICT_WORKERS={best['workers']}" + (" PIN_CPUS=1" if best["pinned"] else "")
+    return {"target": target, "cpus": num_cpus, "results": results,
+            "recommendation": {**best, "worker_flags": flags, "node_env": node_env}}
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+def compare_runs(baseline, current, threshold=0.1):
+    """Lists results whose p50/p95 latency rose or images/sec fell by more than threshold versus a baseline run"""
+    def index(run):
+        return {(t["target"], r["workload"], r["variant"], r["concurrency"]): r
+                for t in run["targets"] for r in t.get("results", [])}
+
+    old, new = index(baseline), index(current)
+    regressions = []
+    for key, result in new.items():
+        if key not in old:
+            continue
+        for metric, worse_if_higher in (("p50_ms", True), ("p95_ms", True), ("images_per_sec", False)):
+            before, after = old[key][metric], result[metric]
+            if not before:
+                continue
+            change = (after - before) / before
+            if (change > threshold) if worse_if_higher else (change < -threshold):
+                regressions.append({"target": key[0], "workload": key[1], "variant": key[2], "concurrency": key[3],
+                                    "metric": metric, "before": before, "after": after, "change": round(change, 4)})
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark prediction and Grad-CAM latency, throughput, memory and startup per backend")
+    parser.add_argument("--targets", type=str, nargs="+", default=list(TARGETS), choices=TARGETS, help="Backends to benchmark, plus 'gradcam' for compute_gradcam")
+    parser.add_argument("--model_path", type=str, action="append", default=[], help="Override an artifact as target=path (repeatable)")
+    parser.add_argument("--resolutions", type=str, nargs="+", default=DEFAULT_RESOLUTIONS, help="Synthetic JPEG sizes as WIDTHxHEIGHT")
+    parser.add_argument("--images", type=str, default=None, help="Directory or glob of real images to add as a workload")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 8], help="Numbers of concurrent callers")
+    parser.add_argument("--requests", type=int, default=64, help="Requests per workload and concurrency level")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed requests before each workload")
+    parser.add_argument("--no-batched", dest="batched", action="store_false", help="Skip the MicroBatcher variant")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Largest batch for the MicroBatcher variant")
+    parser.add_argument("--output", type=str, default=None, help="Write the results JSON here (printed to stdout otherwise)")
+    parser.add_argument("--compare", type=str, default=None, help="Baseline results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression by --compare")
+    parser.add_argument("--sweep_threads", type=str, default=None, choices=BACKENDS,
+                        help="Instead of the normal run, sweep worker/thread/pinning settings for this backend and recommend one")
+    # Internal: used by the per-target child processes
+    parser.add_argument("--worker", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--workloads_json", type=str, default=None, help=argparse.SUPPRESS)
+    parser.add_argument("--wait_for_go", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--raw_latencies", action="store_true", help=argparse.SUPPRESS)
+    cpu_config.add_arguments(parser)
+    args = parser.parse_args()
+
+    overrides = dict(item.split("=", 1) for item in args.model_path)
+
+    if args.worker:
+        cpu_config.apply_args(args)
+        benchmark_worker(args.worker, overrides.get(args.worker), json.loads(args.workloads_json), args.concurrency, args.requests, args.warmup,
+                         args.batched, args.max_batch_size, args.wait_for_go, args.raw_latencies)
+        sys.exit(0)
+
+    if args.sweep_threads:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            # One mid-size synthetic resolution plus the real images keeps the sweep short
+            paths = make_synthetic_images(tmp_dir, args.resolutions[:1])[f"synthetic_{args.resolutions[0]}"]
+            if args.images:
+                paths += collect_real_images(args.images)
+            report = sweep_threads(args.sweep_threads, overrides.get(args.sweep_threads), paths, args.requests, args.warmup)
+        report["commit"] = git_commit()
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(report, f, indent=2)
+        print(json.dumps(report, indent=2))
+        sys.exit(0)
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workloads = make_synthetic_images(tmp_dir, args.resolutions)
+        if args.images:
+            real = collect_real_images(args.images)
+            if real:
+                workloads["real"] = real
+
+        run = {
+            "commit": git_commit(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "settings": {"concurrency": args.concurrency, "requests": args.requests, "warmup": args.warmup,
+                         "max_batch_size": args.max_batch_size, "workloads": {k: len(v) for k, v in workloads.items()}},
+            "targets": [],
+        }
+        for target in args.targets:
+            model_path = overrides.get(target)
+            if target != "gradcam" and not os.path.exists(model_path or DEFAULT_MODEL_PATHS[target]):
+                run["targets"].append({"target": target, "error": "Model file not found, skipped"})
+                continue
+            print(f"Benchmarking {target}", file=sys.stderr)
+            run["targets"].append(run_target(target, model_path, workloads, args))
+
+    if args.compare:
+        with open(args.compare) as f:
+            run["regressions"] = compare_runs(json.load(f), run, args.threshold)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(run, f, indent=2)
+    print(json.dumps(run, indent=2))
+    sys.exit(1 if run.get("regressions") else 0)
@@ -0,0 +1,193 @@
+import os
+import sys
+import json
+import glob
+import argparse
+import numpy as np
+from result_cache import file_fingerprint
+
+# Confidence calibration and open-set rejection.
+#
+# A model artifact can have a sidecar <artifact stem>.calibration.json
+# written by this script from the val split. It holds a softmax temperature
+# (fitted by minimizing the negative log-likelihood, so confidences match
+# observed accuracy) and a reject threshold on an out-of-distribution score
+# computed from the same logits: 'msp' is 1 - the top calibrated probability,
+# 'energy' is -T * logsumexp(logits / T). Higher scores are more unusual;
+# images above the threshold are flagged as rejected so callers can skip
+# Grad-CAM and expert review. All exports of one checkpoint (.tar, .ts, .onnx)
+# share the stem and therefore the calibration.
+
+CALIBRATION_SUFFIX = ".calibration.json"
+OOD_METHODS = ("msp", "energy")
+
+DEFAULT_CALIBRATION = {
+    "temperature": 1.0,
+    "ood_method": "msp",
+    "reject_threshold": None,
+}
+
+def calibration_path(model_path):
+    return os.path.splitext(model_path)[0] + CALIBRATION_SUFFIX
+
+def load_calibration(model_path):
+    """Returns the calibration for an artifact, or the identity calibration when it has none"""
+    path = calibration_path(model_path)
+    if not os.path.exists(path):
+        return dict(DEFAULT_CALIBRATION)
+    with open(path) as f:
+        calibration = json.load(f)
+    calibration = {key: calibration.get(key, default) for key, default in DEFAULT_CALIBRATION.items()}
+    if calibration["ood_method"] not in OOD_METHODS:
+        raise ValueError(f"Unknown OOD method in {path}: {calibration['ood_method']}")
+    return calibration
+
+def save_calibration(model_path, calibration):
+    """Writes the sidecar atomically, so serving workers never read a partial file"""
+    path = calibration_path(model_path)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(calibration, f, indent=2)
+    os.replace(tmp_path, path)
+    return path
+
+def artifact_fingerprint(model_path):
+    """Fingerprint of a model artifact and its calibration, so recalibrating counts as a new model version"""
+    fingerprint = file_fingerprint(model_path)
+    path = calibration_path(model_path)
+    if os.path.exists(path):
+        fingerprint += f"+{file_fingerprint(path)}"
+    return fingerprint
+
+def log_softmax(logits):
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    return shifted - np.log(np.exp(shifted).sum(axis=1, keepdims=True))
+
+def ood_scores(logits, temperature=1.0, method="msp"):
+    """Out-of-distribution score per row of logits; higher means less like the training classes"""
+    scaled = np.asarray(logits, dtype=np.float64) / temperature
+    if method == "energy":
+        top = scaled.max(axis=1)
+        return -temperature * (top + np.log(np.exp(scaled - top[:, None]).sum(axis=1)))
+    return 1.0 - np.exp(log_softmax(scaled).max(axis=1))
+
+def ood_result(score, method, threshold):
+    return {"method": method, "score": round(float(score), 4), "threshold": threshold,
+            "rejected": threshold is not None and bool(score > threshold)}
+
+def fit_temperature(logits, labels, low=0.05, high=20.0, iterations=60):
+    """
+    Finds the softmax temperature minimizing the negative log-likelihood of the labels
+
+    The NLL is convex in 1/T, so a golden-section search over log T is enough.
+    """
+    logits = np.asarray(logits, dtype=np.float64)
+    labels = np.asarray(labels)
+
+    def nll(log_t):
+        return -log_softmax(logits / np.exp(log_t))[np.arange(len(labels)), labels].mean()
+
+    a, b = np.log(low), np.log(high)
+    ratio = (np.sqrt(5) - 1) / 2
+    c, d = b - ratio * (b - a), a + ratio * (b - a)
+    for _ in range(iterations):
+        if nll(c) < nll(d):
+            b = d
+        else:
+            a = c
+        c, d = b - ratio * (b - a), a + ratio * (b - a)
+    return float(np.exp((a + b) / 2))
+
+def expected_calibration_error(logits, labels, temperature=1.0, bins=15):
+    """Mean gap between confidence and accuracy over equal-width confidence bins"""
+    probs = np.exp(log_softmax(np.asarray(logits, dtype=np.float64) / temperature))
+    confidence = probs.max(axis=1)
+    correct = probs.argmax(axis=1) == np.asarray(labels)
+    edges = np.linspace(0.0, 1.0, bins + 1)
+    ece = 0.0
+    for low, high in zip(edges[:-1], edges[1:]):
+        in_bin = (confidence > low) & (confidence <= high)
+        if in_bin.any():
+            ece += in_bin.mean() * abs(confidence[in_bin].mean() - correct[in_bin].mean())
+    return float(ece)
+
+def auroc(negative_scores, positive_scores):
+    """Probability that a positive (OOD) image scores above a negative (in-distribution) one"""
+    scores = np.concatenate([negative_scores, positive_scores])
+    ranks = scores.argsort().argsort() + 1.0
+    positive_ranks = ranks[len(negative_scores):].sum()
+    n_pos, n_neg = len(positive_scores), len(negative_scores)
+    return float((positive_ranks - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg))
+
+def collect_logits(model, image_paths, batch_size=32):
+    """Runs the model over images and returns their raw (uncalibrated) logits"""
+    import predict
+
+    logits = []
+    for offset in range(0, len(image_paths), batch_size):
+        batch = [predict.load_image_tensor(path, model=model) for path in image_paths[offset:offset + batch_size]]
+        logits.append(model.run(np.stack(batch)))
+    return np.concatenate(logits) if logits else np.zeros((0, model.num_classes), np.float32)
+
+if __name__ == "__main__":
+    import predict
+    from backends import BACKENDS, DEFAULT_MODEL_PATHS
+    from predict import IMAGE_EXTENSIONS, list_split
+
+    parser = argparse.ArgumentParser(description="Fit temperature scaling and an out-of-distribution reject threshold on the val split")
+    parser.add_argument("data_dir", help="Processed dataset directory (with train/val/test) or a split directory of class folders")
+    parser.add_argument("--split", type=str, default="val", help="Split to fit on when data_dir holds several")
+    parser.add_argument("--backend", type=str, default="eager", choices=BACKENDS, help="Execution backend")
+    parser.add_argument("--model_path", type=str, default=None, help="Model artifact to calibrate (defaults to the standard file for the backend)")
+    parser.add_argument("--ood_method", type=str, default="energy", choices=OOD_METHODS, help="Score used to reject out-of-distribution images")
+    parser.add_argument("--accept_rate", type=float, default=0.95, help="Share of in-distribution val images the reject threshold keeps")
+    parser.add_argument("--ood_dir", type=str, default=None, help="Optional folder of images of none of the classes, to report how many are rejected")
+    parser.add_argument("--batch_size", type=int, default=32, help="Images per forward pass")
+    parser.add_argument("--dry_run", action="store_true", help="Report the fit without writing the calibration file")
+    args = parser.parse_args()
+
+    split_dir = os.path.join(args.data_dir, args.split)
+    if not os.path.isdir(split_dir):
+        split_dir = args.data_dir
+    model_path = args.model_path or DEFAULT_MODEL_PATHS[args.backend]
+
+    def log(message):
+        print(message, file=sys.stderr)
+
+    model = predict.load_model(args.backend, model_path, check_interval=0)
+    samples, unknown = list_split(split_dir, model.class_to_idx)
+    if not samples:
+        print(json.dumps({"error": f"No images of known classes in {split_dir}"}))
+        sys.exit(1)
+    log(f"Collecting logits for {len(samples)} images from {split_dir}")
+    logits = collect_logits(model, [path for path, _ in samples], args.batch_size)
+    labels = np.array([label for _, label in samples])
+
+    temperature = fit_temperature(logits, labels)
+    scores = ood_scores(logits, temperature, args.ood_method)
+    threshold = round(float(np.quantile(scores, args.accept_rate)), 6)
+    report = {
+        "temperature": round(temperature, 6),
+        "ood_method": args.ood_method,
+        "reject_threshold": threshold,
+        "fitted_on": split_dir,
+        "images": len(samples),
+        "accuracy": round(float((logits.argmax(axis=1) == labels).mean()), 4),
+        "ece_before": round(expected_calibration_error(logits, labels), 4),
+        "ece_after": round(expected_calibration_error(logits, labels, temperature), 4),
+        "val_rejected": round(float((scores > threshold).mean()), 4),
+    }
+
+    if args.ood_dir:
+        ood_paths = sorted(path for path in glob.glob(os.path.join(args.ood_dir, "**", "*"), recursive=True)
+                           if os.path.splitext(path)[1].lower() in IMAGE_EXTENSIONS)
+        if ood_paths:
+            log(f"Scoring {len(ood_paths)} out-of-distribution images from {args.ood_dir}")
+            ood = ood_scores(collect_logits(model, ood_paths, args.batch_size), temperature, args.ood_method)
+            report["ood_images"] = len(ood_paths)
+            report["ood_rejected"] = round(float((ood > threshold).mean()), 4)
+            report["ood_auroc"] = round(auroc(scores, ood), 4)
+
+    if not args.dry_run:
+        report["path"] = save_calibration(model_path, report)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,354 @@
+import os
+import csv
+import sys
+import glob
+import json
+import time
+import signal
+import argparse
+import multiprocessing
+import urllib.request
+from types import SimpleNamespace
+import numpy as np
+import cpu_config
+import predict
+from backends import BACKENDS
+
+# Offline classification of large photo sets (directories, globs or CSV
+# manifests such as iNaturalist observation exports). Images are decoded and
+# preprocessed by a pool of processes while the main process runs batched
+# inference, and results are appended to the output after every batch so an
+# interrupted run can pick up where it stopped.
+
+PATH_COLUMNS = ("image_path", "path", "file", "filename", "image_url", "url")
+ID_COLUMNS = ("id", "observation_id", "uuid")
+FORMATS = ("csv", "jsonl", "parquet")
+
+def iter_sources(source, path_column=None, id_column=None, base_dir=None):
+    """
+    Yields (id, path_or_url) pairs from a directory, a glob or a CSV manifest
+
+    For CSVs the path column defaults to the first of image_path/path/file/
+    filename/image_url/url present and the id column to id/observation_id/uuid,
+    falling back to the path itself. Relative paths are resolved against
+    base_dir (the CSV's directory by default).
+    """
+    if os.path.isfile(source) and source.lower().endswith(".csv"):
+        base_dir = base_dir or os.path.dirname(os.path.abspath(source))
+        with open(source, newline="", encoding="utf-8") as f:
+            reader = csv.DictReader(f)
+            columns = reader.fieldnames or []
+            path_column = path_column or next((c for c in PATH_COLUMNS if c in columns), None)
+            if path_column is None:
+                raise ValueError(f"No image path column in {source}. Pass --path_column (columns: {', '.join(columns)})")
+            id_column = id_column or next((c for c in ID_COLUMNS if c in columns), None)
+            for row in reader:
+                path = (row.get(path_column) or "").strip()
+                if not path:
+                    continue
+                if not path.startswith(("http://", "https://")) and not os.path.isabs(path):
+                    path = os.path.join(base_dir, path)
+                yield (row[id_column] if id_column else path), path
+        return
+
+    if os.path.isdir(source):
+        source = os.path.join(source, "**", "*")
+    for path in sorted(glob.glob(source, recursive=True)):
+        if os.path.splitext(path)[1].lower() in predict.IMAGE_EXTENSIONS:
+            yield path, path
+
+# Set in each decode process by _init_decoder
+_settings = None
+
+def _init_decoder(settings, fast, timeout):
+    global _settings
+    # Ctrl-C goes to the whole process group; only the parent should handle it,
+    # otherwise a worker dying mid-task leaves the pool unable to shut down
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _settings = SimpleNamespace(**settings, fast=fast, timeout=timeout)
+
+def _decode(item):
+    """Runs in a decode process: returns (id, path, tensor, error)"""
+    key, path = item
+    try:
+        if path.startswith(("http://", "https://")):
+            with urllib.request.urlopen(path, timeout=_settings.timeout) as response:
+                image_bytes = response.read()
+        else:
+            with open(path, 'rb') as f:
+                image_bytes = f.read()
+        tensor = predict.decode_image_tensor(image_bytes, fast=_settings.fast, model=_settings)
+        return key, path, tensor, None
+    except Exception as e:
+        return key, path, None, f"Could not open image: {str(e)}"
+
+class ResultWriter:
+    """
+    Appends result rows to a CSV, JSONL or Parquet output and lists ids already written
+
+    CSV and JSONL rows are appended to one file; a half-written last line from
+    a crash is cut off before appending. Parquet output is a directory with
+    one part file per flush, since Parquet files cannot be appended to.
+    """
+
+    def __init__(self, path, fmt, topk, resume=True):
+        self.path = path
+        self.format = fmt
+        self.columns = ["id", "path"] + [f"{name}_{rank}" for rank in range(1, topk + 1) for name in ("class", "confidence")] + ["error"]
+        self.rows = 0
+        self._file = None
+        self._writer = None
+        self._part = 0
+
+        if fmt == "parquet":
+            try:
+                import pyarrow.parquet  # noqa: F401
+            except ImportError:
+                raise ImportError("Parquet output needs pyarrow (pip install pyarrow), or use a .csv/.jsonl output")
+        if not resume:
+            self._remove()
+        else:
+            self._drop_failed_rows()
+        self.done = self._read_done_ids()
+
+        if fmt == "parquet":
+            os.makedirs(path, exist_ok=True)
+            self._part = len(glob.glob(os.path.join(path, "part-*.parquet")))
+        else:
+            self._truncate_partial_line()
+            new_file = not os.path.exists(path) or os.path.getsize(path) == 0
+            self._file = open(path, "a", newline="", encoding="utf-8")
+            if fmt == "csv":
+                self._writer = csv.DictWriter(self._file, fieldnames=self.columns)
+                if new_file:
+                    self._writer.writeheader()
+
+    def _remove(self):
+        if self.format == "parquet" and os.path.isdir(self.path):
+            for part in glob.glob(os.path.join(self.path, "part-*.parquet")):
+                os.remove(part)
+        elif os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _truncate_partial_line(self):
+        if not os.path.exists(self.path) or os.path.getsize(self.path) == 0:
+            return
+        with open(self.path, "rb+") as f:
+            data = f.read()
+            if not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def _drop_failed_rows(self):
+        """Removes rows written with an error, so resuming retries those ids and their new row is the only one"""
+        if self.format == "parquet":
+            import pyarrow.compute as pc
+            import pyarrow.parquet as pq
+            for part in sorted(glob.glob(os.path.join(self.path, "part-*.parquet"))):
+                table = pq.read_table(part)
+                failed = pc.fill_null(pc.not_equal(pc.fill_null(table.column("error"), ""), ""), False)
+                if pc.any(failed).as_py():
+                    # Kept even when empty, since parts are numbered by count
+                    pq.write_table(table.filter(pc.invert(failed)), part + ".tmp")
+                    os.replace(part + ".tmp", part)
+            return
+        if not os.path.exists(self.path):
+            return
+        self._truncate_partial_line()
+        with open(self.path, newline="", encoding="utf-8") as f:
+            if self.format == "csv":
+                reader = csv.DictReader(f)
+                rows = list(reader)
+                kept = [row for row in rows if not row.get("error")]
+            else:
+                rows = f.readlines()
+                kept = [line for line in rows if not _jsonl_error(line)]
+        if len(kept) == len(rows):
+            return
+        with open(self.path + ".tmp", "w", newline="", encoding="utf-8") as f:
+            if self.format == "csv":
+                writer = csv.DictWriter(f, fieldnames=reader.fieldnames)
+                writer.writeheader()
+                writer.writerows(kept)
+            else:
+                f.writelines(kept)
+        os.replace(self.path + ".tmp", self.path)
+
+    def _read_done_ids(self):
+        done = set()
+        if self.format == "parquet":
+            parts = sorted(glob.glob(os.path.join(self.path, "part-*.parquet")))
+            if parts:
+                import pyarrow.parquet as pq
+                for part in parts:
+                    done.update(str(v) for v in pq.read_table(part, columns=["id"]).column("id").to_pylist())
+            return done
+        if not os.path.exists(self.path):
+            return done
+        with open(self.path, newline="", encoding="utf-8") as f:
+            if self.format == "csv":
+                for row in csv.DictReader(f):
+                    if row.get("id") is not None:
+                        done.add(row["id"])
+            else:
+                for line in f:
+                    try:
+                        done.add(str(json.loads(line)["id"]))
+                    except (ValueError, KeyError):
+                        pass
+        return done
+
+    def write(self, rows):
+        if not rows:
+            return
+        if self.format == "csv":
+            self._writer.writerows(rows)
+            self._file.flush()
+        elif self.format == "jsonl":
+            self._file.write("".join(json.dumps(row) + "\n" for row in rows))
+            self._file.flush()
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pylist(rows, schema=self._parquet_schema(pa))
+            part = os.path.join(self.path, f"part-{self._part:05d}.parquet")
+            # Written under a temporary name so a crash never leaves a truncated part behind
+            pq.write_table(table, part + ".tmp")
+            os.replace(part + ".tmp", part)
+            self._part += 1
+        self.rows += len(rows)
+
+    def _parquet_schema(self, pa):
+        fields = []
+        for column in self.columns:
+            fields.append(pa.field(column, pa.float64() if column.startswith("confidence_") else pa.string()))
+        return pa.schema(fields)
+
+    def close(self):
+        if self._file:
+            self._file.close()
+
+def _jsonl_error(line):
+    try:
+        return json.loads(line).get("error")
+    except ValueError:
+        return None
+
+def to_row(key, path, predictions, error, topk):
+    row = {"id": str(key), "path": path, "error": error}
+    for rank in range(1, topk + 1):
+        prediction = predictions[rank - 1] if predictions and rank <= len(predictions) else None
+        row[f"class_{rank}"] = prediction["class"] if prediction else None
+        row[f"confidence_{rank}"] = prediction["confidence"] if prediction else None
+    return row
+
+def classify_bulk(sources, writer, model_id=None, topk=3, batch_size=32, decode_workers=None, fast=True,
+                  download_timeout=30.0, flush_every=1, progress_callback=None):
+    """
+    Classifies (id, path) pairs that are not in writer.done and writes one row per image
+
+    Args:
+        sources (iterable): (id, path_or_url) pairs, e.g. from iter_sources
+        writer (ResultWriter): Output; ids in writer.done are skipped
+        batch_size (int): Images per forward pass
+        decode_workers (int, optional): Decode processes. Defaults to one less than the core count
+        flush_every (int): Batches between writes to the output
+    Returns:
+        dict: Counts of scored, failed and skipped images and the throughput
+    """
+    registry = predict.get_registry()
+    model_id = registry.resolve(model_id)
+    decode_workers = decode_workers or max(1, (os.cpu_count() or 2) - 1)
+
+    skipped = 0
+    def pending():
+        nonlocal skipped
+        for key, path in sources:
+            if str(key) in writer.done:
+                skipped += 1
+                continue
+            yield key, path
+
+    with registry.acquire(model_id) as model:
+        settings = {"input_size": model.input_size, "norm_mean": model.norm_mean, "norm_std": model.norm_std}
+        scored = failed = 0
+        start = time.perf_counter()
+        rows, batch = [], []
+        batches_since_flush = 0
+
+        def run_batch():
+            nonlocal scored
+            results = predict.predict_tensors(np.stack([tensor for _, _, tensor in batch]), topk, model)
+            for (key, path, _), predictions in zip(batch, results):
+                rows.append(to_row(key, path, predictions, None, topk))
+            scored += len(batch)
+            batch.clear()
+
+        with multiprocessing.Pool(decode_workers, initializer=_init_decoder, initargs=(settings, fast, download_timeout)) as pool:
+            # imap keeps the decode pool a bounded distance ahead of inference
+            for key, path, tensor, error in pool.imap(_decode, pending(), chunksize=4):
+                if error:
+                    rows.append(to_row(key, path, None, error, topk))
+                    failed += 1
+                else:
+                    batch.append((key, path, tensor))
+                if len(batch) >= batch_size:
+                    run_batch()
+                    batches_since_flush += 1
+                    if batches_since_flush >= flush_every:
+                        writer.write(rows)
+                        rows.clear()
+                        batches_since_flush = 0
+                        if progress_callback:
+                            elapsed = time.perf_counter() - start
+                            progress_callback(f"Scored {scored} images ({scored / elapsed:.1f}/s), {failed} failed, {skipped} already done")
+            if batch:
+                run_batch()
+            writer.write(rows)
+
+    elapsed = time.perf_counter() - start
+    return {"scored": scored, "failed": failed, "skipped": skipped, "seconds": round(elapsed, 3),
+            "images_per_sec": round(scored / elapsed, 2) if elapsed else 0.0, "output": writer.path}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Classify every image in a directory, glob or CSV manifest and write the results incrementally")
+    parser.add_argument("source", help="Directory (searched recursively), glob pattern or CSV manifest")
+    parser.add_argument("--output", type=str, required=True, help="Results file (.csv, .jsonl) or directory (.parquet)")
+    parser.add_argument("--format", type=str, default=None, choices=FORMATS, help="Output format (defaults to the --output extension)")
+    parser.add_argument("--no-resume", dest="resume", action="store_false", help="Start over instead of skipping images already in --output")
+    parser.add_argument("--path_column", type=str, default=None, help="CSV column with the image path or URL")
+    parser.add_argument("--id_column", type=str, default=None, help="CSV column identifying each row (defaults to id/observation_id/uuid, else the path)")
+    parser.add_argument("--base_dir", type=str, default=None, help="Directory relative CSV paths are resolved against (defaults to the CSV's directory)")
+    parser.add_argument("--topk", type=int, default=3, help="Number of top predictions to record per image")
+    parser.add_argument("--batch_size", type=int, default=32, help="Images per forward pass")
+    parser.add_argument("--decode_workers", type=int, default=None, help="Processes decoding images (defaults to cores - 1)")
+    parser.add_argument("--download_timeout", type=float, default=30.0, help="Seconds to wait for each image URL in a CSV")
+    parser.add_argument("--backend", type=str, default="eager", choices=BACKENDS, help="Execution backend")
+    parser.add_argument("--model_path", type=str, default=None, help="Model artifact to load (defaults to the standard file for the backend)")
+    parser.add_argument("--models_config", type=str, default=None, help="JSON file mapping model ids to backends and artifacts")
+    parser.add_argument("--model", type=str, default=None, help="Model id to classify with (defaults to the config's default model)")
+    parser.set_defaults(fast_decode=True)
+    parser.add_argument("--no-fast-decode", dest="fast_decode", action="store_false", help="Fully decode JPEGs before resizing instead of using draft mode")
+    cpu_config.add_arguments(parser)
+    args = parser.parse_args()
+
+    fmt = args.format or os.path.splitext(args.output.rstrip("/\\"))[1].lstrip(".").lower()
+    if fmt not in FORMATS:
+        print(json.dumps({"error": f"Cannot infer the output format from '{args.output}'. Use --format"}))
+        sys.exit(1)
+
+    # Opened first so a bad output path or missing pyarrow fails before the model loads
+    writer = ResultWriter(args.output, fmt, args.topk, resume=args.resume)
+    cpu_config.apply_args(args)
+    predict.load_model(args.backend, args.model_path, args.models_config, check_interval=0)
+
+    def log(message):
+        print(message, file=sys.stderr)
+
+    try:
+        summary = classify_bulk(iter_sources(args.source, args.path_column, args.id_column, args.base_dir), writer,
+                                model_id=args.model, topk=args.topk, batch_size=args.batch_size,
+                                decode_workers=args.decode_workers, fast=args.fast_decode,
+                                download_timeout=args.download_timeout, progress_callback=log)
+    finally:
+        writer.close()
+    print(json.dumps(summary, indent=2))
@@ -0,0 +1,50 @@
+const path = require("path");
+const { identifyPool } = require("../services/identifyPool");
+
+// Top-k predictions and, with ?heatmap=1, the Grad-CAM overlay from one forward pass.
+// ?heatmap=3 returns overlays for each of the top 3 suggestions; ?model= picks a model from MODELS_CONFIG.
+// ?inline=1 embeds the overlays as data URLs instead of links to /heatmaps.
+const handleIdentify = async (req, res) => {
+  if (!req.file) {
+    return res.status(400).json({ error: "No image uploaded" });
+  }
+
+  const heatmapTopk = req.query.heatmap === "true" ? 1 : parseInt(req.query.heatmap || "0", 10) || 0;
+  const inline = req.query.inline === "1";
+  const heatmapUrl = (h) =>
+    inline ? `data:${h.content_type};base64,${h.data}` : `http://${req.hostname}:3000/heatmaps/${path.basename(h.heatmap_path)}`;
+
+  try {
+    const { result, timings } = await identifyPool.request(
+      {
+        topk: 3,
+        heatmap: heatmapTopk > 0,
+        heatmap_topk: heatmapTopk,
+        model: req.query.model,
+        timings: req.query.timings === "1",
+        inline,
+      },
+      req.file.buffer
+    );
+    const response = { predictions: result.predictions, ood: result.ood };
+    if (result.ood && result.ood.rejected) response.rejected = true;
+    if (timings) response.timings = timings;
+    if (result.heatmap_path) {
+      response.heatmap = heatmapUrl(result.heatmaps[0]);
+      response.heatmaps = result.heatmaps.map((h) => ({ class: h.class, heatmap: heatmapUrl(h) }));
+    }
+    res.json(response);
+  } catch (err) {
+    res.status(500).json({ error: "Python process failed", details: err.message });
+  }
+};
+
+const handleIdentifyHealth = async (req, res) => {
+  try {
+    res.json({ workers: await identifyPool.health() });
+  } catch (err) {
+    res.status(503).json({ error: "Workers unavailable", details: err.message });
+  }
+};
+
+module.exports = { handleIdentify, handleIdentifyHealth };
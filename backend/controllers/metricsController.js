@@ -0,0 +1,32 @@
+const { predictPool } = require("../services/predictPool");
+const { identifyPool } = require("../services/identifyPool");
+
+// Merges the Prometheus text of every worker. Series are already labelled by
+// component and worker pid, so only the repeated HELP/TYPE lines are dropped.
+const mergeMetrics = (texts) => {
+  const seen = new Set();
+  const lines = [];
+  for (const text of texts) {
+    for (const line of text.split("\n")) {
+      if (!line) continue;
+      if (line.startsWith("# ")) {
+        if (seen.has(line)) continue;
+        seen.add(line);
+      }
+      lines.push(line);
+    }
+  }
+  return lines.join("\n") + "\n";
+};
+
+// GET /metrics (start the server with INFERENCE_TIMINGS=1 to collect stage timings)
+const handleMetrics = async (req, res) => {
+  try {
+    const texts = (await Promise.all([predictPool.metrics(), identifyPool.metrics()])).flat();
+    res.type("text/plain; version=0.0.4").send(mergeMetrics(texts));
+  } catch (err) {
+    res.status(503).json({ error: "Workers unavailable", details: err.message });
+  }
+};
+
+module.exports = { handleMetrics };
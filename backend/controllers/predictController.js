@@ -1,39 +1,32 @@
-const { spawn } = require("child_process");
-const path = require("path");
+const { predictPool: pool } = require("../services/predictPool");
 
-const handlePrediction = (req, res) => {
+const handlePrediction = async (req, res) => {
   if (!req.file) {
     return res.status(400).json({ error: "No image uploaded" });
   }
 
-  const imagePath = path.join(__dirname, "..", req.file.path);
-
-  // Spawn a fresh Python process
-  const python = spawn("python", ["predict.py", imagePath]);
-
-  let output = "";
-  let errorOutput = "";
-
-  python.stdout.on("data", (data) => {
-    output += data.toString();
-  });
-
-  python.stderr.on("data", (data) => {
-    errorOutput += data.toString();
-    console.error(`Python error: ${data}`);
-  });
-
-  python.on("close", (code) => {
-    if (code !== 0) {
-      return res.status(500).json({ error: "Python process failed", details: errorOutput });
+  try {
+    const { result, ood, timings } = await pool.request(
+      { topk: 3, model: req.query.model, timings: req.query.timings === "1" },
+      req.file.buffer
+    );
+    // Out-of-distribution photos (not one of the plants) are flagged so the app can skip expert review
+    if (ood && ood.rejected) {
+      res.json({ rejected: true, ood, predictions: result, ...(timings && { timings }) });
+    } else {
+      res.json(timings ? { predictions: result, timings } : result);
     }
-    try {
-      const result = JSON.parse(output); // Expect JSON from Python
-      res.json(result);
-    } catch (e) {
-      res.json({ raw: output.trim() }); // fallback if plain text
-    }
-  });
+  } catch (err) {
+    res.status(500).json({ error: "Python process failed", details: err.message });
+  }
+};
+
+const handleHealth = async (req, res) => {
+  try {
+    res.json({ workers: await pool.health() });
+  } catch (err) {
+    res.status(503).json({ error: "Workers unavailable", details: err.message });
+  }
 };
 
-module.exports = { handlePrediction };
+module.exports = { handlePrediction, handleHealth };
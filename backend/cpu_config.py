@@ -0,0 +1,118 @@
+import os
+import sys
+
+# Thread and core settings for CPU serving. Several worker processes each
+# running PyTorch or ONNX Runtime with one thread per core oversubscribe the
+# host, so each worker gets its share of the cores instead. apply() must run
+# before torch or onnxruntime create their thread pools (i.e. before the
+# model is loaded); the backends read intra_op_threads/inter_op_threads from
+# here when they load.
+
+intra_op_threads = None
+inter_op_threads = None
+cpu_set = None
+
+def available_cpus():
+    """CPUs this process may run on (respects an affinity mask set by the parent or a container)"""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+def parse_cpu_set(spec):
+    """Parses '0-3,6,8-9' into [0, 1, 2, 3, 6, 8, 9]"""
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return sorted(cpus)
+
+def default_threads(workers=1, cpus=None):
+    """Splits the available cores evenly across the workers, at least one thread each"""
+    cpus = available_cpus() if cpus is None else cpus
+    return max(1, len(cpus) // max(1, workers))
+
+def worker_cpu_set(worker_index, workers, cpus=None):
+    """The contiguous block of cores for one worker when the host is split evenly between workers"""
+    cpus = available_cpus() if cpus is None else cpus
+    share = max(1, len(cpus) // max(1, workers))
+    start = (worker_index * share) % len(cpus)
+    return cpus[start:start + share]
+
+def apply(intra_threads=None, inter_threads=None, pin=None, workers=1, worker_index=0):
+    """
+    Configures threading and CPU affinity for this worker process
+
+    Args:
+        intra_threads (int, optional): Threads per operator. Defaults to this worker's share of the cores
+        inter_threads (int, optional): Threads running independent operators in parallel. Defaults to 1,
+            since the classifiers are a single chain of layers
+        pin (str, optional): 'auto' pins to this worker's block of cores, or an explicit list like '0-3,6'
+        workers (int): Number of worker processes sharing the host
+        worker_index (int): This worker's position, used by pin='auto'
+    Returns:
+        dict: The settings that were applied
+    """
+    global intra_op_threads, inter_op_threads, cpu_set
+
+    cpus = available_cpus()
+    if pin == "auto":
+        cpu_set = worker_cpu_set(worker_index, workers, cpus)
+    elif pin:
+        cpu_set = parse_cpu_set(pin)
+    else:
+        cpu_set = None
+
+    # Without an affinity API (macOS/Windows) the thread pools are still sized to the set
+    if cpu_set and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpu_set)
+
+    intra_op_threads = intra_threads or (len(cpu_set) if cpu_set else default_threads(workers, cpus))
+    inter_op_threads = inter_threads or 1
+
+    # OpenMP/MKL read these when they initialize, which happens on first import of torch
+    for name in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[name] = str(intra_op_threads)
+    configure_torch()
+    return settings()
+
+def configure_torch():
+    """Applies the thread settings to torch if it has been (or is being) imported"""
+    if intra_op_threads is None:
+        return
+    torch = sys.modules.get("torch")
+    if torch is None:
+        return
+    torch.set_num_threads(intra_op_threads)
+    try:
+        torch.set_num_interop_threads(inter_op_threads)
+    except RuntimeError:
+        # Only allowed before the first parallel operation in the process
+        pass
+
+def configure_onnx_session(options):
+    """Applies the thread settings to onnxruntime SessionOptions"""
+    if intra_op_threads is not None:
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+    return options
+
+def settings():
+    return {"intra_op_threads": intra_op_threads, "inter_op_threads": inter_op_threads, "cpu_set": cpu_set,
+            "available_cpus": len(available_cpus())}
+
+def add_arguments(parser):
+    """Adds the shared --intra_op_threads/--inter_op_threads/--cpu_set/--workers/--worker_index flags"""
+    parser.add_argument("--intra_op_threads", type=int, default=None, help="Threads per operator (defaults to cores / --workers)")
+    parser.add_argument("--inter_op_threads", type=int, default=None, help="Threads for running independent operators in parallel (defaults to 1)")
+    parser.add_argument("--cpu_set", type=str, default=None, help="Pin to these cores, e.g. '0-3', or 'auto' for this worker's share")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes sharing this host, used for the defaults")
+    parser.add_argument("--worker_index", type=int, default=0, help="This worker's index among --workers, used by --cpu_set auto")
+
+def apply_args(args):
+    return apply(args.intra_op_threads, args.inter_op_threads, args.cpu_set, args.workers, args.worker_index)
@@ -0,0 +1,128 @@
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+import cpu_config
+import predict
+from backends import BACKENDS
+
+# Measures what test-time augmentation buys on a held-out split (the
+# train/val/test layout written by core/process_dataset.py): top-1/top-5
+# accuracy and per-image latency for plain single-view inference and each
+# TTA mode, run with the same batch size as serving.
+
+def load(model, path, mode, fast):
+    if mode:
+        return predict.load_image_views(path, fast, model, mode)
+    return predict.load_image_tensor(path, fast, model)[None]
+
+def evaluate_mode(model, samples, mode=None, batch_size=16, fast=None):
+    """
+    Classifies every sample with one TTA mode (None for a single view)
+
+    Args:
+        model (Backend): The model to evaluate
+        samples (list): (image_path, label_idx) pairs
+        mode (str, optional): A key of predict.TTA_MODES
+        batch_size (int): Images per forward pass
+        fast (bool, optional): JPEG draft decoding, as in predict.py
+    Returns:
+        dict: Accuracy and latency figures for the mode
+    """
+    views = predict.tta_views(mode)
+    top1 = top5 = 0
+    batch_ms = []
+
+    # One untimed batch so lazy initialization is not billed to the first mode
+    warmup = [load(model, path, mode, fast) for path, _ in samples[:batch_size]]
+    predict.predict_tensors(np.concatenate(warmup), 1, model, views=views)
+
+    start = time.perf_counter()
+    for offset in range(0, len(samples), batch_size):
+        batch = samples[offset:offset + batch_size]
+        batch_start = time.perf_counter()
+        tensors = np.concatenate([load(model, path, mode, fast) for path, _ in batch])
+        results = predict.predict_tensors(tensors, 5, model, views=views)
+        batch_ms.append((time.perf_counter() - batch_start) * 1000.0)
+
+        for (_, label), result in zip(batch, results):
+            classes = [model.class_to_idx[r["class"]] for r in result]
+            top1 += classes[0] == label
+            top5 += label in classes
+    elapsed = time.perf_counter() - start
+
+    return {
+        "mode": mode or "none",
+        "views": views,
+        "images": len(samples),
+        "top1": round(top1 / len(samples), 4),
+        "top5": round(top5 / len(samples), 4),
+        "ms_per_image": round(elapsed * 1000.0 / len(samples), 3),
+        "batch_p50_ms": round(float(np.percentile(batch_ms, 50)), 3),
+        "batch_p95_ms": round(float(np.percentile(batch_ms, 95)), 3),
+        "images_per_sec": round(len(samples) / elapsed, 2),
+    }
+
+def evaluate(split_dir, modes, batch_size=16, fast=None, limit=None, model_id=None, progress_callback=None):
+    """
+    Evaluates single-view inference and each TTA mode on one split
+
+    Returns:
+        dict: Per-mode results, each with its accuracy gain and latency cost relative to single-view
+    """
+    model = predict.get_backend(model_id)
+    samples, unknown = predict.list_split(split_dir, model.class_to_idx)
+    if limit:
+        # Spread the subset across classes instead of taking the first few folders
+        samples = samples[::max(1, len(samples) // limit)][:limit]
+    if not samples:
+        raise ValueError(f"No images of known classes in {split_dir}")
+
+    results = []
+    for mode in [None] + [m for m in modes if m]:
+        if progress_callback:
+            progress_callback(f"Evaluating {mode or 'single view'} on {len(samples)} images")
+        results.append(evaluate_mode(model, samples, mode, batch_size, fast))
+
+    baseline = results[0]
+    for result in results[1:]:
+        result["top1_gain"] = round(result["top1"] - baseline["top1"], 4)
+        result["top5_gain"] = round(result["top5"] - baseline["top5"], 4)
+        result["latency_ratio"] = round(result["ms_per_image"] / baseline["ms_per_image"], 3)
+    return {"split": split_dir, "model": model.describe(), "batch_size": batch_size,
+            "unknown_classes": unknown, "results": results}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare accuracy and latency of test-time augmentation modes on a dataset split")
+    parser.add_argument("data_dir", help="Processed dataset directory (with train/val/test) or a split directory of class folders")
+    parser.add_argument("--split", type=str, default="test", help="Split to evaluate when data_dir holds several")
+    parser.add_argument("--modes", type=str, nargs="+", default=list(predict.TTA_MODES), choices=sorted(predict.TTA_MODES), help="TTA modes to compare against single-view inference")
+    parser.add_argument("--batch_size", type=int, default=16, help="Images per forward pass")
+    parser.add_argument("--limit", type=int, default=None, help="Evaluate at most this many images")
+    parser.add_argument("--backend", type=str, default="eager", choices=BACKENDS, help="Execution backend")
+    parser.add_argument("--model_path", type=str, default=None, help="Model artifact to load (defaults to the standard file for the backend)")
+    parser.add_argument("--models_config", type=str, default=None, help="JSON file mapping model ids to backends and artifacts")
+    parser.add_argument("--model", type=str, default=None, help="Model id to evaluate (defaults to the config's default model)")
+    parser.add_argument("--output", type=str, default=None, help="Also write the report to this JSON file")
+    parser.set_defaults(fast_decode=True)
+    parser.add_argument("--no-fast-decode", dest="fast_decode", action="store_false", help="Fully decode JPEGs before resizing instead of using draft mode")
+    cpu_config.add_arguments(parser)
+    args = parser.parse_args()
+
+    split_dir = os.path.join(args.data_dir, args.split)
+    if not os.path.isdir(split_dir):
+        split_dir = args.data_dir
+
+    cpu_config.apply_args(args)
+    predict.load_model(args.backend, args.model_path, args.models_config, check_interval=0)
+
+    def log(message):
+        print(message, file=sys.stderr)
+
+    report = evaluate(split_dir, args.modes, args.batch_size, args.fast_decode, args.limit, args.model, log)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,98 @@
+import os
+import sys
+import json
+import argparse
+import torch
+from backends import CLASS_TO_IDX_KEY, PREPROCESS_KEY, DEFAULT_MODEL_PATHS, load_classifier, preprocess_from_checkpoint
+
+def load_checkpoint_model(checkpoint_path):
+    """
+    Builds the classifier from a .tar checkpoint
+
+    Returns the model, its class mapping and the preprocessing metadata
+    (architecture, input size, normalization) to embed in exported artifacts.
+    """
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    class_to_idx = checkpoint["class_to_idx"]
+    arch = checkpoint.get("model_name", "resnet18")
+    model = load_classifier(checkpoint)
+    return model, class_to_idx, {"arch": arch, **preprocess_from_checkpoint(checkpoint)}
+
+def export_torchscript(model, class_to_idx, preprocess, output_path):
+    scripted = torch.jit.script(model)
+    torch.jit.save(scripted, output_path, _extra_files={
+        f"{CLASS_TO_IDX_KEY}.json": json.dumps(class_to_idx),
+        f"{PREPROCESS_KEY}.json": json.dumps(preprocess),
+    })
+    return output_path
+
+def export_onnx(model, class_to_idx, preprocess, output_path, opset_version=17):
+    input_size = preprocess["input_size"]
+    dummy = torch.randn(1, 3, input_size, input_size)
+    export_kwargs = dict(
+        input_names=["input"],
+        output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=opset_version,
+    )
+    try:
+        # Newer torch defaults to the dynamo exporter, which needs onnxscript
+        torch.onnx.export(model, (dummy,), output_path, dynamo=False, **export_kwargs)
+    except TypeError:
+        torch.onnx.export(model, (dummy,), output_path, **export_kwargs)
+
+    import onnx
+    onnx_model = onnx.load(output_path)
+    for key, value in ((CLASS_TO_IDX_KEY, class_to_idx), (PREPROCESS_KEY, preprocess)):
+        entry = onnx_model.metadata_props.add()
+        entry.key = key
+        entry.value = json.dumps(value)
+    onnx.save(onnx_model, output_path)
+    return output_path
+
+def verify_export(model, output_path, fmt, input_size=224, atol=1e-4):
+    """Checks that an exported artifact produces the same logits as the eager model"""
+    sample = torch.randn(2, 3, input_size, input_size)
+    with torch.no_grad():
+        expected = model(sample).numpy()
+
+    if fmt == "torchscript":
+        with torch.no_grad():
+            actual = torch.jit.load(output_path)(sample).numpy()
+    else:
+        import onnxruntime as ort
+        session = ort.InferenceSession(output_path, providers=["CPUExecutionProvider"])
+        actual = session.run(None, {session.get_inputs()[0].name: sample.numpy()})[0]
+
+    max_diff = float(abs(expected - actual).max())
+    return max_diff <= atol, max_diff
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the classifier checkpoint to TorchScript and ONNX")
+    parser.add_argument("--checkpoint", type=str, default=DEFAULT_MODEL_PATHS["eager"], help="Path to the .tar checkpoint")
+    parser.add_argument("--output_dir", type=str, default=".", help="Directory to write the exported artifacts to")
+    parser.add_argument("--formats", type=str, nargs="+", default=["torchscript", "onnx"], choices=["torchscript", "onnx"], help="Artifacts to produce")
+    parser.add_argument("--opset_version", type=int, default=17, help="ONNX opset version")
+    parser.add_argument("--no-verify", dest="verify", action="store_false", help="Skip comparing exported outputs against the eager model")
+    args = parser.parse_args()
+
+    model, class_to_idx, preprocess = load_checkpoint_model(args.checkpoint)
+    stem = os.path.splitext(os.path.basename(args.checkpoint))[0]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    exported = {}
+    for fmt in args.formats:
+        if fmt == "torchscript":
+            path = export_torchscript(model, class_to_idx, preprocess, os.path.join(args.output_dir, f"{stem}.ts"))
+        else:
+            path = export_onnx(model, class_to_idx, preprocess, os.path.join(args.output_dir, f"{stem}.onnx"), args.opset_version)
+        exported[fmt] = {"path": path}
+
+        if args.verify:
+            ok, max_diff = verify_export(model, path, fmt, preprocess["input_size"])
+            exported[fmt]["max_abs_diff"] = max_diff
+            if not ok:
+                print(json.dumps({"error": f"{fmt} export does not match the eager model", "exported": exported}))
+                sys.exit(1)
+
+    print(json.dumps({"exported": exported}, indent=2))
@@ -0,0 +1,159 @@
+import os
+import re
+import time
+import hashlib
+import threading
+
+# <sha256 of image bytes>_<class index>_<model version>.<ext>
+ARTIFACT_PATTERN = re.compile(r"^[0-9a-f]{64}_\d+_[0-9a-f]+\.(jpg|webp)$")
+
+def image_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def model_version(fingerprint):
+    """Short stable id for a model fingerprint, used in artifact names"""
+    return hashlib.sha1(fingerprint.encode()).hexdigest()[:12]
+
+class HeatmapStore:
+    """
+    Content-addressed directory of heatmap overlays with LRU eviction
+
+    Artifacts are named by image hash, class index and model version, so the
+    same photo uploaded again (under any name) reuses the existing overlay.
+    The directory is shared by all workers on the host, so it is the only
+    index: file mtimes record the last access, and eviction scans the
+    directory and deletes the least recently used files until the total size
+    of everyone's artifacts fits max_bytes. Scans run at most every
+    scan_interval seconds per worker, so the directory can exceed the limit
+    by what the workers write in between.
+
+    Args:
+        directory (str): Where the artifacts are written (served as /heatmaps)
+        max_bytes (int): Total size above which the least recently used artifacts are deleted
+        max_age_seconds (float, optional): Artifacts not accessed for this long are deleted. None disables the age limit
+        scan_interval (float): Least number of seconds between two eviction scans of this process
+    """
+
+    def __init__(self, directory, max_bytes=512 * 1024 * 1024, max_age_seconds=7 * 24 * 3600.0, scan_interval=1.0):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.max_age_seconds = max_age_seconds
+        self.scan_interval = scan_interval
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.entries = 0
+        self.total_bytes = 0
+        self._last_scan = 0.0
+        self._lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._evict()
+
+    def name_for(self, digest, class_index, version, extension=".jpg"):
+        return f"{digest}_{int(class_index)}_{version}{extension}"
+
+    def get(self, digest, class_index, version, extension=".jpg"):
+        """Returns the path of an existing artifact, or None"""
+        path = os.path.join(self.directory, self.name_for(digest, class_index, version, extension))
+        now = time.time()
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            # Evicted (possibly by another worker) or never written
+            with self._lock:
+                self.misses += 1
+            return None
+
+        if self.max_age_seconds is not None and now - st.st_mtime > self.max_age_seconds:
+            self._remove(path)
+            with self._lock:
+                self.expirations += 1
+                self.misses += 1
+            return None
+
+        try:
+            os.utime(path, (now, now))
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return path
+
+    def put(self, digest, class_index, version, encoded_bytes, extension=".jpg"):
+        """Atomically writes an encoded artifact and returns its path"""
+        name = self.name_for(digest, class_index, version, extension)
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(encoded_bytes)
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self.writes += 1
+            if time.monotonic() - self._last_scan >= self.scan_interval:
+                self._evict(keep=name)
+        return path
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                # As of the last eviction scan, counting every worker's artifacts
+                "entries": self.entries,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+                "max_age_seconds": self.max_age_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "writes": self.writes,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Another worker evicted it first
+            pass
+
+    def _evict(self, keep=None):
+        """Scans the directory and deletes expired artifacts, then the least recently used ones above max_bytes"""
+        self._last_scan = time.monotonic()
+        now = time.time()
+        artifacts = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not ARTIFACT_PATTERN.match(entry.name):
+                    continue
+                try:
+                    st = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if self.max_age_seconds is not None and now - st.st_mtime > self.max_age_seconds and entry.name != keep:
+                    self._remove(entry.path)
+                    self.expirations += 1
+                    continue
+                artifacts.append((st.st_mtime, entry.name, st.st_size))
+
+        artifacts.sort()
+        total_bytes = sum(size for _, _, size in artifacts)
+        count = len(artifacts)
+        for _, name, size in artifacts:
+            if total_bytes <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            self._remove(os.path.join(self.directory, name))
+            total_bytes -= size
+            count -= 1
+            self.evictions += 1
+        self.entries = count
+        self.total_bytes = total_bytes
@@ -0,0 +1,284 @@
+import io
+import os
+import sys
+import json
+import base64
+import argparse
+import torch
+from predict import open_image, transform
+from gradcam import CHECKPOINT_PATH, OUTPUT_DIR, forward_with_activations, gradcams_from_activations, cams_from_activations, check_cam_compatible, default_conv_layer, OverlayRenderer, OVERLAY_FORMATS
+from heatmap_store import HeatmapStore, image_digest, model_version
+from calibration import ood_scores, ood_result
+from jsonl_server import serve_jsonl
+from model_registry import ModelRegistry
+import cpu_config
+import timing
+from timing import span
+
+# Single entry point for identification: the image is decoded once, one
+# forward pass yields both the top-k predictions and the conv activations,
+# and the Grad-CAM for the top class reuses that same pass.
+
+# Eager checkpoints by id, set up by load(). Heatmaps need the PyTorch module,
+# so every model here runs on the eager backend
+registry = None
+
+# Deduplicating overlay store (disabled until configure_store() is called)
+heatmap_store = None
+
+# Display size and encoding of the overlays, see configure_overlay()
+overlay_renderer = OverlayRenderer()
+
+# Reject threshold overriding each model's calibrated one (None uses the model's)
+reject_threshold = None
+
+def load(checkpoint_path=CHECKPOINT_PATH, config_path=None, max_memory_mb=0, check_interval=5.0):
+    """Sets up the model registry (see ModelRegistry) and loads the default model"""
+    global registry
+    registry = ModelRegistry(config_path, "eager", checkpoint_path,
+                             max_memory_bytes=max_memory_mb * 1024 * 1024 if max_memory_mb > 0 else None,
+                             check_interval=check_interval)
+    return registry.get()
+
+def get_registry():
+    if registry is None:
+        load()
+    return registry
+
+def cam_settings(model, cam_mode):
+    """Returns the conv layer to explain and the CAM mode that works for it, falling back to gradcam"""
+    conv_layer_name = default_conv_layer(model)
+    if cam_mode == "cam":
+        try:
+            check_cam_compatible(model, conv_layer_name)
+        except ValueError:
+            cam_mode = "gradcam"
+    return conv_layer_name, cam_mode
+
+def configure_store(max_mb=512, max_age_seconds=7 * 24 * 3600.0, directory=OUTPUT_DIR):
+    """Enables the content-addressed heatmap store, or disables it when max_mb is 0"""
+    global heatmap_store
+    heatmap_store = HeatmapStore(directory, max_mb * 1024 * 1024, max_age_seconds) if max_mb > 0 else None
+    return heatmap_store
+
+def configure_overlay(max_side=1024, image_format="jpeg", quality=85):
+    """Sets the longest side, format and quality of the overlays identify() produces"""
+    global overlay_renderer
+    overlay_renderer = OverlayRenderer(max_side, image_format, quality)
+    return overlay_renderer
+
+def identify(image_path, topk=3, heatmap=False, output_dir=OUTPUT_DIR, cam_mode="cam", heatmap_topk=1, model_id=None, name=None, inline=False):
+    """
+    Predicts the top-k classes for an image and optionally writes Grad-CAM overlays
+
+    image_path may also be the encoded image bytes. The image is decoded once
+    and that array feeds both the model input and the overlays. Overlay files
+    outside the heatmap store are named after name, the file name, or for
+    bytes without a name the start of their hash.
+
+    Overlays are drawn at the display size set by configure_overlay(), and
+    the photo is only decoded at that size. With inline set each entry of
+    "heatmaps" also carries the encoded overlay as base64 "data" with its
+    "content_type", so it can be sent to the client without another request.
+
+    The response also has "ood", the out-of-distribution score from the same
+    forward pass (see calibration.py). Images it rejects get no overlays.
+
+    Returns a dict with "predictions" (the same list predict.py returns) and,
+    when heatmap is set, "heatmap_path" for the top class plus "heatmaps"
+    with one overlay per class for the first heatmap_topk predictions, all
+    computed from the same forward pass. cam_mode 'cam' builds the maps from
+    the fc weights with no backward pass; 'gradcam' uses autograd. Models
+    that are not ResNets always use 'gradcam' on their last conv layer.
+
+    With the heatmap store enabled, overlays are keyed by image content,
+    class and model version; ones already on disk are returned as they are
+    and only the missing classes are computed.
+    """
+    registry = get_registry()
+    model_id = registry.resolve(model_id)
+    with registry.acquire(model_id) as backend:
+        return _identify(backend, model_id, image_path, topk, heatmap, output_dir, cam_mode, heatmap_topk, name, inline)
+
+def _identify(backend, model_id, image_path, topk, heatmap, output_dir, cam_mode, heatmap_topk, name=None, inline=False):
+    if backend.name != "eager":
+        return {"error": f"Model '{model_id}' uses the {backend.name} backend; identify needs an eager .tar checkpoint"}
+    model = backend.model
+    try:
+        if isinstance(image_path, bytes):
+            image_bytes = image_path
+        else:
+            with span("read"):
+                with open(image_path, 'rb') as f:
+                    image_bytes = f.read()
+        # The overlay is drawn on the decoded image, so draft mode may only shrink it to the overlay size
+        renderer = overlay_renderer
+        decode_size = max(backend.input_size, renderer.max_side) if heatmap else backend.input_size
+        with span("decode"):
+            img = open_image(io.BytesIO(image_bytes), fast=not heatmap or renderer.max_side > 0, input_size=decode_size)
+    except Exception as e:
+        return {"error": f"Could not open image: {str(e)}"}
+
+    with span("preprocess"):
+        img_tensor = torch.from_numpy(transform(img, backend)).unsqueeze(0).to(backend.device)
+    conv_layer_name, cam_mode = cam_settings(model, cam_mode)
+    use_gradients = heatmap and cam_mode == "gradcam"
+    preds, activations = forward_with_activations(model, img_tensor, conv_layer_name=conv_layer_name, requires_grad=use_gradients)
+
+    with span("postprocess"):
+        logits = preds.detach()
+        probs = torch.softmax(logits / backend.temperature, dim=1)[0]
+        top_probs, top_idxs = probs.topk(min(topk, probs.shape[0]))
+        threshold = reject_threshold if reject_threshold is not None else backend.reject_threshold
+        ood = ood_result(ood_scores(logits.cpu().numpy(), backend.temperature, backend.ood_method)[0], backend.ood_method, threshold)
+
+        predictions = []
+        for prob, idx in zip(top_probs.tolist(), top_idxs.tolist()):
+            predictions.append({
+                "class": backend.idx_to_class[idx],
+                "confidence": round(float(prob), 4)
+            })
+    response = {"predictions": predictions, "ood": ood}
+
+    # Rejected images are not worth explaining
+    if heatmap and ood["rejected"]:
+        response["heatmaps"] = []
+        response["heatmap_path"] = None
+    elif heatmap:
+        ranked = top_idxs[:max(1, heatmap_topk)].tolist()
+        paths = [None] * len(ranked)
+        digest = None
+        version = model_version(f"{model_id}:{backend.fingerprint}:{renderer.key}")
+        if heatmap_store is not None:
+            with span("store_lookup"):
+                digest = image_digest(image_bytes)
+                paths = [heatmap_store.get(digest, class_index, version, renderer.extension) for class_index in ranked]
+
+        missing = [rank for rank, path in enumerate(paths) if path is None]
+        encoded = [None] * len(ranked)
+        if missing:
+            class_indices = torch.tensor([[ranked[rank] for rank in missing]])
+            if use_gradients:
+                cams = gradcams_from_activations(preds, activations, class_indices)[0]
+            else:
+                cams = cams_from_activations(model, activations, class_indices)[0]
+
+            photo = renderer.prepare(img)
+            if name:
+                filename = os.path.basename(name)
+            elif isinstance(image_path, bytes):
+                filename = (digest or image_digest(image_bytes))[:16]
+            else:
+                filename = os.path.splitext(os.path.basename(image_path))[0]
+            for rank, cam in zip(missing, cams):
+                encoded[rank] = renderer.render_encoded(photo, cam)
+                if heatmap_store is not None:
+                    with span("write"):
+                        paths[rank] = heatmap_store.put(digest, ranked[rank], version, encoded[rank], renderer.extension)
+                else:
+                    suffix = "" if rank == 0 else f"_{rank + 1}"
+                    paths[rank] = os.path.join(output_dir, f"{filename}_heatmap{suffix}{renderer.extension}")
+                    with span("write"):
+                        with open(paths[rank], "wb") as f:
+                            f.write(encoded[rank])
+
+        response["heatmaps"] = [{"class": predictions[rank]["class"], "heatmap_path": path} for rank, path in enumerate(paths)]
+        response["heatmap_path"] = paths[0]
+        if inline:
+            for rank, entry in enumerate(response["heatmaps"]):
+                if encoded[rank] is None:
+                    # Served from the store
+                    with span("read"):
+                        with open(paths[rank], "rb") as f:
+                            encoded[rank] = f.read()
+                entry["data"] = base64.b64encode(encoded[rank]).decode("ascii")
+                entry["content_type"] = renderer.content_type
+
+    return response
+
+def serve(input_stream=sys.stdin, output_stream=sys.stdout, default_cam_mode="cam"):
+    """
+    Serves identify() over JSON lines with the registry's models resident
+
+    Requests look like {"id": 1, "image_path": "uploads/abc", "topk": 3, "heatmap": true, "heatmap_topk": 3, "model": "plants"}
+    and are answered with {"id": 1, "result": {"predictions": [...], "ood": {...}, "heatmap_path": ..., "heatmaps": [...]}}.
+    Instead of image_path a request can carry the upload as "image_bytes"
+    framing (see serve_jsonl) plus an optional "name" for the overlay files,
+    and "inline": true returns the encoded overlays in the reply (see identify).
+    {"id": 2, "cmd": "reload", "model": "plants"} swaps in a retrained checkpoint right away.
+    With stage timing enabled, "timings": true adds a per-stage breakdown to the
+    reply and {"cmd": "metrics"} returns Prometheus histograms.
+    """
+    def handle(request, reply):
+        if request.get("cmd") == "reload":
+            reply({"result": get_registry().reload(request.get("model")).describe()})
+            return
+        source = request.get("image_data") or request.get("image_path")
+        if not source:
+            reply({"error": "No image provided"})
+            return
+        with timing.trace() as spans:
+            result = identify(source, topk=int(request.get("topk", 3)), heatmap=bool(request.get("heatmap", False)),
+                              cam_mode=request.get("cam_mode", default_cam_mode), heatmap_topk=int(request.get("heatmap_topk", 1)),
+                              model_id=request.get("model"), name=request.get("name"), inline=bool(request.get("inline", False)))
+        if "error" in result:
+            reply({"error": result["error"]})
+        elif spans is not None and request.get("timings"):
+            reply({"result": result, "timings": spans})
+        else:
+            reply({"result": result})
+
+    def health_info():
+        return {"models": get_registry().stats(), "heatmap_store": heatmap_store.stats() if heatmap_store else None,
+                "overlay": overlay_renderer.key, "cpu": cpu_config.settings()}
+
+    backend = get_registry().get()
+    serve_jsonl(handle, input_stream, output_stream,
+                ready_info={"num_classes": backend.num_classes, "models": get_registry().model_ids()},
+                health_info=health_info,
+                metrics_text=timing.render_metrics if timing.enabled else None)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Predict the plant species in an image and optionally explain it with Grad-CAM")
+    parser.add_argument("image_path", nargs="?", help="Path to the image to classify")
+    parser.add_argument("--topk", type=int, default=3, help="Number of top predictions to return")
+    parser.add_argument("--heatmap", action="store_true", help="Also write the Grad-CAM overlay for the top class")
+    parser.add_argument("--heatmap_topk", type=int, default=1, help="Number of top predictions to write overlays for")
+    parser.add_argument("--cam_mode", type=str, default="cam", choices=["cam", "gradcam"], help="'cam' derives the map from the fc weights without a backward pass")
+    parser.add_argument("--checkpoint", type=str, default=CHECKPOINT_PATH, help="Path to the .tar checkpoint")
+    parser.add_argument("--models_config", type=str, default=None, help="JSON file mapping model ids to .tar checkpoints; overrides --checkpoint")
+    parser.add_argument("--model", type=str, default=None, help="Model id to identify with (defaults to the config's default model)")
+    parser.add_argument("--max_model_memory_mb", type=int, default=0, help="Unload least recently used models above this much resident model memory (0 for no limit)")
+    parser.add_argument("--reload_interval", type=float, default=5.0, help="Seconds between checks for rewritten checkpoints to hot-swap (0 to disable)")
+    parser.add_argument("--serve", action="store_true", help="Keep the model loaded and serve JSON-line requests on stdin/stdout")
+    parser.add_argument("--heatmap_store_mb", type=int, default=512, help="Disk budget for deduplicated overlays in serve mode, shared by all workers using the directory (0 to disable)")
+    parser.add_argument("--heatmap_store_max_age", type=float, default=7 * 24 * 3600.0, help="Seconds an overlay may go unused before it is deleted")
+    parser.add_argument("--reject_threshold", type=float, default=None, help="OOD score above which images are rejected and get no heatmap (defaults to the model's calibration)")
+    parser.add_argument("--overlay_max_side", type=int, default=1024, help="Longest side of the overlays in pixels (0 for the full photo resolution)")
+    parser.add_argument("--overlay_format", type=str, default="jpeg", choices=sorted(OVERLAY_FORMATS), help="Encoding of the overlays")
+    parser.add_argument("--overlay_quality", type=int, default=85, help="JPEG/WebP quality of the overlays")
+    parser.add_argument("--timings", action="store_true", help="Time each stage: adds a per-stage breakdown to the output and enables the metrics command in serve mode")
+    cpu_config.add_arguments(parser)
+    args = parser.parse_args()
+    cpu_config.apply_args(args)
+    timing.configure(args.timings, "identify")
+
+    configure_overlay(args.overlay_max_side, args.overlay_format, args.overlay_quality)
+    reject_threshold = args.reject_threshold
+    load(args.checkpoint, args.models_config, args.max_model_memory_mb, args.reload_interval)
+
+    if args.serve:
+        configure_store(args.heatmap_store_mb, args.heatmap_store_max_age)
+        serve(default_cam_mode=args.cam_mode)
+        sys.exit(0)
+
+    if not args.image_path:
+        print(json.dumps({"error": "No image path provided"}))
+        sys.exit(1)
+
+    with timing.trace() as spans:
+        result = identify(args.image_path, topk=args.topk, heatmap=args.heatmap, cam_mode=args.cam_mode, heatmap_topk=args.heatmap_topk, model_id=args.model)
+    if spans is not None:
+        result["timings"] = spans
+    print(json.dumps(result, indent=2))
+    sys.exit(0)
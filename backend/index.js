@@ -3,6 +3,8 @@ const path = require("path");
 
 const predictRoutes = require("./routes/predict");
 const heatmapRoutes = require("./routes/heatmap");
+const identifyRoutes = require("./routes/identify");
+const { handleMetrics } = require("./controllers/metricsController");
 
 const app = express();
 app.use(express.json());
@@ -13,6 +15,8 @@ app.use("/heatmaps", express.static(path.join(__dirname, "heatmaps")));
 // Mount routes
 app.use("/predict", predictRoutes);      
 app.use("/heatmap", heatmapRoutes); 
+app.use("/identify", identifyRoutes);
+app.get("/metrics", handleMetrics);
 
 app.listen(3000, () => {
   console.log("✅ Server running on http://localhost:3000");
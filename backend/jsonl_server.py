@@ -0,0 +1,102 @@
+import os
+import sys
+import json
+import time
+import threading
+
+def serve_jsonl(handle, input_stream=sys.stdin, output_stream=sys.stdout, ready_info=None, health_info=None, on_shutdown=None, metrics_text=None):
+    """
+    Runs the JSON-lines request loop shared by the long-running backend scripts
+
+    Each input line is a JSON object. A request with "image_bytes": n is
+    followed on the stream by exactly n raw bytes (an encoded image), which
+    are passed to handle as request["image_data"]; this lets the caller hand
+    over an upload without a base64 round trip or a temp file. This needs a
+    binary stream, so text streams like sys.stdin are read through .buffer.
+
+    {"id": 2, "cmd": "health"} returns the
+    worker status, {"id": 3, "cmd": "metrics"} returns {"metrics": <Prometheus
+    text>} when metrics_text is given, and {"cmd": "shutdown"} (or EOF) stops the loop. Anything
+    else is passed to handle(request, reply), which answers by calling
+    reply(message) once, from any thread; the request id is added to the
+    message automatically. A single {"status": "ready"} line is written
+    before the first request is read.
+
+    Args:
+        handle (function): Called as handle(request, reply) for every non-control request
+        ready_info (dict, optional): Extra fields for the ready line
+        health_info (function, optional): Returns extra fields for health replies
+        on_shutdown (function, optional): Called before the loop returns, e.g. to drain queued work
+        metrics_text (function, optional): Returns the Prometheus text for metrics replies
+    """
+    write_lock = threading.Lock()
+
+    def send(message):
+        with write_lock:
+            output_stream.write(json.dumps(message) + "\n")
+            output_stream.flush()
+
+    def make_reply(request_id):
+        def reply(message):
+            send({"id": request_id, **message})
+        return reply
+
+    stream = getattr(input_stream, "buffer", input_stream)
+
+    started = time.time()
+    served = 0
+    send({"status": "ready", "pid": os.getpid(), **(ready_info or {})})
+
+    while True:
+        line = stream.readline()
+        if not line:
+            break
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            send({"error": f"Invalid request: {str(e)}"})
+            continue
+
+        request_id = request.get("id")
+        cmd = request.get("cmd")
+
+        if "image_bytes" in request:
+            size = int(request.pop("image_bytes"))
+            data = stream.read(size)
+            if isinstance(data, str):
+                send({"id": request_id, "error": "Image bytes need a binary input stream"})
+                continue
+            if len(data) < size:
+                # The stream ended mid-image
+                send({"id": request_id, "error": "Truncated image bytes"})
+                break
+            request["image_data"] = data
+
+        if cmd == "shutdown":
+            if on_shutdown:
+                on_shutdown()
+            send({"id": request_id, "status": "bye"})
+            return
+        elif cmd == "health":
+            status = {"status": "ok", "pid": os.getpid(), "served": served, "uptime": round(time.time() - started, 3)}
+            if health_info:
+                status.update(health_info())
+            send({"id": request_id, **status})
+            continue
+        elif cmd == "metrics" and metrics_text:
+            send({"id": request_id, "metrics": metrics_text()})
+            continue
+
+        reply = make_reply(request_id)
+        try:
+            handle(request, reply)
+        except Exception as e:
+            reply({"error": f"Request failed: {str(e)}"})
+        served += 1
+
+    # EOF: answer everything still queued before exiting
+    if on_shutdown:
+        on_shutdown()
@@ -0,0 +1,266 @@
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from backends import DEFAULT_MODEL_PATHS, load_backend
+from result_cache import file_fingerprint
+from calibration import artifact_fingerprint
+
+DEFAULT_MODEL_ID = "default"
+
+class _Resident:
+    """A loaded backend plus the number of requests currently using it"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.in_use = 0
+        self.last_used = time.monotonic()
+
+class ModelRegistry:
+    """
+    Keeps several classifiers resident and hot-swaps retrained checkpoints
+
+    Models are listed in an optional JSON config:
+
+        {"default": "plants", "models": {"plants": {"backend": "onnx", "path": "plants.onnx"},
+                                         "weeds": {"backend": "eager", "path": "weeds.tar"}}}
+
+    The architecture, input size and normalization of each model come from
+    the artifact's own metadata (see backends.py), so a new fine-tune only
+    needs a config entry. The config file is re-read when it changes.
+
+    Models are loaded on first use and unloaded least recently used first
+    once their combined memory_bytes exceed max_memory_bytes. Models serving
+    a request and the most recently used one are never unloaded.
+
+    Every check_interval seconds the registry also looks at the artifacts of
+    resident models. When a file (or its calibration sidecar) was rewritten, the new version is loaded on a
+    background thread and swapped in atomically: new requests get the new
+    backend while in-flight ones finish on the old one, which is released when
+    they are done.
+
+    Args:
+        config_path (str, optional): JSON file listing the models. Without one a single "default" model is served
+        backend_name (str): Backend for the default model when there is no config
+        model_path (str, optional): Artifact for the default model when there is no config
+        max_memory_bytes (int, optional): Memory budget for resident models. None never unloads
+        check_interval (float): Seconds between checks for rewritten artifacts. 0 disables hot-swapping
+    """
+
+    def __init__(self, config_path=None, backend_name="eager", model_path=None, max_memory_bytes=None, check_interval=5.0):
+        self.config_path = config_path
+        self.max_memory_bytes = max_memory_bytes
+        self.check_interval = check_interval
+        self.loads = 0
+        self.swaps = 0
+        self.unloads = 0
+        self.load_errors = {}
+        self._fallback = {DEFAULT_MODEL_ID: {"backend": backend_name, "path": model_path or DEFAULT_MODEL_PATHS[backend_name]}}
+        self._config_fingerprint = None
+        self._specs = {}
+        self.default_id = DEFAULT_MODEL_ID
+        self._resident = OrderedDict()  # model id -> _Resident, least recently used first
+        self._swapping = set()
+        self._lock = threading.Lock()
+        self._load_locks = {}
+        self._last_check = time.monotonic()
+        self._read_config()
+
+    def _read_config(self):
+        if not self.config_path:
+            self._specs = self._fallback
+            return
+        fingerprint = file_fingerprint(self.config_path)
+        if fingerprint == self._config_fingerprint:
+            return
+        with open(self.config_path) as f:
+            config = json.load(f)
+        base_dir = os.path.dirname(os.path.abspath(self.config_path))
+        specs = {}
+        for model_id, spec in config["models"].items():
+            backend_name = spec.get("backend", "eager")
+            path = spec.get("path") or DEFAULT_MODEL_PATHS[backend_name]
+            specs[model_id] = {"backend": backend_name, "path": os.path.join(base_dir, path)}
+        self._specs = specs
+        self.default_id = config.get("default") or next(iter(specs))
+        self._config_fingerprint = fingerprint
+
+    def model_ids(self):
+        return list(self._specs)
+
+    def resolve(self, model_id=None):
+        """Returns the id that would serve a request for model_id, raising ValueError for unknown ids"""
+        model_id = model_id or self.default_id
+        if model_id not in self._specs:
+            raise ValueError(f"Unknown model: {model_id}. Available: {', '.join(self._specs)}")
+        return model_id
+
+    def get(self, model_id=None):
+        """
+        Returns the current backend for a model, loading it if needed
+
+        Prefer acquire() while serving: a backend returned here can be unloaded
+        or swapped out by another thread at any time.
+        """
+        with self.acquire(model_id) as backend:
+            return backend
+
+    @contextmanager
+    def acquire(self, model_id=None):
+        """Context manager that yields a backend and keeps it from being unloaded until the block exits"""
+        self._maybe_check()
+        model_id = self.resolve(model_id)
+        resident = self._pin(model_id)
+        try:
+            yield resident.backend
+        finally:
+            with self._lock:
+                resident.in_use -= 1
+                self._evict()
+
+    def _pin(self, model_id):
+        with self._lock:
+            resident = self._resident.get(model_id)
+            if resident is not None:
+                resident.in_use += 1
+                resident.last_used = time.monotonic()
+                self._resident.move_to_end(model_id)
+                return resident
+            load_lock = self._load_locks.setdefault(model_id, threading.Lock())
+
+        # Load outside the registry lock so other models keep serving; the
+        # per-model lock stops concurrent requests from loading it twice
+        with load_lock:
+            with self._lock:
+                resident = self._resident.get(model_id)
+            if resident is None:
+                resident = _Resident(self._load(model_id))
+                with self._lock:
+                    self._resident[model_id] = resident
+            with self._lock:
+                resident.in_use += 1
+                resident.last_used = time.monotonic()
+                self._resident.move_to_end(model_id)
+                self._evict(keep=model_id)
+        return resident
+
+    def _load(self, model_id):
+        spec = self._specs[model_id]
+        try:
+            backend = load_backend(spec["backend"], spec["path"])
+        except Exception as e:
+            self.load_errors[model_id] = str(e)
+            raise
+        self.load_errors.pop(model_id, None)
+        self.loads += 1
+        return backend
+
+    def _evict(self, keep=None):
+        # Caller holds self._lock
+        if self.max_memory_bytes is None:
+            return
+        # The most recently used model always stays, even if it alone exceeds the budget
+        for model_id in list(self._resident)[:-1]:
+            if self._memory_bytes() <= self.max_memory_bytes:
+                break
+            resident = self._resident[model_id]
+            if model_id == keep or resident.in_use > 0:
+                continue
+            del self._resident[model_id]
+            self.unloads += 1
+
+    def _memory_bytes(self):
+        return sum(resident.backend.memory_bytes for resident in self._resident.values())
+
+    def _maybe_check(self):
+        if self.check_interval <= 0 or time.monotonic() - self._last_check < self.check_interval:
+            return
+        self._last_check = time.monotonic()
+        self.check_for_updates()
+
+    def check_for_updates(self, wait=False):
+        """
+        Re-reads the config and starts a background reload for every resident model whose artifact changed
+
+        Models removed from the config are unloaded once idle. Returns the ids
+        being reloaded; with wait=True the reloads finish before returning.
+        """
+        try:
+            self._read_config()
+        except (OSError, ValueError, KeyError) as e:
+            # Keep serving the last good config while the file is being edited
+            self.load_errors["config"] = str(e)
+        else:
+            self.load_errors.pop("config", None)
+
+        threads = []
+        with self._lock:
+            for model_id in list(self._resident):
+                if model_id not in self._specs:
+                    if self._resident[model_id].in_use == 0:
+                        del self._resident[model_id]
+                        self.unloads += 1
+                    continue
+                backend = self._resident[model_id].backend
+                spec = self._specs[model_id]
+                if model_id in self._swapping:
+                    continue
+                try:
+                    changed = (spec["path"] != backend.model_path or spec["backend"] != backend.name
+                               or artifact_fingerprint(spec["path"]) != backend.fingerprint)
+                except FileNotFoundError:
+                    # Mid-write or removed; keep serving the loaded version
+                    changed = False
+                if changed:
+                    self._swapping.add(model_id)
+                    thread = threading.Thread(target=self._swap, args=(model_id,), daemon=True)
+                    thread.start()
+                    threads.append((model_id, thread))
+        if wait:
+            for _, thread in threads:
+                thread.join()
+        return [model_id for model_id, _ in threads]
+
+    def reload(self, model_id=None):
+        """Loads the current artifact for a model and swaps it in, blocking until done"""
+        model_id = self.resolve(model_id)
+        with self._lock:
+            self._swapping.add(model_id)
+        self._swap(model_id)
+        if model_id in self.load_errors:
+            raise RuntimeError(f"Could not reload model '{model_id}': {self.load_errors[model_id]}")
+        return self.get(model_id)
+
+    def _swap(self, model_id):
+        try:
+            backend = self._load(model_id)
+        except Exception:
+            # load_errors records it; the previous version keeps serving
+            with self._lock:
+                self._swapping.discard(model_id)
+            return
+
+        with self._lock:
+            # Requests holding the old _Resident keep using its backend until they finish
+            self._resident[model_id] = _Resident(backend)
+            self._resident.move_to_end(model_id)
+            self._swapping.discard(model_id)
+            self.swaps += 1
+            self._evict(keep=model_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "default": self.default_id,
+                "available": list(self._specs),
+                "resident": {model_id: {**resident.backend.describe(), "in_use": resident.in_use}
+                             for model_id, resident in self._resident.items()},
+                "memory_bytes": self._memory_bytes(),
+                "max_memory_bytes": self.max_memory_bytes,
+                "loads": self.loads,
+                "swaps": self.swaps,
+                "unloads": self.unloads,
+                "load_errors": dict(self.load_errors),
+            }
@@ -1,70 +1,475 @@
+import io
+import os
 import sys
 import json
-import torch
-import torch.nn as nn
-import torch.nn.functional as F
-from torchvision.models import resnet18
-from torchvision import transforms
-from PIL import Image
-
-#Setup
-num_classes = 12
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-
-# Load model (ResNet18)
-model = resnet18(weights=None)
-model.fc = nn.Linear(model.fc.in_features, num_classes)
-
-# Load checkpoint
-checkpoint = torch.load("resnet18_with_class_label_weights_best_acc.tar", map_location=device)
-model.load_state_dict(checkpoint['model'], strict=False)
-
-# Build idx_to_class mapping
-idx_to_class = {v: k for k, v in checkpoint["class_to_idx"].items()}
-
-model = model.to(device)
-model.eval()
-
-# Preprocessing
-transform = transforms.Compose([
-    transforms.Resize((224, 224)),
-    transforms.ToTensor(),
-    transforms.Normalize([0.485, 0.456, 0.406],
-                         [0.229, 0.224, 0.225])
-])
-
-def predict(image_path, topk=3):
-    try:
-        img = Image.open(image_path).convert('RGB')
-    except Exception as e:
-        return {"error": f"Could not open image: {str(e)}"}
-
-    img_tensor = transform(img).unsqueeze(0).to(device)
-
-    with torch.no_grad():
-        output = model(img_tensor)
-        probs = F.softmax(output, dim=1)[0]
-
-        # Get top-k predictions
-        top_probs, top_idxs = probs.topk(topk)
-        top_probs = top_probs.cpu().numpy()
-        top_idxs = top_idxs.cpu().numpy()
-
-        results = []
-        for i in range(topk):
-            results.append({
-                "class": idx_to_class[top_idxs[i]],
-                "confidence": round(float(top_probs[i]), 4)
-            })
+import time
+import argparse
+import numpy as np
+from PIL import Image, ImageOps
+from backends import BACKENDS
+from batcher import MicroBatcher
+from calibration import ood_scores, ood_result
+from jsonl_server import serve_jsonl
+from model_registry import ModelRegistry
+from result_cache import ResultCache
+import cpu_config
+import timing
+from timing import span
 
+#Setup: defaults for callers that preprocess without a model at hand.
+# Each backend reports the input size and normalization of its own model
+INPUT_SIZE = 224
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
+NORM_MEAN = np.array([0.485, 0.456, 0.406], dtype=np.float32)
+NORM_STD = np.array([0.229, 0.224, 0.225], dtype=np.float32)
+
+# Models by id (one "default" model unless a config lists more), set up by load_model()
+registry = None
+
+def load_model(backend_name="eager", model_path=None, config_path=None, max_memory_mb=0, check_interval=5.0):
+    """
+    Sets up the model registry and loads the default model
+
+    Args:
+        backend_name (str): Execution backend for the default model when there is no config
+        model_path (str, optional): Artifact for the default model when there is no config
+        config_path (str, optional): JSON file listing several models, see ModelRegistry
+        max_memory_mb (int): Memory budget for resident models (0 for no limit)
+        check_interval (float): Seconds between checks for retrained artifacts (0 to disable hot-swapping)
+    """
+    global registry
+    registry = ModelRegistry(config_path, backend_name, model_path,
+                             max_memory_bytes=max_memory_mb * 1024 * 1024 if max_memory_mb > 0 else None,
+                             check_interval=check_interval)
+    return registry.get()
+
+def get_registry():
+    if registry is None:
+        load_model()
+    return registry
+
+def get_backend(model_id=None):
+    return get_registry().get(model_id)
+
+# Result cache (disabled until configure_cache() is called)
+result_cache = None
+
+def configure_cache(max_entries=1024, ttl_seconds=3600.0):
+    """Enables the content-hash result cache, or disables it when max_entries is 0"""
+    global result_cache
+    result_cache = ResultCache(max_entries, ttl_seconds) if max_entries > 0 else None
+    return result_cache
+
+def preprocess_settings(model=None):
+    """Returns (input_size, norm_mean, norm_std) for a backend, or the ResNet18 defaults"""
+    if model is None:
+        return INPUT_SIZE, NORM_MEAN, NORM_STD
+    return model.input_size, np.array(model.norm_mean, dtype=np.float32), np.array(model.norm_std, dtype=np.float32)
+
+# Preprocessing: the same resize/scale/normalize as torchvision's
+# Resize((size, size)) + ToTensor + Normalize, done in numpy so the
+# TorchScript and ONNX backends can skip importing torchvision
+def transform(img, model=None):
+    input_size, norm_mean, norm_std = preprocess_settings(model)
+    img = img.resize((input_size, input_size), Image.BILINEAR)
+    arr = np.asarray(img, dtype=np.float32) / 255.0
+    arr = (arr - norm_mean) / norm_std
+    return np.ascontiguousarray(arr.transpose(2, 0, 1))
+
+# When set, JPEGs are decoded straight at a reduced scale (1/2, 1/4 or 1/8) in
+# the DCT domain so 12 MP phone photos never get fully decoded just to be
+# shrunk to the model input size. Non-JPEG formats ignore it
+fast_decode = True
+
+def list_split(split_dir, class_to_idx):
+    """Lists (image_path, label_idx) pairs of a split laid out as <split>/<class>/<image>, and the class folders the model does not know"""
+    samples, unknown = [], []
+    for class_name in sorted(os.listdir(split_dir)):
+        class_dir = os.path.join(split_dir, class_name)
+        if not os.path.isdir(class_dir):
+            continue
+        if class_name not in class_to_idx:
+            unknown.append(class_name)
+            continue
+        for name in sorted(os.listdir(class_dir)):
+            if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS:
+                samples.append((os.path.join(class_dir, name), class_to_idx[class_name]))
+    return samples, unknown
+
+def open_image(source, fast=None, input_size=INPUT_SIZE):
+    """Opens an image path or file object as RGB, using JPEG draft mode when fast decoding is on"""
+    if fast is None:
+        fast = fast_decode
+    img = Image.open(source)
+    if fast:
+        # draft() keeps both sides >= input_size, so the final resize only ever shrinks
+        img.draft('RGB', (input_size, input_size))
+    # Phone photos store their rotation in EXIF; cv2.imread applied it, so keep doing so
+    img = ImageOps.exif_transpose(img)
+    return img.convert('RGB')
+
+def load_image_tensor(image_path, fast=None, model=None):
+    """Decodes an image from disk into a normalized (3, size, size) float32 array"""
+    with span("decode"):
+        img = open_image(image_path, fast, preprocess_settings(model)[0])
+    with span("preprocess"):
+        return transform(img, model)
+
+def decode_image_tensor(image_bytes, fast=None, model=None):
+    """Decodes encoded image bytes into a normalized (3, size, size) float32 array"""
+    return load_image_tensor(io.BytesIO(image_bytes), fast, model)
+
+# Test-time augmentation: each image is classified from several views whose
+# logits are averaged. A view is (crop, flip): crop None is the plain squashed
+# resize used without TTA, and crop s is a center square of side
+# shorter_side / s (the same region as resizing the shorter side to size * s
+# and center-cropping size). All views of all images in a batch go through
+# one forward pass, so the cost grows with the batch size, not the pass count
+TTA_MODES = {
+    "flip": ((None, False), (None, True)),
+    "standard": ((None, False), (None, True), (1.14, False), (1.14, True)),
+    "multiscale": ((None, False), (None, True), (1.0, False), (1.0, True),
+                   (1.14, False), (1.14, True), (1.3, False), (1.3, True)),
+}
+
+# TTA mode used by predict_batch (None for a single view)
+tta_mode = None
+
+def tta_views(mode=None):
+    """Number of views per image for a TTA mode"""
+    return len(TTA_MODES[mode]) if mode else 1
+
+def center_crop(img, crop):
+    """The centered square of side min(width, height) / crop"""
+    width, height = img.size
+    side = min(width, height) / crop
+    left, top = (width - side) / 2, (height - side) / 2
+    return img.crop((round(left), round(top), round(left + side), round(top + side)))
+
+def load_image_views(image_path, fast=None, model=None, mode=None):
+    """
+    Decodes an image once into a (views, 3, size, size) float32 array of TTA views
+
+    Each distinct crop is resized and normalized once; flipped views are
+    mirrored copies of the normalized array.
+    """
+    views = TTA_MODES[mode]
+    input_size = preprocess_settings(model)[0]
+    largest_crop = max(crop or 1.0 for crop, _ in views)
+    with span("decode"):
+        # Decode large enough that the tightest crop still has input_size pixels per side
+        img = open_image(image_path, fast, int(round(input_size * largest_crop)))
+    with span("preprocess"):
+        crops = {}
+        arrays = []
+        for crop, flip in views:
+            if crop not in crops:
+                crops[crop] = transform(img if crop is None else center_crop(img, crop), model)
+            arrays.append(crops[crop][:, :, ::-1] if flip else crops[crop])
+        return np.stack(arrays)
+
+def decode_image_views(image_bytes, fast=None, model=None, mode=None):
+    """Decodes encoded image bytes into a (views, 3, size, size) array of TTA views"""
+    return load_image_views(io.BytesIO(image_bytes), fast, model, mode)
+
+def compare_decode(image_path, topk=3):
+    """Runs the fast (draft) and full decode paths on one image and reports how they differ"""
+    with open(image_path, 'rb') as f:
+        image_bytes = f.read()
+
+    model = get_backend()
+    report = {}
+    tensors = {}
+    for name, fast in (("full", False), ("fast", True)):
+        start = time.perf_counter()
+        tensors[name] = decode_image_tensor(image_bytes, fast=fast, model=model)
+        decode_ms = (time.perf_counter() - start) * 1000.0
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            if fast:
+                img.draft('RGB', (model.input_size, model.input_size))
+            decoded_size = img.size
+        report[name] = {
+            "decode_ms": round(decode_ms, 3),
+            "decoded_size": list(decoded_size),
+            "result": predict_tensors(tensors[name][None], topk, model)[0],
+        }
+
+    report["max_abs_diff"] = float(np.abs(tensors["full"] - tensors["fast"]).max())
+    report["same_top1"] = report["full"]["result"][0]["class"] == report["fast"]["result"][0]["class"]
+    return report
+
+# Reject threshold overriding each model's calibrated one (None uses the model's)
+reject_threshold = None
+
+def softmax(logits):
+    shifted = logits - logits.max(axis=1, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=1, keepdims=True)
+
+def predict_tensors(img_tensors, topk=3, model=None, views=1, with_ood=False):
+    """
+    Runs one batched forward pass and returns a top-k result list per image
+
+    Confidences are softmax probabilities at the model's calibrated
+    temperature. With with_ood it returns (results, ood) instead, where ood
+    holds each image's out-of-distribution score from the same logits and
+    whether it is above the reject threshold (see calibration.py).
+
+    Args:
+        img_tensors (ndarray): A (N * views, 3, size, size) float32 batch of preprocessed images,
+            with the views of each image next to each other
+        topk (int or list): Number of predictions to return, either shared or one per image
+        model (Backend, optional): The backend to run. Defaults to the registry's default model
+        views (int): TTA views per image; their logits are averaged
+        with_ood (bool): Also return the out-of-distribution scores
+    """
+    if model is None:
+        model = get_backend()
+    num_images = len(img_tensors) // views
+    topks = list(topk) if isinstance(topk, (list, tuple)) else [topk] * num_images
+    max_k = min(max(topks), model.num_classes)
+
+    with span("forward"):
+        logits = model.run(img_tensors)
+    if views > 1:
+        logits = logits.reshape(num_images, views, -1).mean(axis=1)
+
+    with span("postprocess"):
+        probs = softmax(logits / model.temperature)
+
+        # Get top-k predictions for the whole batch at once
+        top_idxs = np.argsort(-probs, axis=1, kind="stable")[:, :max_k]
+        top_probs = np.take_along_axis(probs, top_idxs, axis=1)
+
+        batch_results = []
+        for row, k in enumerate(topks):
+            results = []
+            for i in range(min(k, max_k)):
+                results.append({
+                    "class": model.idx_to_class[int(top_idxs[row, i])],
+                    "confidence": round(float(top_probs[row, i]), 4)
+                })
+            batch_results.append(results)
+
+        if not with_ood:
+            return batch_results
+        threshold = reject_threshold if reject_threshold is not None else model.reject_threshold
+        scores = ood_scores(logits, model.temperature, model.ood_method)
+        return batch_results, [ood_result(score, model.ood_method, threshold) for score in scores]
+
+def predict_batch(image_paths, topk=3, model_id=None, with_ood=False):
+    """
+    Predicts several images with a single forward pass of one model
+
+    Each entry of image_paths is a file path or the encoded image bytes
+    themselves (as handed over by serve mode). Images that cannot be opened get an error dict in their slot instead of
+    failing the whole batch. When the result cache is enabled, images whose
+    bytes were already classified with the same model, checkpoint and TTA
+    mode are answered from the cache and skipped in the forward pass. With
+    tta_mode set, every view of every image shares the one forward pass.
+
+    With with_ood each successful slot is {"predictions": [...], "ood": {...}}
+    instead of the bare prediction list, see predict_tensors.
+
+    The model is held for the whole call, so a hot-swap that lands meanwhile
+    only affects the next batch.
+    """
+    registry = get_registry()
+    model_id = registry.resolve(model_id)
+    with registry.acquire(model_id) as model:
+        results = _predict_batch(model, model_id, image_paths, topk)
+    if with_ood:
+        return results
+    return [result.get("predictions", result) for result in results]
+
+def _predict_batch(model, model_id, image_paths, topk):
+    topks = list(topk) if isinstance(topk, (list, tuple)) else [topk] * len(image_paths)
+    results = [None] * len(image_paths)
+    tensors, rows, keys = [], [], []
+
+    for i, image_path in enumerate(image_paths):
+        try:
+            if isinstance(image_path, bytes):
+                image_bytes = image_path
+            else:
+                with span("read"):
+                    with open(image_path, 'rb') as f:
+                        image_bytes = f.read()
+        except Exception as e:
+            results[i] = {"error": f"Could not open image: {str(e)}"}
+            continue
+
+        key = None
+        if result_cache is not None:
+            # The fingerprint changes when the checkpoint is rewritten, so stale results are never hit
+            with span("cache_lookup"):
+                key = result_cache.make_key(image_bytes, model_id, model.fingerprint, topks[i], tta_mode)
+                cached = result_cache.get(key)
+            if cached is not None:
+                results[i] = cached
+                continue
+
+        try:
+            if tta_mode:
+                tensors.append(decode_image_views(image_bytes, model=model, mode=tta_mode))
+            else:
+                tensors.append(decode_image_tensor(image_bytes, model=model))
+            rows.append(i)
+            keys.append(key)
+        except Exception as e:
+            results[i] = {"error": f"Could not open image: {str(e)}"}
+
+    if tensors:
+        with span("collate"):
+            batch = np.concatenate(tensors) if tta_mode else np.stack(tensors)
+        batch_results, oods = predict_tensors(batch, [topks[i] for i in rows], model, views=tta_views(tta_mode), with_ood=True)
+        for i, key, predictions, ood in zip(rows, keys, batch_results, oods):
+            result = results[i] = {"predictions": predictions, "ood": ood}
+            if key is not None:
+                result_cache.put(key, result)
     return results
 
+def predict(image_path, topk=3, model_id=None):
+    return predict_batch([image_path], topk=topk, model_id=model_id)[0]
+
+def serve(input_stream=sys.stdin, output_stream=sys.stdout, max_batch_size=8, max_wait_ms=5.0):
+    """
+    Serves predictions over JSON lines so the models are loaded only once
+
+    Prediction requests look like {"id": 1, "image_path": "uploads/abc", "topk": 3, "model": "plants"}
+    and are answered with {"id": 1, "result": [...], "ood": {"score": ..., "rejected": false, ...}}
+    (see predict_tensors). Instead of image_path a
+    request can carry the upload itself as "image_bytes" framing (see
+    serve_jsonl), which is decoded straight from memory. "model" is optional and
+    defaults to the registry's default model. {"id": 2, "cmd": "reload", "model": "plants"}
+    swaps in the current artifact right away instead of waiting for the
+    periodic check. See serve_jsonl for the health/shutdown commands and the ready line.
+
+    Prediction requests that arrive together are coalesced by a MicroBatcher
+    into one forward pass per model of up to max_batch_size images, so
+    responses may be written out of order; match them by id.
+
+    With stage timing enabled (see timing.py), {"cmd": "metrics"} returns
+    Prometheus histograms and requests sent with "timings": true get a
+    "timings" dict of milliseconds per stage for the batch they ran in,
+    plus the time they waited in the queue.
+    """
+    def run_batch(items):
+        results = [None] * len(items)
+        groups = {}
+        for i, (_, _, model_id, _) in enumerate(items):
+            groups.setdefault(model_id, []).append(i)
+        for model_id, rows in groups.items():
+            started = time.perf_counter()
+            with timing.trace() as spans:
+                try:
+                    group_results = predict_batch([items[i][0] for i in rows], topk=[items[i][1] for i in rows], model_id=model_id, with_ood=True)
+                except Exception as e:
+                    group_results = [{"error": f"Prediction failed: {str(e)}"}] * len(rows)
+            for i, result in zip(rows, group_results):
+                timings = None
+                if spans is not None:
+                    queued_ms = (started - items[i][3]) * 1000.0
+                    timing.histograms.observe("queue", queued_ms / 1000.0)
+                    timings = {"queue": round(queued_ms, 3), "batch_size": len(rows), **spans}
+                results[i] = (result, timings)
+        return results
+
+    def respond(reply, future, want_timings):
+        timings = None
+        try:
+            result, timings = future.result()
+        except Exception as e:
+            result = {"error": f"Prediction failed: {str(e)}"}
+        if "error" in result:
+            reply({"error": result["error"]})
+        elif want_timings and timings is not None:
+            reply({"result": result["predictions"], "ood": result["ood"], "timings": timings})
+        else:
+            reply({"result": result["predictions"], "ood": result["ood"]})
+
+    def handle(request, reply):
+        cmd = request.get("cmd", "predict")
+        if cmd == "reload":
+            reply({"result": get_registry().reload(request.get("model")).describe()})
+            return
+        if cmd != "predict":
+            reply({"error": f"Unknown command: {cmd}"})
+            return
+        source = request.get("image_data") or request.get("image_path")
+        if not source:
+            reply({"error": "No image provided"})
+            return
+        try:
+            model_id = get_registry().resolve(request.get("model"))
+        except ValueError as e:
+            reply({"error": str(e)})
+            return
+        future = batcher.submit((source, int(request.get("topk", 3)), model_id, time.perf_counter()))
+        want_timings = bool(request.get("timings", False))
+        future.add_done_callback(lambda f: respond(reply, f, want_timings))
+
+    def health_info():
+        return {"batching": batcher.stats(), "cache": result_cache.stats() if result_cache else None,
+                "models": get_registry().stats(), "cpu": cpu_config.settings()}
+
+    model = get_backend()
+    batcher = MicroBatcher(run_batch, max_batch_size=max_batch_size, max_wait_ms=max_wait_ms)
+    serve_jsonl(handle, input_stream, output_stream,
+                ready_info={"backend": model.name, "num_classes": model.num_classes, "models": get_registry().model_ids(), "tta": tta_mode},
+                health_info=health_info,
+                on_shutdown=batcher.close,
+                metrics_text=timing.render_metrics if timing.enabled else None)
+
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
+    parser = argparse.ArgumentParser(description="Predict the plant species in an image")
+    parser.add_argument("image_path", nargs="?", help="Path to the image to classify")
+    parser.add_argument("--topk", type=int, default=3, help="Number of top predictions to return")
+    parser.add_argument("--backend", type=str, default="eager", choices=BACKENDS, help="Execution backend (export TorchScript/ONNX artifacts with export_model.py)")
+    parser.add_argument("--model_path", type=str, default=None, help="Model artifact to load (defaults to the standard file for the backend)")
+    parser.add_argument("--models_config", type=str, default=None, help="JSON file mapping model ids to backends and artifacts; overrides --backend/--model_path")
+    parser.add_argument("--model", type=str, default=None, help="Model id to classify with (defaults to the config's default model)")
+    parser.add_argument("--max_model_memory_mb", type=int, default=0, help="Unload least recently used models above this much resident model memory (0 for no limit)")
+    parser.add_argument("--reload_interval", type=float, default=5.0, help="Seconds between checks for rewritten model files to hot-swap (0 to disable)")
+    parser.add_argument("--serve", action="store_true", help="Keep the model loaded and serve JSON-line requests on stdin/stdout")
+    parser.add_argument("--max_batch_size", type=int, default=8, help="Largest batch the serve mode coalesces into one forward pass")
+    parser.add_argument("--max_wait_ms", type=float, default=5.0, help="How long serve mode waits for more requests before running a batch")
+    parser.add_argument("--cache_size", type=int, default=1024, help="Number of results kept in the content-hash cache (0 to disable)")
+    parser.add_argument("--cache_ttl", type=float, default=3600.0, help="Seconds a cached result stays valid")
+    parser.set_defaults(fast_decode=True)
+    parser.add_argument("--no-fast-decode", dest="fast_decode", action="store_false", help="Fully decode JPEGs before resizing instead of using draft mode")
+    parser.add_argument("--tta", type=str, default=None, choices=sorted(TTA_MODES), help="Average the logits of several flipped/cropped views of each image, all run in one batch")
+    parser.add_argument("--ood", action="store_true", help="Also report the out-of-distribution score and whether the image is rejected")
+    parser.add_argument("--reject_threshold", type=float, default=None, help="OOD score above which images are rejected (defaults to the model's calibration)")
+    parser.add_argument("--compare_decode", action="store_true", help="Report timing and output differences between the fast and full decode paths")
+    parser.add_argument("--timings", action="store_true", help="Time each stage: adds a per-stage breakdown to the output and enables the metrics command in serve mode")
+    cpu_config.add_arguments(parser)
+    args = parser.parse_args()
+    cpu_config.apply_args(args)
+
+    fast_decode = args.fast_decode
+    tta_mode = args.tta
+    reject_threshold = args.reject_threshold
+    timing.configure(args.timings, "predict")
+    load_model(args.backend, args.model_path, args.models_config, args.max_model_memory_mb, args.reload_interval)
+
+    if args.serve:
+        configure_cache(args.cache_size, args.cache_ttl)
+        serve(max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms)
+        sys.exit(0)
+
+    if not args.image_path:
         print(json.dumps({"error": "No image path provided"}))
         sys.exit(1)
 
-    image_path = sys.argv[1]
-    results = predict(image_path, topk=3)
+    if args.compare_decode:
+        results = compare_decode(args.image_path, topk=args.topk)
+    else:
+        with timing.trace() as spans:
+            results = predict_batch([args.image_path], topk=args.topk, model_id=args.model, with_ood=True)[0]
+        if "error" not in results and not args.ood:
+            results = results["predictions"]
+        if spans is not None:
+            results = {"predictions": results, "timings": spans} if isinstance(results, list) else {**results, "timings": spans}
     print(json.dumps(results, indent=2))
     sys.exit(0)
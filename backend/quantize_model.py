@@ -0,0 +1,161 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision.models import resnet18
+from torchvision.models.quantization import resnet18 as quantizable_resnet18
+from backends import CLASS_TO_IDX_KEY, QUANT_ENGINE_KEY, PREPROCESS_KEY, DEFAULT_MODEL_PATHS, preprocess_from_checkpoint
+from predict import load_image_tensor, list_split
+
+def pick_engine(engine="auto"):
+    supported = torch.backends.quantized.supported_engines
+    if engine == "auto":
+        engine = "fbgemm" if "fbgemm" in supported else "qnnpack"
+    if engine not in supported:
+        raise ValueError(f"Quantization engine '{engine}' is not supported here. Available: {', '.join(supported)}")
+    torch.backends.quantized.engine = engine
+    return engine
+
+def iter_batches(samples, batch_size):
+    for start in range(0, len(samples), batch_size):
+        chunk = samples[start:start + batch_size]
+        images = torch.from_numpy(np.stack([load_image_tensor(path) for path, _ in chunk]))
+        labels = torch.tensor([label for _, label in chunk])
+        yield images, labels
+
+def build_models(checkpoint_path):
+    """Returns the fp32 reference model, an unconverted quantizable copy, the class mapping and preprocessing metadata"""
+    checkpoint = torch.load(checkpoint_path, map_location="cpu")
+    if checkpoint.get("model_name", "resnet18") != "resnet18":
+        raise ValueError(f"Only ResNet18 checkpoints can be quantized, got '{checkpoint['model_name']}'")
+    class_to_idx = checkpoint["class_to_idx"]
+    num_classes = len(class_to_idx)
+
+    fp32_model = resnet18(weights=None)
+    fp32_model.fc = nn.Linear(fp32_model.fc.in_features, num_classes)
+    fp32_model.load_state_dict(checkpoint["model"], strict=False)
+    fp32_model.eval()
+
+    quant_model = quantizable_resnet18(weights=None, quantize=False)
+    quant_model.fc = nn.Linear(quant_model.fc.in_features, num_classes)
+    quant_model.load_state_dict(checkpoint["model"], strict=False)
+    quant_model.eval()
+    return fp32_model, quant_model, class_to_idx, {"arch": "resnet18", **preprocess_from_checkpoint(checkpoint)}
+
+def quantize(quant_model, calibration_samples, engine, batch_size=32, progress_callback=None):
+    """Fuses conv/bn/relu, calibrates activation ranges on the given images and converts to int8"""
+    quant_model.fuse_model(is_qat=False)
+    quant_model.qconfig = torch.ao.quantization.get_default_qconfig(engine)
+    torch.ao.quantization.prepare(quant_model, inplace=True)
+
+    with torch.no_grad():
+        for i, (images, _) in enumerate(iter_batches(calibration_samples, batch_size)):
+            quant_model(images)
+            if progress_callback:
+                progress_callback(f"Calibrated batch {i + 1}/{(len(calibration_samples) + batch_size - 1) // batch_size}")
+
+    torch.ao.quantization.convert(quant_model, inplace=True)
+    return quant_model
+
+def evaluate(model, samples, batch_size=32):
+    """Returns top-1/top-3 accuracy, the argmax for each sample and the mean latency per image"""
+    top1 = 0
+    top3 = 0
+    predictions = []
+    elapsed = 0.0
+    with torch.no_grad():
+        for images, labels in iter_batches(samples, batch_size):
+            start = time.perf_counter()
+            logits = model(images)
+            elapsed += time.perf_counter() - start
+            k = min(3, logits.shape[1])
+            top = logits.topk(k, dim=1).indices
+            top1 += (top[:, 0] == labels).sum().item()
+            top3 += (top == labels.unsqueeze(1)).any(dim=1).sum().item()
+            predictions.extend(top[:, 0].tolist())
+    n = max(len(samples), 1)
+    return {
+        "top1": top1 / n,
+        "top3": top3 / n,
+        "ms_per_image": 1000.0 * elapsed / n,
+    }, predictions
+
+def save_quantized(quant_model, class_to_idx, preprocess, engine, output_path):
+    example = torch.randn(1, 3, preprocess["input_size"], preprocess["input_size"])
+    with torch.no_grad():
+        traced = torch.jit.trace(quant_model, example)
+    torch.jit.save(traced, output_path, _extra_files={
+        f"{CLASS_TO_IDX_KEY}.json": json.dumps(class_to_idx),
+        f"{PREPROCESS_KEY}.json": json.dumps(preprocess),
+        QUANT_ENGINE_KEY: engine,
+    })
+    return output_path
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Statically quantize the classifier to int8 using a sample of the processed val split")
+    parser.add_argument("--checkpoint", type=str, default=DEFAULT_MODEL_PATHS["eager"], help="Path to the fp32 .tar checkpoint")
+    parser.add_argument("--data_dir", type=str, required=True, help="Processed dataset directory produced by core/process_dataset.py")
+    parser.add_argument("--val_dir_name", type=str, default="val", help="Name of the validation directory")
+    parser.add_argument("--output", type=str, default=DEFAULT_MODEL_PATHS["quantized"], help="Where to write the quantized TorchScript model")
+    parser.add_argument("--engine", type=str, default="auto", help="Quantization engine: fbgemm (x86), qnnpack (ARM) or auto")
+    parser.add_argument("--calibration_size", type=int, default=256, help="Number of val images used to calibrate activation ranges")
+    parser.add_argument("--eval_size", type=int, default=0, help="Number of held-out val images for the accuracy report (0 for all remaining)")
+    parser.add_argument("--batch_size", type=int, default=32, help="Batch size for calibration and evaluation")
+    parser.add_argument("--max_top1_drop", type=float, default=0.01, help="Largest allowed top-1 accuracy drop versus fp32 before the model is rejected")
+    parser.add_argument("--force", action="store_true", help="Save the quantized model even if it exceeds --max_top1_drop")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for choosing calibration images")
+    args = parser.parse_args()
+
+    engine = pick_engine(args.engine)
+    fp32_model, quant_model, class_to_idx, preprocess = build_models(args.checkpoint)
+
+    samples, skipped = list_split(os.path.join(args.data_dir, args.val_dir_name), class_to_idx)
+    if not samples:
+        print(json.dumps({"error": "No labelled images found in the val split"}))
+        sys.exit(1)
+    random.Random(args.seed).shuffle(samples)
+
+    calibration_samples = samples[:args.calibration_size]
+    eval_samples = samples[args.calibration_size:]
+    if args.eval_size > 0:
+        eval_samples = eval_samples[:args.eval_size]
+    if not eval_samples:
+        # Too few images to hold any out; report on the calibration set instead
+        eval_samples = calibration_samples
+
+    def log(message):
+        print(message, file=sys.stderr)
+
+    quantize(quant_model, calibration_samples, engine, args.batch_size, progress_callback=log)
+
+    fp32_metrics, fp32_predictions = evaluate(fp32_model, eval_samples, args.batch_size)
+    int8_metrics, int8_predictions = evaluate(quant_model, eval_samples, args.batch_size)
+    agreement = float(np.mean([a == b for a, b in zip(fp32_predictions, int8_predictions)]))
+
+    report = {
+        "engine": engine,
+        "calibration_images": len(calibration_samples),
+        "eval_images": len(eval_samples),
+        "held_out": eval_samples is not calibration_samples,
+        "skipped_classes": skipped,
+        "fp32": fp32_metrics,
+        "int8": int8_metrics,
+        "top1_delta": int8_metrics["top1"] - fp32_metrics["top1"],
+        "top3_delta": int8_metrics["top3"] - fp32_metrics["top3"],
+        "top1_agreement": agreement,
+        "speedup": fp32_metrics["ms_per_image"] / int8_metrics["ms_per_image"] if int8_metrics["ms_per_image"] else None,
+    }
+
+    top1_drop = fp32_metrics["top1"] - int8_metrics["top1"]
+    if top1_drop > args.max_top1_drop and not args.force:
+        report["error"] = f"Top-1 accuracy dropped by {top1_drop:.4f} (limit {args.max_top1_drop}). Model not saved; use --force to save anyway"
+        print(json.dumps(report, indent=2))
+        sys.exit(1)
+
+    report["output"] = save_quantized(quant_model, class_to_idx, preprocess, engine, args.output)
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,81 @@
+import os
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+
+def file_fingerprint(path):
+    """Cheap fingerprint of a file on disk that changes whenever it is rewritten"""
+    st = os.stat(path)
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+class ResultCache:
+    """
+    Thread-safe LRU cache with a time-to-live for prediction results
+
+    Keys combine a hash of the raw image bytes with the request options, so
+    re-uploads of the same photo under a new name still hit. Callers include
+    the model's fingerprint in the options, so results of a rewritten
+    checkpoint never match old entries, which age out through the LRU and TTL.
+
+    Args:
+        max_entries (int): The most results kept before the least recently used is evicted
+        ttl_seconds (float, optional): How long a result stays valid. None keeps results until evicted
+    """
+
+    def __init__(self, max_entries=1024, ttl_seconds=3600.0):
+        self.max_entries = max(1, int(max_entries))
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(image_bytes, *options):
+        digest = hashlib.sha256(image_bytes).hexdigest()
+        return (digest,) + tuple(options)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            stored_at, value = entry
+            if self.ttl_seconds is not None and time.monotonic() - stored_at > self.ttl_seconds:
+                del self._entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic(), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl_seconds,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
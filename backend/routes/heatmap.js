@@ -4,8 +4,8 @@ const multer = require("multer");
 const path = require("path");
 const { generateGradcam } = require("../controllers/heatmapController");
 
-// Upload folder for heatmap processing
-const upload = multer({ dest: "uploads/" });
+// Multer config: keeps the upload in memory; the bytes are piped straight to the Python worker
+const upload = multer({ storage: multer.memoryStorage(), limits: { fileSize: 25 * 1024 * 1024 } });
 
 // POST /predict/heatmap
 router.post("/", upload.single("image"), generateGradcam);
@@ -0,0 +1,16 @@
+const express = require("express");
+const multer = require("multer");
+const { handleIdentify, handleIdentifyHealth } = require("../controllers/identifyController");
+
+const router = express.Router();
+
+// Multer config: keeps the upload in memory; the bytes are piped straight to the Python worker
+const upload = multer({ storage: multer.memoryStorage(), limits: { fileSize: 25 * 1024 * 1024 } });
+
+// POST /identify (add ?heatmap=1 to also get the Grad-CAM overlay)
+router.post("/", upload.single("image"), handleIdentify);
+
+// GET /identify/health (worker status and heatmap store stats)
+router.get("/health", handleIdentifyHealth);
+
+module.exports = router;
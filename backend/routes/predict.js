@@ -1,13 +1,16 @@
 const express = require("express");
 const multer = require("multer");
-const { handlePrediction } = require("../controllers/predictController");
+const { handlePrediction, handleHealth } = require("../controllers/predictController");
 
 const router = express.Router();
 
-// Multer config: saves uploaded files into "uploads/"
-const upload = multer({ dest: "uploads/" });
+// Multer config: keeps the upload in memory; the bytes are piped straight to the Python worker
+const upload = multer({ storage: multer.memoryStorage(), limits: { fileSize: 25 * 1024 * 1024 } });
 
 // POST /predict
 router.post("/", upload.single("image"), handlePrediction);
 
+// GET /predict/health
+router.get("/health", handleHealth);
+
 module.exports = router;
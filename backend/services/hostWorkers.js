@@ -0,0 +1,10 @@
+const os = require("os");
+
+// Worker counts of both Python pools. Each worker sizes its thread pools to
+// its share of the cores among all workers on the host, so predict and
+// identify workers together never ask for more threads than there are cores.
+const predictWorkers = process.env.PREDICT_WORKERS ? parseInt(process.env.PREDICT_WORKERS, 10) : os.cpus().length;
+const identifyWorkers = process.env.IDENTIFY_WORKERS ? parseInt(process.env.IDENTIFY_WORKERS, 10) : 1;
+const hostWorkers = predictWorkers + identifyWorkers;
+
+module.exports = { predictWorkers, identifyWorkers, hostWorkers };
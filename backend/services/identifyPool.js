@@ -0,0 +1,21 @@
+const { PythonWorkerPool } = require("./pythonWorkerPool");
+const { identifyWorkers, hostWorkers } = require("./hostWorkers");
+
+// Warm identify.py workers shared by /identify and /heatmap so both use the
+// same resident model (override the count with IDENTIFY_WORKERS). Heatmaps need
+// eager .tar checkpoints, so IDENTIFY_MODELS_CONFIG lists those separately from MODELS_CONFIG.
+// HEATMAP_MAX_SIDE, HEATMAP_FORMAT (jpeg or webp) and HEATMAP_QUALITY set the overlay size and encoding.
+const args = [];
+if (process.env.IDENTIFY_MODELS_CONFIG) args.push("--models_config", process.env.IDENTIFY_MODELS_CONFIG);
+if (process.env.HEATMAP_MAX_SIDE) args.push("--overlay_max_side", process.env.HEATMAP_MAX_SIDE);
+if (process.env.HEATMAP_FORMAT) args.push("--overlay_format", process.env.HEATMAP_FORMAT);
+if (process.env.HEATMAP_QUALITY) args.push("--overlay_quality", process.env.HEATMAP_QUALITY);
+if (process.env.INFERENCE_TIMINGS === "1") args.push("--timings");
+
+const identifyPool = new PythonWorkerPool("identify.py", {
+  size: identifyWorkers,
+  args,
+  hostWorkers,
+});
+
+module.exports = { identifyPool };
@@ -0,0 +1,23 @@
+const { PythonWorkerPool } = require("./pythonWorkerPool");
+const { predictWorkers, hostWorkers } = require("./hostWorkers");
+
+// One warm predict.py process per core (override with PREDICT_WORKERS).
+// PREDICT_BACKEND selects eager, torchscript or onnx execution; MODELS_CONFIG
+// points at a JSON file listing several models (picked per request with ?model=).
+// INFERENCE_TIMINGS=1 turns on per-stage timing for /metrics and ?timings=1.
+// PREDICT_TTA (flip, standard or multiscale) averages several views per image.
+// PIN_CPUS=1 pins each worker to its own block of cores.
+const args = [];
+if (process.env.PREDICT_BACKEND) args.push("--backend", process.env.PREDICT_BACKEND);
+if (process.env.MODELS_CONFIG) args.push("--models_config", process.env.MODELS_CONFIG);
+if (process.env.INFERENCE_TIMINGS === "1") args.push("--timings");
+if (process.env.PREDICT_TTA) args.push("--tta", process.env.PREDICT_TTA);
+
+const predictPool = new PythonWorkerPool("predict.py", {
+  size: predictWorkers,
+  args,
+  hostWorkers,
+  pinCpus: process.env.PIN_CPUS === "1",
+});
+
+module.exports = { predictPool };
@@ -0,0 +1,190 @@
+const { spawn } = require("child_process");
+const readline = require("readline");
+const os = require("os");
+const path = require("path");
+
+const BACKEND_DIR = path.join(__dirname, "..");
+
+// Keeps a set of long-running Python processes (started with --serve) warm and
+// hands out JSON-line requests to the least busy one. Each worker is told the
+// number of workers on the host (hostWorkers, defaulting to the pool size) and
+// its index so it sizes its thread pools to its share of the cores; with
+// pinCpus it is also pinned to that share (Linux only).
+//
+// request(payload, data) can attach a Buffer (e.g. an in-memory upload): the
+// JSON line gets "image_bytes": data.length and the raw bytes follow it on
+// stdin, so images reach Python without a temp file or base64 encoding.
+//
+// A worker that dies (or fails to start) rejects its pending requests and is
+// restarted after restartDelay; requests never wait on a dead worker, and any
+// request without a reply after requestTimeout ms is rejected.
+class PythonWorkerPool {
+  constructor(script, { size = os.cpus().length, args = [], restartDelay = 1000, requestTimeout = 120000, hostWorkers, pinCpus = false } = {}) {
+    this.script = script;
+    this.args = args;
+    this.size = Math.max(1, size);
+    this.hostWorkers = Math.max(this.size, hostWorkers || 0);
+    this.restartDelay = restartDelay;
+    this.requestTimeout = requestTimeout;
+    this.pinCpus = pinCpus;
+    this.workers = [];
+    this.nextId = 1;
+    this.closed = false;
+
+    for (let i = 0; i < this.size; i++) {
+      this.workers.push(this.startWorker(i));
+    }
+  }
+
+  startWorker(index) {
+    const cpuArgs = ["--workers", String(this.hostWorkers), "--worker_index", String(index)];
+    if (this.pinCpus) cpuArgs.push("--cpu_set", "auto");
+    const proc = spawn("python", [this.script, "--serve", ...this.args, ...cpuArgs], { cwd: BACKEND_DIR });
+    const worker = { proc, ready: false, exited: false, pending: new Map() };
+    worker.readyPromise = new Promise((resolve) => (worker.markReady = resolve));
+
+    readline.createInterface({ input: proc.stdout }).on("line", (line) => {
+      let message;
+      try {
+        message = JSON.parse(line);
+      } catch (e) {
+        console.error(`Python worker ${proc.pid} wrote non-JSON output: ${line}`);
+        return;
+      }
+
+      if (message.status === "ready" && message.id === undefined) {
+        worker.ready = true;
+        worker.markReady();
+        return;
+      }
+
+      const request = worker.pending.get(message.id);
+      if (!request) return;
+      worker.pending.delete(message.id);
+      if (message.error) request.reject(new Error(message.error));
+      else request.resolve(message);
+    });
+
+    proc.stderr.on("data", (data) => {
+      console.error(`Python worker ${proc.pid}: ${data}`);
+    });
+
+    // A worker dying mid-write (e.g. during a large upload) surfaces as EPIPE here, not as an uncaught exception
+    proc.stdin.on("error", (err) => {
+      this.failPending(worker, new Error(`Python worker died: ${err.message}`));
+    });
+
+    // Spawning failed (e.g. no python executable); "exit" may never follow
+    proc.on("error", (err) => {
+      console.error(`Python worker for ${this.script} failed: ${err.message}`);
+      this.onWorkerExit(worker, err.message);
+    });
+
+    proc.on("exit", (code, signal) => {
+      this.onWorkerExit(worker, signal ? `signal ${signal}` : `code ${code}`);
+    });
+
+    return worker;
+  }
+
+  isDead(worker) {
+    return worker.exited || worker.proc.exitCode !== null || worker.proc.signalCode !== null;
+  }
+
+  failPending(worker, error) {
+    for (const request of worker.pending.values()) request.reject(error);
+    worker.pending.clear();
+  }
+
+  onWorkerExit(worker, reason) {
+    if (worker.exited) return;
+    worker.exited = true;
+    worker.ready = false;
+    // Anything still waiting for this worker to become ready must not write to its dead pipe
+    worker.readyPromise = new Promise((resolve) => (worker.markReady = resolve));
+    this.failPending(worker, new Error(`Python worker exited with ${reason}`));
+
+    if (!this.closed) {
+      setTimeout(() => {
+        const index = this.workers.indexOf(worker);
+        if (index !== -1 && !this.closed) this.workers[index] = this.startWorker(index);
+      }, this.restartDelay);
+    }
+  }
+
+  pickWorker() {
+    const alive = this.workers.filter((w) => !this.isDead(w));
+    if (alive.length === 0) return null;
+    const ready = alive.filter((w) => w.ready);
+    const candidates = ready.length > 0 ? ready : alive;
+    return candidates.reduce((best, w) => (w.pending.size < best.pending.size ? w : best));
+  }
+
+  request(payload, data) {
+    const worker = this.pickWorker();
+    if (!worker) return Promise.reject(new Error(`No ${this.script} worker is running (restarting)`));
+    return this.requestOn(worker, payload, data);
+  }
+
+  health() {
+    return Promise.all(this.workers.map((w) => (w.ready ? this.requestOn(w, { cmd: "health" }) : { status: "starting" })));
+  }
+
+  // Prometheus text from every ready worker; workers without timing enabled are skipped
+  async metrics() {
+    const replies = await Promise.all(
+      this.workers.filter((w) => w.ready).map((w) => this.requestOn(w, { cmd: "metrics" }).catch(() => null))
+    );
+    return replies.filter((r) => r && r.metrics).map((r) => r.metrics);
+  }
+
+  requestOn(worker, payload, data) {
+    const id = this.nextId++;
+    return new Promise((resolve, reject) => {
+      if (this.isDead(worker)) {
+        reject(new Error("Python worker is not running"));
+        return;
+      }
+      const timer = setTimeout(() => {
+        if (!worker.pending.delete(id)) return;
+        reject(new Error(`Python worker did not answer within ${this.requestTimeout} ms`));
+      }, this.requestTimeout);
+      const settle = (fn) => (value) => {
+        clearTimeout(timer);
+        fn(value);
+      };
+      // Register before the worker is ready so pickWorker() sees the queued load
+      worker.pending.set(id, { resolve: settle(resolve), reject: settle(reject) });
+      const failRequest = (err) => {
+        const request = worker.pending.get(id);
+        if (!request) return;
+        worker.pending.delete(id);
+        request.reject(new Error(`Python worker died: ${err.message}`));
+      };
+      worker.readyPromise.then(() => {
+        // Timed out or failed while waiting, or the worker died just now
+        if (!worker.pending.has(id)) return;
+        if (this.isDead(worker)) return failRequest(new Error("worker exited"));
+        if (!data) {
+          worker.proc.stdin.write(JSON.stringify({ ...payload, id }) + "\n");
+          return;
+        }
+        // Both writes are queued in the same tick, so no other request can land between header and bytes
+        worker.proc.stdin.write(JSON.stringify({ ...payload, id, image_bytes: data.length }) + "\n");
+        // A multi-MB upload can still be in flight when the worker dies
+        worker.proc.stdin.write(data, (err) => {
+          if (err) failRequest(err);
+        });
+      });
+    });
+  }
+
+  close() {
+    this.closed = true;
+    for (const worker of this.workers) {
+      worker.proc.stdin.end(JSON.stringify({ cmd: "shutdown" }) + "\n");
+    }
+  }
+}
+
+module.exports = { PythonWorkerPool };
@@ -0,0 +1,85 @@
+import os
+import sys
+import json
+import shlex
+import time
+import argparse
+import subprocess
+import statistics
+import zygote
+
+# Startup profile of the backend scripts: where import time goes (from
+# `python -X importtime`), and the wall time of a one-shot CLI run started
+# cold versus forked from a running zygote.py server.
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def import_profile(module, top=10):
+    """
+    Imports a module in a fresh interpreter under -X importtime
+
+    Args:
+        module (str): Module to import, e.g. 'predict'
+        top (int): Number of slowest direct imports to report
+    Returns:
+        dict: Total import time and the module's direct imports with the largest cumulative time, in ms
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            cwd=BACKEND_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr}")
+
+    total_ms, imports, pending = 0.0, [], []
+    for line in result.stderr.splitlines():
+        # "import time:  self [us] | cumulative | imported package", each nesting level indented two more spaces
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        # Nested imports are logged before their importer, so collect them until it appears
+        if depth == 1:
+            pending.append((name.strip(), int(cumulative) / 1000.0))
+        elif depth == 0:
+            if name.strip() == module:
+                total_ms, imports = int(cumulative) / 1000.0, pending
+            pending = []
+
+    imports.sort(key=lambda item: item[1], reverse=True)
+    return {
+        "module": module,
+        "total_ms": round(total_ms, 1),
+        "top": [{"module": name, "cumulative_ms": round(ms, 1)} for name, ms in imports[:top]],
+    }
+
+def time_command(argv, runs=3):
+    """Median wall time in ms of running a command to completion"""
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        result = subprocess.run(argv, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        times.append((time.perf_counter() - start) * 1000.0)
+        if result.returncode != 0:
+            raise RuntimeError(f"{' '.join(argv)} exited with {result.returncode}:\n{result.stderr}")
+    return round(statistics.median(times), 1)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile import time and cold versus zygote-forked start of the backend scripts")
+    parser.add_argument("image_path", help="Image to classify in the timed runs")
+    parser.add_argument("--modules", type=str, nargs="+", default=list(zygote.DEFAULT_PRELOAD), help="Modules to profile imports of")
+    parser.add_argument("--top", type=int, default=10, help="Slowest direct imports to list per module")
+    parser.add_argument("--runs", type=int, default=3, help="Timed runs per configuration (the median is reported)")
+    parser.add_argument("--socket", type=str, default=zygote.DEFAULT_SOCKET, help="Socket of a running zygote.py --serve to time against")
+    parser.add_argument("--predict_args", type=str, default="", help="Extra predict.py arguments, e.g. '--backend onnx --model_path model.onnx'")
+    args = parser.parse_args()
+
+    report = {"imports": [import_profile(module, args.top) for module in args.modules]}
+
+    command = ["predict.py", os.path.abspath(args.image_path)] + shlex.split(args.predict_args)
+    report["cold_ms"] = time_command([sys.executable, os.path.join(BACKEND_DIR, command[0])] + command[1:], args.runs)
+    if os.path.exists(args.socket):
+        report["zygote_ms"] = time_command([sys.executable, os.path.join(BACKEND_DIR, "zygote.py"), "--socket", args.socket] + command, args.runs)
+        report["speedup"] = round(report["cold_ms"] / report["zygote_ms"], 1)
+    else:
+        print(f"No zygote server at {args.socket}; start one with zygote.py --serve to compare", file=sys.stderr)
+
+    print(json.dumps(report, indent=2))
@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+from contextlib import contextmanager, nullcontext
+
+# Optional per-stage timing for predict.py, gradcam.py and identify.py.
+#
+# Code marks its stages with `with span("decode"):`. While instrumentation
+# is off (the default) span() returns a shared no-op context manager, so a
+# stage costs one global lookup and an empty with block. Once configure()
+# turns it on, every span is added to a Prometheus histogram and, if the
+# current thread is inside trace(), to that request's breakdown.
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRIC_NAME = "smartplant_stage_seconds"
+
+enabled = False
+component = None
+
+_NOOP = nullcontext()
+_local = threading.local()
+
+class StageHistograms:
+    """
+    Thread-safe Prometheus histograms of stage durations, one series per stage
+
+    Args:
+        buckets (tuple): Upper bounds in seconds; +Inf is added automatically
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # stage -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, stage, seconds):
+        with self._lock:
+            series = self._series.get(stage)
+            if series is None:
+                series = self._series[stage] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    series[i] += 1
+            series[-2] += seconds
+            series[-1] += 1
+
+    def render(self, labels=None):
+        """Returns the histograms in the Prometheus text exposition format"""
+        base = "".join(f'{key}="{value}",' for key, value in (labels or {}).items())
+        lines = [f"# HELP {METRIC_NAME} Time spent in each inference stage",
+                 f"# TYPE {METRIC_NAME} histogram"]
+        with self._lock:
+            for stage, series in sorted(self._series.items()):
+                for bound, count in zip(self.buckets, series):
+                    lines.append(f'{METRIC_NAME}_bucket{{{base}stage="{stage}",le="{bound}"}} {count}')
+                lines.append(f'{METRIC_NAME}_bucket{{{base}stage="{stage}",le="+Inf"}} {series[-1]}')
+                lines.append(f'{METRIC_NAME}_sum{{{base}stage="{stage}"}} {series[-2]:.6f}')
+                lines.append(f'{METRIC_NAME}_count{{{base}stage="{stage}"}} {series[-1]}')
+        return "\n".join(lines) + "\n"
+
+histograms = StageHistograms()
+
+def configure(enable=True, name=None, buckets=None):
+    """
+    Turns stage timing on or off for this process
+
+    Args:
+        enable (bool): Whether span() records anything
+        name (str, optional): Component label for the metrics, e.g. 'predict' or 'identify'
+        buckets (tuple, optional): Histogram bucket bounds in seconds. Resets the histograms
+    """
+    global enabled, component, histograms
+    enabled = enable
+    component = name
+    if buckets is not None:
+        histograms = StageHistograms(buckets)
+
+class _Span:
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter() - self.start
+        histograms.observe(self.name, elapsed)
+        spans = getattr(_local, "spans", None)
+        if spans is not None:
+            spans[self.name] = spans.get(self.name, 0.0) + elapsed * 1000.0
+        return False
+
+def span(name):
+    """Context manager timing one stage; a no-op while instrumentation is disabled"""
+    if not enabled:
+        return _NOOP
+    return _Span(name)
+
+@contextmanager
+def trace():
+    """
+    Collects the spans run on this thread inside the block
+
+    Yields a dict that fills with {stage: milliseconds} (repeated stages are
+    summed) plus "total" when the block exits, or None when disabled.
+    """
+    if not enabled:
+        yield None
+        return
+    previous = getattr(_local, "spans", None)
+    spans = {}
+    _local.spans = spans
+    start = time.perf_counter()
+    try:
+        yield spans
+    finally:
+        spans["total"] = (time.perf_counter() - start) * 1000.0
+        for stage in spans:
+            spans[stage] = round(spans[stage], 3)
+        _local.spans = previous
+
+def render_metrics():
+    """Prometheus text for this process, labelled with the component and pid so workers can be merged"""
+    labels = {"worker": os.getpid()}
+    if component:
+        labels = {"component": component, **labels}
+    return histograms.render(labels)
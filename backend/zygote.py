@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import socket
+import signal
+import argparse
+import tempfile
+
+# Fork server for spawn-per-request use of the backend scripts.
+#
+# A cold `python predict.py image.jpg` spends most of its time importing torch,
+# torchvision/timm and onnxruntime and reading the model before the first
+# forward pass. Started with --serve, this script does that work once: it
+# imports the scripts' modules, preloads the given model artifacts (see
+# backends.preload_backend) and waits on a Unix socket. Every client
+# connection passes its argv, working directory and stdin/stdout/stderr file
+# descriptors; the server forks, the child runs the script as __main__ on the
+# client's descriptors, and the client exits with the child's exit code.
+#
+# The parent never runs inference, so no torch thread pool exists when it
+# forks. The client side only imports the standard library:
+#
+#   python zygote.py --serve --model eager:resnet18_with_class_label_weights_best_acc.tar &
+#   python zygote.py predict.py image.jpg --topk 3
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SOCKET = os.path.join(tempfile.gettempdir(), "plant-backend-zygote.sock")
+
+# Scripts a client may run; anything else is refused so the socket cannot run arbitrary code
+SCRIPTS = ("predict.py", "identify.py", "gradcam.py", "classify_bulk.py", "evaluate_tta.py", "calibration.py")
+DEFAULT_PRELOAD = ("predict", "identify", "gradcam")
+
+# Environment variables forwarded from the client to the forked child
+FORWARDED_ENV = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")
+
+MAX_REQUEST_BYTES = 1 << 20
+
+def preload(modules=DEFAULT_PRELOAD, models=()):
+    """
+    Imports modules and loads model artifacts into this process
+
+    Args:
+        modules (iterable): Module names to import, e.g. 'predict'
+        models (iterable): 'backend:path' specs (path optional) to load with backends.preload_backend
+    Returns:
+        list: Descriptions of the preloaded models
+    """
+    import importlib
+
+    for module in modules:
+        importlib.import_module(module)
+    import backends
+
+    loaded = []
+    for spec in models:
+        name, _, path = spec.partition(":")
+        loaded.append(backends.preload_backend(name, path or None).describe())
+    return loaded
+
+def _read_request(conn):
+    """Reads one JSON request line and the three file descriptors sent with it"""
+    data, fds, _, _ = socket.recv_fds(conn, 65536, 3)
+    while not data.endswith(b"\n"):
+        if len(data) > MAX_REQUEST_BYTES:
+            raise ValueError("Request too large")
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    if len(fds) != 3:
+        for fd in fds:
+            os.close(fd)
+        raise ValueError("Expected stdin, stdout and stderr descriptors")
+    return json.loads(data), fds
+
+def _exit_code(error):
+    """Maps a SystemExit to a process exit code the way the interpreter does"""
+    if error.code is None:
+        return 0
+    if isinstance(error.code, int):
+        return error.code
+    print(error.code, file=sys.stderr)
+    return 1
+
+def _run_child(request, fds, close_fds):
+    """Runs a script as __main__ on the client's descriptors; never returns"""
+    import runpy
+    import traceback
+
+    code = 1
+    try:
+        signal.set_wakeup_fd(-1)
+        for signum in (signal.SIGCHLD, signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_DFL)
+        for fd in close_fds:
+            os.close(fd)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+            os.close(fd)
+
+        os.chdir(request["cwd"])
+        os.environ.update({k: v for k, v in request.get("env", {}).items() if k in FORWARDED_ENV})
+        sys.argv = list(request["argv"])
+        try:
+            runpy.run_path(os.path.join(BACKEND_DIR, sys.argv[0]), run_name="__main__")
+            code = 0
+        except SystemExit as e:
+            code = _exit_code(e)
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(code)
+
+def serve(socket_path=DEFAULT_SOCKET, modules=DEFAULT_PRELOAD, models=()):
+    """
+    Preloads, then forks one child per client connection until interrupted
+
+    Args:
+        socket_path (str): Unix socket to listen on (replaced if it exists)
+        modules (iterable): Module names to import before forking
+        models (iterable): 'backend:path' specs to load before forking
+    """
+    import selectors
+
+    loaded = preload(modules, models)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the owner may connect: a client gets to run the scripts with our files and models
+    umask = os.umask(0o177)
+    try:
+        listener.bind(socket_path)
+    finally:
+        os.umask(umask)
+    listener.listen(64)
+
+    # SIGCHLD wakes the selector through a pipe, so children are reaped as soon as they exit
+    wakeup_read, wakeup_write = os.pipe()
+    os.set_blocking(wakeup_read, False)
+    os.set_blocking(wakeup_write, False)
+    signal.set_wakeup_fd(wakeup_write)
+    signal.signal(signal.SIGCHLD, lambda signum, frame: None)
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
+
+    selector = selectors.DefaultSelector()
+    selector.register(listener, selectors.EVENT_READ)
+    selector.register(wakeup_read, selectors.EVENT_READ)
+    children = {}
+
+    def reap():
+        while children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            conn = children.pop(pid, None)
+            if conn is None:
+                continue
+            code = os.waitstatus_to_exitcode(status)
+            try:
+                conn.sendall((json.dumps({"exit": code if code >= 0 else 128 - code}) + "\n").encode())
+            except OSError:
+                pass
+            conn.close()
+
+    def handle(conn):
+        try:
+            request, fds = _read_request(conn)
+        except (OSError, ValueError) as e:
+            conn.close()
+            print(f"Rejected zygote client: {e}", file=sys.stderr)
+            return
+        argv = request.get("argv") or [""]
+        if argv[0] not in SCRIPTS:
+            os.write(fds[2], f"Unknown script '{argv[0]}', choose from {', '.join(SCRIPTS)}\n".encode())
+            for fd in fds:
+                os.close(fd)
+            conn.sendall((json.dumps({"exit": 2}) + "\n").encode())
+            conn.close()
+            return
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            _run_child(request, fds, [listener.fileno(), wakeup_read, wakeup_write, conn.fileno()])
+        for fd in fds:
+            os.close(fd)
+        children[pid] = conn
+
+    print(json.dumps({"status": "ready", "socket": socket_path, "pid": os.getpid(), "models": loaded}), flush=True)
+    try:
+        while True:
+            for key, _ in selector.select():
+                if key.fileobj is listener:
+                    conn, _ = listener.accept()
+                    handle(conn)
+                else:
+                    try:
+                        while os.read(wakeup_read, 512):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    reap()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+def run(argv, socket_path=DEFAULT_SOCKET):
+    """Runs a backend script in a child forked from the server and returns its exit code"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(socket_path)
+    request = {"argv": list(argv), "cwd": os.getcwd(),
+               "env": {k: os.environ[k] for k in FORWARDED_ENV if k in os.environ}}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    socket.send_fds(conn, [(json.dumps(request) + "\n").encode()], [0, 1, 2])
+
+    reply = b""
+    while True:
+        chunk = conn.recv(4096)
+        if not chunk:
+            break
+        reply += chunk
+    conn.close()
+    if not reply:
+        print("Zygote server closed the connection without an exit code", file=sys.stderr)
+        return 1
+    return json.loads(reply)["exit"]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fork server that keeps the backend scripts' imports and models warm")
+    parser.add_argument("--serve", action="store_true", help="Start the server instead of running a script through it")
+    parser.add_argument("--socket", type=str, default=DEFAULT_SOCKET, help="Unix socket path")
+    parser.add_argument("--preload", type=str, nargs="*", default=list(DEFAULT_PRELOAD), help="Modules to import in the server")
+    parser.add_argument("--model", type=str, action="append", default=[], help="Artifact to load in the server as backend:path, e.g. eager:model.tar (repeatable)")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="Script and arguments to run, e.g. predict.py image.jpg --topk 3")
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args.socket, args.preload, args.model)
+    elif not args.command:
+        parser.error(f"Give a script to run ({', '.join(SCRIPTS)}) or --serve")
+    else:
+        sys.exit(run(args.command, args.socket))
@@ -0,0 +1,98 @@
+import argparse
+import json
+import os
+import time
+import torch
+from torchvision import datasets
+from PIL import ImageFile
+from finetune import build_transforms
+from image_cache import build_cache, CachedImageFolder
+
+# Measures what the decoded image cache saves per epoch: iterates the train
+# and val loaders exactly as finetune.py builds them, once reading JPEGs with
+# ImageFolder and once from the memory-mapped cache, without running a model,
+# so the numbers are pure data-loading time. The one-off cost of building the
+# cache is reported separately.
+
+def time_epochs(dataset, epochs, batch_size, num_workers, shuffle):
+    """Seconds per full pass over a dataset through a DataLoader"""
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, num_workers=num_workers)
+    times = []
+    for _ in range(epochs):
+        start = time.perf_counter()
+        for _ in loader:
+            pass
+        times.append(time.perf_counter() - start)
+    return times
+
+def benchmark(args, epochs=2, progress_callback=None):
+    """
+    Times data loading with and without the decoded image cache
+
+    Args:
+        args (dict): finetune.py settings; data_dir and cache_dir are required
+        epochs (int): Passes over each split per configuration
+        progress_callback (function, optional): A function to call with progress updates
+    Returns:
+        dict: Per-split seconds per epoch for both paths, the speedup and the cache build time
+    """
+    def log(message):
+        if progress_callback:
+            progress_callback(message)
+
+    ImageFile.LOAD_TRUNCATED_IMAGES = args.get('load_truncated_images', True)
+    data_dir, cache_dir = args['data_dir'], args['cache_dir']
+    input_size = args.get('input_size', 224)
+    resize_size = args.get('resize_size') or int(input_size / 224 * 256)
+    batch_size = args.get('batch_size', 32)
+    num_workers = args.get('num_workers', 0)
+    splits = [args.get('train_dir_name', 'train'), args.get('val_dir_name', 'val')]
+
+    train_transform, eval_transform, _ = build_transforms(args)
+
+    report = {"epochs": epochs, "batch_size": batch_size, "num_workers": num_workers, "resize_size": resize_size, "splits": {}}
+    for split, transform in zip(splits, (train_transform, eval_transform)):
+        root = os.path.join(data_dir, split)
+        shuffle = split == splits[0]
+
+        log(f"Building the cache for {root}")
+        start = time.perf_counter()
+        index_path = build_cache(root, cache_dir, resize_size, num_workers, log)
+        build_seconds = time.perf_counter() - start
+
+        log(f"Timing ImageFolder on {root}")
+        folder_times = time_epochs(datasets.ImageFolder(root, transform), epochs, batch_size, num_workers, shuffle)
+        log(f"Timing the cache on {root}")
+        cached_times = time_epochs(CachedImageFolder(index_path, transform), epochs, batch_size, num_workers, shuffle)
+
+        folder_epoch, cached_epoch = min(folder_times), min(cached_times)
+        report["splits"][split] = {
+            "images": len(CachedImageFolder(index_path)),
+            "cache_build_s": round(build_seconds, 3),
+            "image_folder_epoch_s": round(folder_epoch, 3),
+            "cached_epoch_s": round(cached_epoch, 3),
+            "speedup": round(folder_epoch / cached_epoch, 2),
+            "saved_per_epoch_s": round(folder_epoch - cached_epoch, 3),
+        }
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare data-loading time per epoch with and without the decoded image cache')
+    parser.add_argument('--data_dir', type=str, required=True, help='Path to the dataset directory')
+    parser.add_argument('--cache_dir', type=str, required=True, help='Directory for the decoded image cache')
+    parser.add_argument('--epochs', type=int, default=2, help='Passes over each split per configuration (the fastest is reported)')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size for the data loaders')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of data loader workers')
+    parser.add_argument('--input_size', type=int, default=224, help='Input image size')
+    parser.add_argument('--resize_size', type=int, default=None, help='Size to resize images to before cropping (defaults to 256 for 224 input)')
+    parser.add_argument('--train_dir_name', type=str, default='train', help='Name of the training directory')
+    parser.add_argument('--val_dir_name', type=str, default='val', help='Name of the validation directory')
+    parser.add_argument('--output', type=str, default=None, help='Also write the report to this JSON file')
+    args = parser.parse_args()
+
+    settings = vars(args)
+    report = benchmark(settings, settings.pop('epochs'), print)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    print(json.dumps(report, indent=2))
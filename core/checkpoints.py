@@ -0,0 +1,106 @@
+import os
+import random
+import threading
+import numpy as np
+import torch
+
+# Resumable training state for finetune.py.
+#
+# A training checkpoint holds everything needed to continue a run exactly:
+# model, optimizer and GradScaler state, the epoch and number of training
+# batches done in it, early-stopping bookkeeping, the running metrics of a
+# partly trained epoch and the Python/NumPy/torch RNG states. The RNG state
+# at the start of the epoch is stored too: resuming mid-epoch restores it,
+# replays the data loader past the batches already trained on (so shuffling
+# and augmentation draw the same numbers) and then restores the state saved
+# after the last batch.
+#
+# These files are separate from the serving checkpoint written to save_path,
+# which stays in the format the backend loads.
+
+CHECKPOINT_VERSION = 1
+
+def capture_rng_state():
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+def restore_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+def snapshot(value):
+    """Deep copy of nested dicts/lists/tuples with every tensor cloned to CPU, so training can keep updating the originals"""
+    if isinstance(value, torch.Tensor):
+        return value.detach().to('cpu', copy=True)
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return value
+
+def save_atomic(state, path):
+    """Writes to a temporary file, flushes it to disk and renames it over path"""
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        torch.save(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+def load_checkpoint(path):
+    """Loads a training checkpoint written by AsyncCheckpointWriter"""
+    # The RNG states are plain Python/NumPy objects, which the weights-only unpickler rejects
+    state = torch.load(path, map_location='cpu', weights_only=False)
+    if state.get('version') != CHECKPOINT_VERSION:
+        raise ValueError(f"{path} is not a training checkpoint written by this version of finetune.py")
+    return state
+
+class AsyncCheckpointWriter:
+    """
+    Saves training checkpoints on a background thread
+
+    save() snapshots the state to CPU memory on the calling thread, which is
+    a quick copy, and leaves serialization and disk I/O to the writer thread.
+    At most one write is in flight: a save() while the previous one is still
+    writing waits for it, so memory stays bounded. A failed write is raised
+    from the next save() or close().
+    """
+
+    def __init__(self):
+        self._thread = None
+        self._error = None
+
+    def _write(self, state, path, on_done):
+        try:
+            save_atomic(state, path)
+            if on_done:
+                on_done(path)
+        except BaseException as e:
+            self._error = e
+
+    def wait(self):
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise RuntimeError(f"Writing a training checkpoint failed: {error}") from error
+
+    def save(self, state, path, on_done=None):
+        """Queues a checkpoint write; on_done(path) is called from the writer thread once it is on disk"""
+        state = snapshot(state)
+        self.wait()
+        self._thread = threading.Thread(target=self._write, args=(state, path, on_done), name='checkpoint-writer', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.wait()
@@ -0,0 +1,53 @@
+import os
+import torch
+import torch.distributed as dist
+
+# Distributed data-parallel helpers for finetune.py.
+#
+# Launch one process per core group (or per GPU) on every machine with
+# torchrun, which sets RANK, WORLD_SIZE, LOCAL_RANK and the rendezvous
+# address in the environment, e.g. on each of two machines:
+#
+#   torchrun --nnodes 2 --nproc_per_node 4 --rdzv_backend c10d \
+#       --rdzv_endpoint host0:29500 finetune.py --data_dir ... --save_path ...
+#
+# The default gloo backend runs on CPU-only Linux; use nccl for GPUs.
+
+def launched_by_torchrun():
+    return int(os.environ.get("WORLD_SIZE", "1")) > 1
+
+def init(backend="gloo"):
+    """
+    Joins the process group described by the torchrun environment, unless already joined
+
+    Returns:
+        tuple: (rank, world_size, local_rank, initialized_here)
+    """
+    initialized_here = False
+    if not dist.is_initialized():
+        dist.init_process_group(backend=backend)
+        initialized_here = True
+    local_rank = int(os.environ.get("LOCAL_RANK", dist.get_rank()))
+    return dist.get_rank(), dist.get_world_size(), local_rank, initialized_here
+
+def all_reduce_sum(values, device):
+    """Sums a list of numbers over all ranks"""
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
+
+def eval_indices(size, rank, world_size):
+    """This rank's share of an evaluation set; unlike DistributedSampler it never repeats samples to even out ranks"""
+    return list(range(rank, size, world_size))
+
+def all_gather_objects(value):
+    """Every rank's value, in rank order"""
+    values = [None] * dist.get_world_size()
+    dist.all_gather_object(values, value)
+    return values
+
+def broadcast_object(value, src=0):
+    """Rank src's value on every rank, for decisions that must be taken in step"""
+    values = [value]
+    dist.broadcast_object_list(values, src=src)
+    return values[0]
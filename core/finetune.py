@@ -1,6 +1,8 @@
 import argparse
+import contextlib
 import copy
 import os
+import time
 import torch
 import timm
 import torch.nn as nn
@@ -8,56 +10,27 @@ import torch.optim as optim
 from torchvision import datasets, transforms
 from timm.loss import LabelSmoothingCrossEntropy
 from PIL import ImageFile
-
-def main(args, progress_callback=None):
-    """Main function to run the fine-tuning script"""
-    
-    def log(message):
-        if progress_callback:
-            progress_callback(message)
-        else:
-            print(message)
-
-    log("Starting fine-tuning")
-
-    load_truncated_images = args.get('load_truncated_images', True)
-    ImageFile.LOAD_TRUNCATED_IMAGES = load_truncated_images
-    
-    cancel_event = args.get('cancel_event')
-    data_dir = args['data_dir']
-    model_name = args.get('model_name', 'resnet18')
-    num_epochs = args.get('num_epochs', 25)
-    batch_size = args.get('batch_size', 32)
-    learning_rate = args.get('learning_rate', 0.001)
-    dropout_rate = args.get('dropout_rate', 0.0)
-    optimiser_name = args.get('optimiser', 'adamw')
-    sgd_momentum = args.get('sgd_momentum', 0.9)
-    adam_beta1 = args.get('adam_beta1', 0.9)
-    adam_beta2 = args.get('adam_beta2', 0.999)
-    adam_eps = args.get('adam_eps', 1e-8)
-    loss_function = args.get('loss_function', 'cross_entropy')
-    label_smoothing_factor = args.get('label_smoothing_factor', 0.1)
-    weight_decay = args.get('weight_decay', 0.0)
-    load_path = args.get('load_path')
-    save_path = args.get('save_path')
-    early_stopping_patience = args.get('early_stopping_patience', 0)
-    early_stopping_min_delta = args.get('early_stopping_min_delta', 0.0)
-    early_stopping_metric = args.get('early_stopping_metric', 'loss')
-    mixed_precision = args.get('mixed_precision', False)
+from image_cache import cached_image_folder
+from shards import has_shards
+from shard_dataset import ShardDataset
+from checkpoints import AsyncCheckpointWriter, capture_rng_state, restore_rng_state, load_checkpoint, CHECKPOINT_VERSION
+import ddp
+
+def build_transforms(args):
+    """
+    Builds the training and evaluation transforms from the fine-tuning settings
+
+    Args:
+        args (dict): The settings passed to main()
+    Returns:
+        tuple: (train_transform, eval_transform, (norm_mean, norm_std)), the normalization being (None, None) when disabled
+    """
     use_imagenet_norm = args.get('use_imagenet_norm', True)
     norm_mean_str = args.get('norm_mean', '0.485, 0.456, 0.406')
     norm_std_str = args.get('norm_std', '0.229, 0.224, 0.225')
     input_size = args.get('input_size', 224)
-    resize_size = args.get('resize_size', int(input_size / 224 * 256))
-    num_workers = args.get('num_workers', 0)
-    train_from_scratch = args.get('train_from_scratch', False)
-    strict_load = args.get('strict_load', False)
-    log_frequency = args.get('log_frequency', 10)
-    train_dir_name = args.get('train_dir_name', 'train')
-    val_dir_name = args.get('val_dir_name', 'val')
-    test_dir_name = args.get('test_dir_name', 'test')
-    device_str = args.get('device', 'auto')
-    
+    resize_size = args.get('resize_size') or int(input_size / 224 * 256)
+
     # Get individual augmentation flags
     aug_random_resized_crop = args.get('aug_random_resized_crop', True)
     aug_horizontal_flip = args.get('aug_horizontal_flip', True)
@@ -72,15 +45,7 @@ def main(args, progress_callback=None):
     aug_crop_scale_max = args.get('aug_crop_scale_max', 1.0)
     aug_crop_ratio_min = args.get('aug_crop_ratio_min', 0.75)
     aug_crop_ratio_max = args.get('aug_crop_ratio_max', 1.33)
-    pin_memory = args.get('pin_memory', False)
-    
-    seed = args.get('seed')
-
-    if seed is not None:
-        torch.manual_seed(seed)
-        log(f"Using random seed: {seed}")
 
-    # 1. Set up data transforms
     train_transform_list = []
     if aug_random_resized_crop:
         train_transform_list.append(transforms.RandomResizedCrop(input_size, scale=(aug_crop_scale_min, aug_crop_scale_max), ratio=(aug_crop_ratio_min, aug_crop_ratio_max)))
@@ -118,31 +83,175 @@ def main(args, progress_callback=None):
         normalizer = transforms.Normalize(mean, std)
         train_transform_list.append(normalizer)
         val_transform_list.append(normalizer)
+    else:
+        mean = std = None
+
+    return transforms.Compose(train_transform_list), transforms.Compose(val_transform_list), (mean, std)
+
+def build_optimizer(params, args):
+    """
+    Creates the optimizer chosen in the fine-tuning settings
+
+    Args:
+        params (iterable): The parameters to optimize
+        args (dict): The settings passed to main()
+    Returns:
+        torch.optim.Optimizer: Adam, AdamW or SGD
+    """
+    optimiser_name = args.get('optimiser', 'adamw')
+    learning_rate = args.get('learning_rate', 0.001)
+    weight_decay = args.get('weight_decay', 0.0)
+    betas = (args.get('adam_beta1', 0.9), args.get('adam_beta2', 0.999))
+    adam_eps = args.get('adam_eps', 1e-8)
+
+    if optimiser_name == 'adam':
+        return optim.Adam(params, lr=learning_rate, betas=betas, eps=adam_eps, weight_decay=weight_decay)
+    elif optimiser_name == 'adamw':
+        return optim.AdamW(params, lr=learning_rate, betas=betas, eps=adam_eps, weight_decay=weight_decay)
+    elif optimiser_name == 'sgd':
+        return optim.SGD(params, lr=learning_rate, momentum=args.get('sgd_momentum', 0.9), weight_decay=weight_decay)
+    raise ValueError(f"Unsupported optimiser: {optimiser_name}")
+
+def save_checkpoint(path, model, class_to_idx, model_name, input_size, mean=None, std=None):
+    """
+    Saves a trained model in the checkpoint format the backend serving scripts load
+
+    Args:
+        path (str): Where to write the checkpoint
+        model (nn.Module): The timm model
+        class_to_idx (dict): Label index of every class name
+        model_name (str): timm architecture name
+        input_size (int): Side of the square model input
+        mean (list, optional): Normalization mean, None when images are not normalized
+        std (list, optional): Normalization standard deviation, None when images are not normalized
+    """
+    # Record the architecture, class mapping and preprocessing next to the
+    # weights so the backend serving scripts can load any timm model as is
+    checkpoint = {
+        'model': model.state_dict(),
+        'class_to_idx': class_to_idx,
+        'model_name': model_name,
+        'framework': 'timm',
+        'input_size': input_size,
+        'norm_mean': mean if mean is not None else [0.0, 0.0, 0.0],
+        'norm_std': std if std is not None else [1.0, 1.0, 1.0],
+    }
+    # Write to a temporary file first so servers hot-swapping the checkpoint never read a partial file
+    tmp_path = f"{path}.tmp"
+    torch.save(checkpoint, tmp_path)
+    os.replace(tmp_path, path)
+
+def main(args, progress_callback=None):
+    """Main function to run the fine-tuning script"""
+
+    # Under torchrun every process runs main(); they train one model data-parallel
+    distributed = args.get('distributed', ddp.launched_by_torchrun())
+    rank, world_size, local_rank, owns_process_group = 0, 1, 0, False
+    if distributed:
+        rank, world_size, local_rank, owns_process_group = ddp.init(args.get('dist_backend', 'gloo'))
+    log_all_ranks = args.get('log_all_ranks', False)
+
+    def log(message):
+        if rank != 0 and not log_all_ranks:
+            return
+        if world_size > 1:
+            message = f"[rank {rank}/{world_size}] {message}"
+        if progress_callback:
+            progress_callback(message)
+        else:
+            print(message)
+
+    log("Starting fine-tuning")
+
+    load_truncated_images = args.get('load_truncated_images', True)
+    ImageFile.LOAD_TRUNCATED_IMAGES = load_truncated_images
+    
+    cancel_event = args.get('cancel_event')
+    data_dir = args['data_dir']
+    model_name = args.get('model_name', 'resnet18')
+    num_epochs = args.get('num_epochs', 25)
+    batch_size = args.get('batch_size', 32)
+    dropout_rate = args.get('dropout_rate', 0.0)
+    loss_function = args.get('loss_function', 'cross_entropy')
+    label_smoothing_factor = args.get('label_smoothing_factor', 0.1)
+    load_path = args.get('load_path')
+    save_path = args.get('save_path')
+    early_stopping_patience = args.get('early_stopping_patience', 0)
+    early_stopping_min_delta = args.get('early_stopping_min_delta', 0.0)
+    early_stopping_metric = args.get('early_stopping_metric', 'loss')
+    mixed_precision = args.get('mixed_precision', False)
+    input_size = args.get('input_size', 224)
+    resize_size = args.get('resize_size') or int(input_size / 224 * 256)
+    num_workers = args.get('num_workers', 0)
+    cache_dir = args.get('cache_dir')
+    shuffle_buffer = args.get('shuffle_buffer', 1000)
+    train_from_scratch = args.get('train_from_scratch', False)
+    strict_load = args.get('strict_load', False)
+    log_frequency = args.get('log_frequency', 10)
+    train_dir_name = args.get('train_dir_name', 'train')
+    val_dir_name = args.get('val_dir_name', 'val')
+    test_dir_name = args.get('test_dir_name', 'test')
+    device_str = args.get('device', 'auto')
+    pin_memory = args.get('pin_memory', False)
+    checkpoint_path = args.get('checkpoint_path')
+    checkpoint_every_epochs = args.get('checkpoint_every_epochs', 1)
+    checkpoint_every_minutes = args.get('checkpoint_every_minutes', 0)
+    resume_path = args.get('resume')
 
+    seed = args.get('seed')
+
+    if seed is not None:
+        torch.manual_seed(seed)
+        log(f"Using random seed: {seed}")
+
+    # 1. Set up data transforms
+    train_transform, eval_transform, (mean, std) = build_transforms(args)
     data_transforms = {
-        train_dir_name: transforms.Compose(train_transform_list),
-        val_dir_name: transforms.Compose(val_transform_list),
-        test_dir_name: transforms.Compose(val_transform_list),
+        train_dir_name: train_transform,
+        val_dir_name: eval_transform,
+        test_dir_name: eval_transform,
     }
 
-    # 2. Create ImageFolder datasets
+    # 2. Create datasets: tar shards written by process_dataset.py are streamed, class folders use ImageFolder
     phases = [train_dir_name, val_dir_name]
     if os.path.isdir(os.path.join(data_dir, test_dir_name)):
         phases.append(test_dir_name)
+
+    def create_dataset(phase):
+        split_dir = os.path.join(data_dir, phase)
+        if has_shards(split_dir):
+            return ShardDataset(split_dir, data_transforms[phase], shuffle_buffer=shuffle_buffer if phase == train_dir_name else 0, seed=seed or 0)
+        if cache_dir:
+            # One process per machine decodes the split; the others wait, then map the finished cache
+            if world_size > 1 and local_rank != 0:
+                torch.distributed.barrier()
+            dataset = cached_image_folder(split_dir, cache_dir, resize_size, data_transforms[phase], num_workers, log)
+            if world_size > 1 and local_rank == 0:
+                torch.distributed.barrier()
+            return dataset
+        return datasets.ImageFolder(split_dir, data_transforms[phase])
+
+    image_datasets = {x: create_dataset(x) for x in phases}
     
-    image_datasets = {x: datasets.ImageFolder(os.path.join(data_dir, x), data_transforms[x])
-                      for x in phases}
-    
-    # 3. Create DataLoaders
-    dataloaders = {x: torch.utils.data.DataLoader(image_datasets[x], batch_size=batch_size, shuffle=(x == train_dir_name), num_workers=num_workers, pin_memory=pin_memory)
-                   for x in phases}
+    # 3. Create DataLoaders (streamed datasets shuffle and split themselves between ranks)
+    def create_dataloader(phase):
+        dataset = image_datasets[phase]
+        sampler = None
+        if world_size > 1 and not isinstance(dataset, ShardDataset):
+            if phase == train_dir_name:
+                sampler = torch.utils.data.DistributedSampler(dataset, num_replicas=world_size, rank=rank, shuffle=True, seed=seed or 0)
+            else:
+                sampler = ddp.eval_indices(len(dataset), rank, world_size)
+        shuffle = phase == train_dir_name and sampler is None and not isinstance(dataset, ShardDataset)
+        return torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=shuffle, sampler=sampler, num_workers=num_workers, pin_memory=pin_memory)
+
+    dataloaders = {x: create_dataloader(x) for x in phases}
     
-    dataset_sizes = {x: len(image_datasets[x]) for x in phases}
     class_names = image_datasets[train_dir_name].classes
     num_classes = len(class_names)
 
     if device_str == 'auto':
-        device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        device = torch.device(f"cuda:{local_rank}" if torch.cuda.is_available() else "cpu")
     else:
         device = torch.device(device_str)
     log(f"Using device: {device}")
@@ -159,9 +268,18 @@ def main(args, progress_callback=None):
     # 5. If a load_path is provided, load the model state
     if load_path:
         # Using strict=False allows loading weights from a checkpoint with a different classifier.
-        model.load_state_dict(torch.load(load_path, map_location=device), strict=strict_load)
+        # Accepts both a bare state dict and a checkpoint saved by this script.
+        state = torch.load(load_path, map_location=device)
+        if 'model' in state and 'class_to_idx' in state:
+            state = state['model']
+        model.load_state_dict(state, strict=strict_load)
 
     model = model.to(device)
+    # DDP averages gradients across ranks in backward; evaluation and saving use the bare model
+    model_without_ddp = model
+    if world_size > 1:
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[device.index] if device.type == 'cuda' else None)
+        log(f"Training data-parallel on {world_size} processes with the {torch.distributed.get_backend()} backend")
 
     # 7. Define loss function and optimizer
     if loss_function == 'cross_entropy':
@@ -171,86 +289,196 @@ def main(args, progress_callback=None):
     else:
         raise ValueError(f"Unsupported loss function: {loss_function}")
     
-    if optimiser_name == 'adam':
-        optimizer = optim.Adam(model.parameters(), lr=learning_rate, betas=(adam_beta1, adam_beta2), eps=adam_eps, weight_decay=weight_decay)
-    elif optimiser_name == 'adamw':
-        optimizer = optim.AdamW(model.parameters(), lr=learning_rate, betas=(adam_beta1, adam_beta2), eps=adam_eps, weight_decay=weight_decay)
-    elif optimiser_name == 'sgd':
-        optimizer = optim.SGD(model.parameters(), lr=learning_rate, momentum=sgd_momentum, weight_decay=weight_decay)
-    else:
-        raise ValueError(f"Unsupported optimiser: {optimiser_name}")
+    optimizer = build_optimizer(model.parameters(), args)
 
     # 8. Implement the training loop
-    best_model_state = copy.deepcopy(model.state_dict())
+    best_model_state = copy.deepcopy(model_without_ddp.state_dict())
     final_epoch_val_acc = 0.0
     best_val_loss = float('inf')
     best_val_acc = 0.0
     epochs_no_improve = 0
 
-    for epoch in range(num_epochs):
+    # Training checkpoints (see checkpoints.py) are written at epoch ends and, in a single process,
+    # also mid-epoch on a timer or when cancelled; DDP ranks only agree on a state at epoch ends
+    writer = AsyncCheckpointWriter() if checkpoint_path else None
+    mid_epoch_checkpoints = writer is not None and world_size == 1
+    last_checkpoint_time = time.monotonic()
+
+    def save_training_checkpoint(epoch, batch, train_done, running, epoch_rng, rng):
+        """Saves the state after `batch` training batches of `epoch`, or after its whole training phase when train_done"""
+        nonlocal last_checkpoint_time
+        last_checkpoint_time = time.monotonic()
+        rng_states = ddp.all_gather_objects(rng) if world_size > 1 else [rng]
+        if rank != 0:
+            return
+        state = {
+            'version': CHECKPOINT_VERSION,
+            'model_name': model_name,
+            'class_to_idx': image_datasets[train_dir_name].class_to_idx,
+            'world_size': world_size,
+            'epoch': epoch,
+            'batch': batch,
+            'train_done': train_done,
+            'running': running,
+            'model': model_without_ddp.state_dict(),
+            'optimizer': optimizer.state_dict(),
+            'scaler': scaler.state_dict(),
+            'best_model_state': best_model_state if early_stopping_patience > 0 else None,
+            'best_val_loss': best_val_loss,
+            'best_val_acc': best_val_acc,
+            'epochs_no_improve': epochs_no_improve,
+            'final_epoch_val_acc': final_epoch_val_acc,
+            # Per-rank RNG states now, and (mid-epoch only) when the epoch's training loader was created
+            'rng': rng_states,
+            'epoch_rng': epoch_rng,
+        }
+        position = f"epoch {epoch}, batch {batch}" if batch or train_done else f"start of epoch {epoch}"
+        writer.save(state, checkpoint_path, on_done=lambda path: log(f"Saved training checkpoint ({position}) to {path}"))
+
+    def cancelled():
+        log("Fine-tuning cancelled")
+        if mid_epoch_checkpoints:
+            save_training_checkpoint(*resume_point)
+        if writer:
+            writer.close()
+        return {'val_acc': final_epoch_val_acc, 'test_acc': None}
+
+    start_epoch, start_batch, resume_state, resumes_mid_epoch = 0, 0, None, False
+    if resume_path:
+        resume_state = load_checkpoint(resume_path)
+        if resume_state['model_name'] != model_name or resume_state['class_to_idx'] != image_datasets[train_dir_name].class_to_idx:
+            raise ValueError(f"{resume_path} was written for a different model or dataset")
+        start_epoch, start_batch = resume_state['epoch'], resume_state['batch']
+        if (start_batch or resume_state['train_done']) and resume_state['world_size'] != world_size:
+            raise ValueError(f"{resume_path} was saved mid-epoch by {resume_state['world_size']} process(es) and can only be resumed with as many")
+        if resume_state['world_size'] != world_size:
+            log(f"{resume_path} was written by {resume_state['world_size']} process(es), resuming with {world_size}: data order will differ from an uninterrupted run")
+        model_without_ddp.load_state_dict(resume_state['model'])
+        optimizer.load_state_dict(resume_state['optimizer'])
+        if resume_state['scaler']:
+            scaler.load_state_dict(resume_state['scaler'])
+        if resume_state['best_model_state'] is not None:
+            best_model_state = resume_state['best_model_state']
+        best_val_loss = resume_state['best_val_loss']
+        best_val_acc = resume_state['best_val_acc']
+        epochs_no_improve = resume_state['epochs_no_improve']
+        final_epoch_val_acc = resume_state['final_epoch_val_acc']
+        resumes_mid_epoch = start_batch > 0 or resume_state['train_done']
+        if not resumes_mid_epoch:
+            restore_rng_state(resume_state['rng'][rank % len(resume_state['rng'])])
+        log(f"Resuming from {resume_path} at epoch {start_epoch}" + (f", batch {start_batch}" if resumes_mid_epoch else ""))
+
+    # The last consistent state, written if training is cancelled: arguments of save_training_checkpoint()
+    if resumes_mid_epoch:
+        resume_point = (start_epoch, start_batch, resume_state['train_done'], resume_state['running'], resume_state['epoch_rng'], resume_state['rng'][0])
+    else:
+        resume_point = (start_epoch, 0, False, (0.0, 0, 0), None, capture_rng_state())
+
+    for epoch in range(start_epoch, num_epochs):
         if cancel_event and cancel_event.is_set():
-            log("Fine-tuning cancelled")
-            return {'val_acc': final_epoch_val_acc, 'test_acc': None}
+            return cancelled()
         log(f'Epoch {epoch}/{num_epochs - 1}')
         log('-' * 10)
 
         for phase in [train_dir_name, val_dir_name]:
-            if phase == train_dir_name:
+            training = phase == train_dir_name
+            if training:
                 model.train()
+                net = model
             else:
                 model.eval()
+                net = model_without_ddp
 
             running_loss = 0.0
             running_corrects = 0
-
+            running_samples = 0
+            if isinstance(image_datasets[phase], ShardDataset):
+                image_datasets[phase].set_epoch(epoch)
+            if isinstance(dataloaders[phase].sampler, torch.utils.data.DistributedSampler):
+                dataloaders[phase].sampler.set_epoch(epoch)
+
+            resuming = training and resumes_mid_epoch and epoch == start_epoch
+            if resuming:
+                running_loss, running_corrects, running_samples = resume_state['running']
+                restore_rng_state(resume_state['epoch_rng'])
+            if training and mid_epoch_checkpoints:
+                # Shuffling and worker seeds are drawn from the RNG when the loader's iterator is created
+                epoch_rng = capture_rng_state()
+
+            # Ranks streaming shards can get different numbers of batches; join() keeps the gradient
+            # all-reduce of the ranks still training from waiting on the ones that ran out
+            uneven_inputs = model.join() if training and world_size > 1 else contextlib.nullcontext()
             num_batches = len(dataloaders[phase])
-            for i, (inputs, labels) in enumerate(dataloaders[phase]):
-                if cancel_event and cancel_event.is_set():
-                    log("Fine-tuning cancelled")
-                    return {'val_acc': final_epoch_val_acc, 'test_acc': None}
-                inputs = inputs.to(device)
-                labels = labels.to(device)
-
-                optimizer.zero_grad()
-
-                with torch.set_grad_enabled(phase == 'train'):
-                    with torch.cuda.amp.autocast(enabled=use_amp):
-                        outputs = model(inputs)
-                        _, preds = torch.max(outputs, 1)
-                        loss = criterion(outputs, labels)
-
-                    if phase == 'train':
-                        scaler.scale(loss).backward()
-                        scaler.step(optimizer)
-                        scaler.update()
-
-                if phase == 'train' and log_frequency > 0:
-                    log_interval = num_batches // log_frequency
-                    if log_interval > 0 and (i + 1) % log_interval == 0:
-                        log(f'Processing batch {i+1}/{num_batches}')
-
-                running_loss += loss.item() * inputs.size(0)
-                running_corrects += torch.sum(preds == labels.data)
-
-            epoch_loss = running_loss / dataset_sizes[phase]
-            epoch_acc = running_corrects.double() / dataset_sizes[phase]
+            if resuming and resume_state['train_done']:
+                # Cancelled during validation: the training phase is complete, only its metrics are needed
+                restore_rng_state(resume_state['rng'][0])
+                batches = ()
+            else:
+                batches = enumerate(dataloaders[phase])
+            with uneven_inputs:
+                for i, (inputs, labels) in batches:
+                    if resuming and i < start_batch:
+                        # Replay the loader past the batches trained on before the checkpoint, so that
+                        # shuffling and augmentation draw the same numbers, then continue from its RNG state
+                        if i == start_batch - 1:
+                            restore_rng_state(resume_state['rng'][0])
+                        continue
+                    if cancel_event and cancel_event.is_set():
+                        return cancelled()
+                    inputs = inputs.to(device)
+                    labels = labels.to(device)
+
+                    optimizer.zero_grad()
+
+                    with torch.set_grad_enabled(training):
+                        with torch.cuda.amp.autocast(enabled=use_amp):
+                            outputs = net(inputs)
+                            _, preds = torch.max(outputs, 1)
+                            loss = criterion(outputs, labels)
+
+                        if training:
+                            scaler.scale(loss).backward()
+                            scaler.step(optimizer)
+                            scaler.update()
+
+                    if training and log_frequency > 0:
+                        log_interval = num_batches // log_frequency
+                        if log_interval > 0 and (i + 1) % log_interval == 0:
+                            log(f'Processing batch {i+1}/{num_batches}')
+
+                    running_loss += loss.item() * inputs.size(0)
+                    running_corrects += torch.sum(preds == labels.data).item()
+                    running_samples += inputs.size(0)
+
+                    if training and mid_epoch_checkpoints:
+                        resume_point = (epoch, i + 1, False, (running_loss, running_corrects, running_samples), epoch_rng, capture_rng_state())
+                        if checkpoint_every_minutes > 0 and time.monotonic() - last_checkpoint_time >= checkpoint_every_minutes * 60:
+                            save_training_checkpoint(*resume_point)
+
+            if training and mid_epoch_checkpoints:
+                resume_point = (epoch, resume_point[1], True, (running_loss, running_corrects, running_samples), epoch_rng, capture_rng_state())
+
+            if world_size > 1:
+                running_loss, running_corrects, running_samples = ddp.all_reduce_sum([running_loss, running_corrects, running_samples], device)
+            epoch_loss = running_loss / running_samples
+            epoch_acc = running_corrects / running_samples
 
             log(f'{phase} Loss: {epoch_loss:.4f} Acc: {epoch_acc:.4f}')
 
             if phase == val_dir_name:
-                final_epoch_val_acc = epoch_acc.item()
+                final_epoch_val_acc = epoch_acc
                 if early_stopping_patience > 0:
                     if early_stopping_metric == 'loss':
                         if epoch_loss < best_val_loss - early_stopping_min_delta:
                             best_val_loss = epoch_loss
-                            best_model_state = copy.deepcopy(model.state_dict())
+                            best_model_state = copy.deepcopy(model_without_ddp.state_dict())
                             epochs_no_improve = 0
                         else:
                             epochs_no_improve += 1
                     elif early_stopping_metric == 'accuracy':
                         if epoch_acc > best_val_acc + early_stopping_min_delta:
-                            best_val_acc = epoch_acc.item()
-                            best_model_state = copy.deepcopy(model.state_dict())
+                            best_val_acc = epoch_acc
+                            best_model_state = copy.deepcopy(model_without_ddp.state_dict())
                             epochs_no_improve = 0
                         else:
                             epochs_no_improve += 1
@@ -259,42 +487,60 @@ def main(args, progress_callback=None):
                         log(f"Early stopping triggered after {epochs_no_improve} epochs with no improvement.")
                         break
         else:
+            resume_point = (epoch + 1, 0, False, (0.0, 0, 0), None, capture_rng_state())
+            if writer:
+                due = checkpoint_every_epochs > 0 and (epoch + 1) % checkpoint_every_epochs == 0
+                due = due or (checkpoint_every_minutes > 0 and time.monotonic() - last_checkpoint_time >= checkpoint_every_minutes * 60)
+                if world_size > 1:
+                    # Clocks differ between ranks, so rank 0 decides for all of them
+                    due = ddp.broadcast_object(due)
+                if due:
+                    save_training_checkpoint(*resume_point)
             continue
         break
 
-    # 9. After training, save the model
+    if writer:
+        writer.close()
+
+    # 9. After training, save the model (every rank holds the same weights, rank 0 writes them)
     if save_path:
         if early_stopping_patience > 0:
             log("Loading best model state before saving.")
-            model.load_state_dict(best_model_state)
-        torch.save(model.state_dict(), save_path)
+            model_without_ddp.load_state_dict(best_model_state)
+        if rank == 0:
+            save_checkpoint(save_path, model_without_ddp, image_datasets[train_dir_name].class_to_idx, model_name, input_size, mean, std)
 
     # 10. Evaluate on test set if it exists
     test_acc_value = None
     if test_dir_name in dataloaders:
         log("Evaluating on test set...")
-        model.eval()
+        model_without_ddp.eval()
         running_loss = 0.0
         running_corrects = 0
+        running_samples = 0
 
         for inputs, labels in dataloaders[test_dir_name]:
             inputs = inputs.to(device)
             labels = labels.to(device)
 
             with torch.no_grad():
-                outputs = model(inputs)
+                outputs = model_without_ddp(inputs)
                 _, preds = torch.max(outputs, 1)
                 loss = criterion(outputs, labels)
 
             running_loss += loss.item() * inputs.size(0)
-            running_corrects += torch.sum(preds == labels.data)
+            running_corrects += torch.sum(preds == labels.data).item()
+            running_samples += inputs.size(0)
 
-        test_loss = running_loss / dataset_sizes[test_dir_name]
-        test_acc = running_corrects.double() / dataset_sizes[test_dir_name]
-        test_acc_value = test_acc.item()
-        log(f'Test Loss: {test_loss:.4f} Acc: {test_acc:.4f}')
+        if world_size > 1:
+            running_loss, running_corrects, running_samples = ddp.all_reduce_sum([running_loss, running_corrects, running_samples], device)
+        test_loss = running_loss / running_samples
+        test_acc_value = running_corrects / running_samples
+        log(f'Test Loss: {test_loss:.4f} Acc: {test_acc_value:.4f}')
 
     log("Fine-tuning finished")
+    if owns_process_group:
+        torch.distributed.destroy_process_group()
     
     # 11. Return the final validation and test accuracies
     return {'val_acc': final_epoch_val_acc, 'test_acc': test_acc_value}
@@ -327,6 +573,8 @@ if __name__ == '__main__':
     parser.add_argument('--input_size', type=int, default=224, help='Input image size')
     parser.add_argument('--resize_size', type=int, default=None, help='Size to resize images to before cropping (defaults to 256 for 224 input)')
     parser.add_argument('--num_workers', type=int, default=0, help='Number of data loader workers')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Decode images once into a memory-mapped cache in this directory and train from it')
+    parser.add_argument('--shuffle_buffer', type=int, default=1000, help='Training samples held in the shuffle buffer when streaming tar shards')
     parser.add_argument('--pin_memory', action='store_true', help='Use pin memory for data loaders')
     parser.add_argument('--train_from_scratch', action='store_true', help='Train model from scratch instead of using pretrained weights')
     parser.add_argument('--strict_load', action='store_true', help='Use strict loading for model state dict')
@@ -335,8 +583,14 @@ if __name__ == '__main__':
     parser.add_argument('--val_dir_name', type=str, default='val', help='Name of the validation directory')
     parser.add_argument('--test_dir_name', type=str, default='test', help='Name of the test directory')
     parser.add_argument('--device', type=str, default='auto', help='Device to use for training (e.g., "cpu", "cuda:0")')
+    parser.add_argument('--dist_backend', type=str, default='gloo', choices=['gloo', 'nccl'], help='torch.distributed backend when launched with torchrun (gloo works on CPU)')
+    parser.add_argument('--log_all_ranks', action='store_true', help='Log progress from every torchrun process instead of rank 0 only')
     parser.add_argument('--load_path', type=str, default=None, help='Path to load a model state from')
     parser.add_argument('--save_path', type=str, default=None, help='Path to save the trained model state')
+    parser.add_argument('--checkpoint_path', type=str, default=None, help='Periodically save the full training state here so an interrupted run can be resumed')
+    parser.add_argument('--checkpoint_every_epochs', type=int, default=1, help='Save a training checkpoint every N epochs (0 to disable)')
+    parser.add_argument('--checkpoint_every_minutes', type=float, default=0, help='Also save a training checkpoint every N minutes, mid-epoch when training in a single process (0 to disable)')
+    parser.add_argument('--resume', type=str, default=None, help='Resume training from a checkpoint written with --checkpoint_path')
     
     # Augmentation flags
     parser.set_defaults(aug_random_resized_crop=True, aug_horizontal_flip=True, aug_rotation=True, aug_color_jitter=True)
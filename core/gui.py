@@ -6,6 +6,7 @@ import json
 import shutil
 import os
 from finetune import main as finetune_main
+from linear_probe import main as linear_probe_main
 from process_dataset import process_dataset
 
 cancel_event = threading.Event()
@@ -160,7 +161,8 @@ def main(page: ft.Page):
                     load_truncated_images=load_truncated_images_switch.value,
                     train_dir_name=train_dir_name_field.value or 'train',
                     val_dir_name=val_dir_name_field.value or 'val',
-                    test_dir_name=test_dir_name_field.value or 'test'
+                    test_dir_name=test_dir_name_field.value or 'test',
+                    output_format='shards' if write_shards_switch.value else 'folders'
                 )
                 if not cancel_event.is_set():
                     progress_callback("Dataset processing finished successfully")
@@ -220,6 +222,7 @@ def main(page: ft.Page):
                 'input_size': int(input_size_field.value) if input_size_field.value else 224,
                 'resize_size': int(resize_size_field.value) if resize_size_field.value else int((int(input_size_field.value) if input_size_field.value else 224) / 224 * 256),
                 'num_workers': int(num_workers_field.value) if num_workers_field.value else 0,
+                'cache_dir': cache_dir_field.value or None,
                 'log_frequency': int(log_frequency_field.value) if log_frequency_field.value else 10,
                 'device': device_field.value or 'auto',
                 'train_dir_name': train_dir_name_field.value or 'train',
@@ -229,6 +232,10 @@ def main(page: ft.Page):
                 'strict_load': strict_load_switch.value,
                 'load_path': load_model_path.value or None,
                 'save_path': save_model_path.value or None,
+                'checkpoint_path': checkpoint_path_field.value or None,
+                'checkpoint_every_minutes': float(checkpoint_minutes_field.value) if checkpoint_minutes_field.value else 0,
+                'augment_views': int(augment_views_field.value) if augment_views_field.value else 0,
+                'resume': checkpoint_path_field.value if resume_switch.value and checkpoint_path_field.value and os.path.exists(checkpoint_path_field.value) else None,
                 'cancel_event': cancel_event,
                 'aug_random_resized_crop': aug_random_resized_crop_switch.value,
                 'aug_horizontal_flip': aug_horizontal_flip_switch.value,
@@ -278,7 +285,9 @@ def main(page: ft.Page):
                 page.update()
 
             try:
-                results = finetune_main(settings_dict, progress_callback=progress_callback)
+                # The linear probe takes the same settings and only trains the classifier head
+                train = linear_probe_main if linear_probe_switch.value else finetune_main
+                results = train(settings_dict, progress_callback=progress_callback)
                 if not cancel_event.is_set():
                     val_acc = results.get('val_acc', 0.0)
                     test_acc = results.get('test_acc')
@@ -337,6 +346,7 @@ def main(page: ft.Page):
     )
     process_seed_field = ft.TextField(label="Seed (optional)", height=TEXT_FIELD_HEIGHT, text_align=ft.TextAlign.CENTER, expand=3)
     overwrite_dest_switch = ft.Switch(value=False)
+    write_shards_switch = ft.Switch(value=False)
 
     def run_clear_dataset_thread():
         """Background thread to clear the dataset directory"""
@@ -420,12 +430,18 @@ def main(page: ft.Page):
     input_size_field = ft.TextField(label="Input size (px)", value="224", height=TEXT_FIELD_HEIGHT)
     resize_size_field = ft.TextField(label="Resize size (px)", value="256", height=TEXT_FIELD_HEIGHT)
     num_workers_field = ft.TextField(label="Data loader workers", value="0", height=TEXT_FIELD_HEIGHT)
+    cache_dir_field = ft.TextField(label="Decoded image cache dir (optional)", value="", height=TEXT_FIELD_HEIGHT)
+    checkpoint_path_field = ft.TextField(label="Training checkpoint path (optional)", value="", height=TEXT_FIELD_HEIGHT)
+    checkpoint_minutes_field = ft.TextField(label="Checkpoint every N minutes (0 = per epoch only)", value="10", height=TEXT_FIELD_HEIGHT)
+    resume_switch = ft.Switch(value=False)
     log_frequency_field = ft.TextField(label="Log Frequency per Epoch", value="10", height=TEXT_FIELD_HEIGHT)
     device_field = ft.TextField(label="Device", value="auto", height=TEXT_FIELD_HEIGHT)
     train_from_scratch_switch = ft.Switch(value=False)
     strict_load_switch = ft.Switch(value=False)
     dropout_rate_field = ft.TextField(label="Dropout rate", value="0.0", height=TEXT_FIELD_HEIGHT)
     mixed_precision_switch = ft.Switch(value=False)
+    linear_probe_switch = ft.Switch(value=False)
+    augment_views_field = ft.TextField(label="Augmented feature views (linear probe)", value="0", height=TEXT_FIELD_HEIGHT)
     early_stopping_switch = ft.Switch(value=False)
     early_stopping_patience_field = ft.TextField(label="Patience", value="5", height=TEXT_FIELD_HEIGHT, text_align=ft.TextAlign.CENTER, expand=True)
     early_stopping_min_delta_field = ft.TextField(label="Min delta", value="0.001", height=TEXT_FIELD_HEIGHT, text_align=ft.TextAlign.CENTER, expand=True)
@@ -700,6 +716,13 @@ def main(page: ft.Page):
                                                     ],
                                                     vertical_alignment=ft.CrossAxisAlignment.CENTER,
                                                 ),
+                                                ft.Row(
+                                                    [
+                                                        ft.Text("Write tar shards", expand=True),
+                                                        write_shards_switch,
+                                                    ],
+                                                    vertical_alignment=ft.CrossAxisAlignment.CENTER,
+                                                ),
                                             ],
                                             spacing=10,
                                             horizontal_alignment=ft.CrossAxisAlignment.STRETCH,
@@ -872,6 +895,16 @@ def main(page: ft.Page):
                                                 input_size_field,
                                                 resize_size_field,
                                                 num_workers_field,
+                                                cache_dir_field,
+                                                checkpoint_path_field,
+                                                checkpoint_minutes_field,
+                                                ft.Row(
+                                                    [
+                                                        ft.Text("Resume from training checkpoint", expand=True),
+                                                        resume_switch,
+                                                    ],
+                                                    vertical_alignment=ft.CrossAxisAlignment.CENTER,
+                                                ),
                                                 log_frequency_field,
                                                 device_field,
                                                 dropout_rate_field,
@@ -891,6 +924,14 @@ def main(page: ft.Page):
                                                     ],
                                                     vertical_alignment=ft.CrossAxisAlignment.CENTER,
                                                 ),
+                                                ft.Row(
+                                                    [
+                                                        ft.Text("Linear probe (train the classifier head only)", expand=True),
+                                                        linear_probe_switch,
+                                                    ],
+                                                    vertical_alignment=ft.CrossAxisAlignment.CENTER,
+                                                ),
+                                                augment_views_field,
                                                 ft.Row(
                                                     [
                                                         ft.Text("Pin Memory (CUDA)", expand=True),
@@ -1077,11 +1118,11 @@ def main(page: ft.Page):
         "source_dir_path": source_dir_path, "dest_dir_path": dest_dir_path,
         "train_ratio_field": train_ratio_field, "val_ratio_field": val_ratio_field, "test_ratio_field": test_ratio_field, "resolution_field": resolution_field, "process_seed_field": process_seed_field,
         "train_dir_name_field": train_dir_name_field, "val_dir_name_field": val_dir_name_field, "test_dir_name_field": test_dir_name_field,
-        "image_extensions_field": image_extensions_field, "color_mode_dropdown": color_mode_dropdown, "overwrite_dest_switch": overwrite_dest_switch,
+        "image_extensions_field": image_extensions_field, "color_mode_dropdown": color_mode_dropdown, "overwrite_dest_switch": overwrite_dest_switch, "write_shards_switch": write_shards_switch,
         "data_dir_path": data_dir_path, "save_model_path": save_model_path, "load_model_path": load_model_path,
         "model_name_field": model_name_field, "epochs_field": epochs_field,
         "batch_size_field": batch_size_field, "learning_rate_field": learning_rate_field,
-        "input_size_field": input_size_field, "resize_size_field": resize_size_field, "num_workers_field": num_workers_field, "log_frequency_field": log_frequency_field, "device_field": device_field,
+        "input_size_field": input_size_field, "resize_size_field": resize_size_field, "num_workers_field": num_workers_field, "cache_dir_field": cache_dir_field, "checkpoint_path_field": checkpoint_path_field, "checkpoint_minutes_field": checkpoint_minutes_field, "resume_switch": resume_switch, "log_frequency_field": log_frequency_field, "device_field": device_field,
         "train_from_scratch_switch": train_from_scratch_switch,
         "strict_load_switch": strict_load_switch,
         "dropout_rate_field": dropout_rate_field, "optimiser_dropdown": optimiser_dropdown,
@@ -1089,7 +1130,7 @@ def main(page: ft.Page):
         "loss_function_dropdown": loss_function_dropdown, "label_smoothing_factor_field": label_smoothing_factor_field,
         "use_imagenet_norm_switch": use_imagenet_norm_switch, "norm_mean_field": norm_mean_field, "norm_std_field": norm_std_field,
         "load_truncated_images_switch": load_truncated_images_switch,
-        "mixed_precision_switch": mixed_precision_switch,
+        "mixed_precision_switch": mixed_precision_switch, "linear_probe_switch": linear_probe_switch, "augment_views_field": augment_views_field,
         "pin_memory_switch": pin_memory_switch,
         "early_stopping_switch": early_stopping_switch, "early_stopping_patience_field": early_stopping_patience_field, "early_stopping_min_delta_field": early_stopping_min_delta_field, "early_stopping_metric_dropdown": early_stopping_metric_dropdown,
         "finetune_seed_field": finetune_seed_field,
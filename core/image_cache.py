@@ -0,0 +1,192 @@
+import os
+import json
+import hashlib
+import multiprocessing
+import numpy as np
+import torch
+from torchvision import datasets
+from PIL import Image, ImageFile
+
+# On-disk cache of decoded images for finetune.py.
+#
+# ImageFolder re-opens and re-decodes every JPEG each epoch, which dominates
+# epoch time on CPU. build_cache() decodes a split once: each image is resized
+# so its shorter side is resize_size and center-cropped square, and the pixels
+# go into one uint8 .npy array of shape (N, resize_size, resize_size, 3) with a
+# JSON index of labels and classes next to it. The files are named after a
+# fingerprint of the split's file list (paths, sizes, modification times) and
+# the resize size, so adding, removing or editing an image builds a new cache
+# instead of reusing stale pixels.
+#
+# CachedImageFolder memory-maps the array and wraps each decoded image as a
+# PIL image, so the same torchvision transforms apply as with ImageFolder
+# (the PIL augmentations are faster on CPU than their tensor versions).
+# Random crops only see the center square of non-square images, while the
+# Resize + CenterCrop used for val/test gives the same crop as before.
+
+CACHE_VERSION = 1
+
+def split_fingerprint(samples, root, resize_size):
+    """Hash of the samples' relative paths, labels, sizes and mtimes, plus the cache settings"""
+    digest = hashlib.sha1(f"v{CACHE_VERSION}:{resize_size}\n".encode())
+    for path, label in samples:
+        stat = os.stat(path)
+        digest.update(f"{os.path.relpath(path, root)}:{label}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()[:16]
+
+def decode_resized(path, size):
+    """
+    Decodes an image to RGB, resizes its shorter side to size and center-crops it to size x size
+
+    Matches transforms.Resize(size) followed by transforms.CenterCrop(size), except
+    that JPEGs are decoded in draft mode at the smallest scale still covering size.
+    """
+    with Image.open(path) as img:
+        img.draft("RGB", (size, size))
+        img = img.convert("RGB")
+        width, height = img.size
+        if width <= height:
+            new_size = (size, int(size * height / width))
+        else:
+            new_size = (int(size * width / height), size)
+        img = img.resize(new_size, Image.BILINEAR)
+        left = int(round((new_size[0] - size) / 2.0))
+        top = int(round((new_size[1] - size) / 2.0))
+        return np.asarray(img.crop((left, top, left + size, top + size)))
+
+def _init_worker(load_truncated_images):
+    ImageFile.LOAD_TRUNCATED_IMAGES = load_truncated_images
+
+def _decode(task):
+    path, size = task
+    try:
+        return decode_resized(path, size)
+    except Exception as e:
+        raise RuntimeError(f"Could not decode {path}: {e}") from e
+
+def cache_paths(cache_dir, split_name, resize_size, fingerprint):
+    stem = os.path.join(cache_dir, f"{split_name}-{resize_size}-{fingerprint}")
+    return stem + ".json", stem + ".npy"
+
+def build_cache(root, cache_dir, resize_size, num_workers=0, progress_callback=None):
+    """
+    Decodes a split of class folders into the cache, unless an up-to-date cache exists
+
+    Args:
+        root (str): Split directory with one subfolder per class, as read by ImageFolder
+        cache_dir (str): Directory holding the cache files
+        resize_size (int): Side of the stored square images
+        num_workers (int): Processes decoding in parallel (0 decodes in this process)
+        progress_callback (function, optional): A function to call with progress updates
+    Returns:
+        str: Path to the cache's JSON index
+    """
+    def log(message):
+        if progress_callback:
+            progress_callback(message)
+
+    # ImageFolder only scans here, so the classes and labels match the uncached path exactly
+    folder = datasets.ImageFolder(root)
+    split_name = os.path.basename(os.path.normpath(root))
+    fingerprint = split_fingerprint(folder.samples, root, resize_size)
+    index_path, data_path = cache_paths(cache_dir, split_name, resize_size, fingerprint)
+    if os.path.exists(index_path) and os.path.exists(data_path):
+        log(f"Using decoded image cache {data_path}")
+        return index_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stale_prefix = f"{split_name}-{resize_size}-"
+    for name in os.listdir(cache_dir):
+        if name.startswith(stale_prefix) and not name.startswith(stale_prefix + fingerprint):
+            os.remove(os.path.join(cache_dir, name))
+
+    count = len(folder.samples)
+    log(f"Decoding {count} images from {root} into {data_path}")
+    # Unique per process, since machines sharing cache_dir may each build it at the same time
+    tmp_path = f"{data_path}.{os.getpid()}.tmp"
+    images = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.uint8, shape=(count, resize_size, resize_size, 3))
+    tasks = [(path, resize_size) for path, _ in folder.samples]
+    log_interval = max(1, count // 10)
+    pool = None
+    try:
+        if num_workers > 0:
+            pool = multiprocessing.Pool(num_workers, initializer=_init_worker, initargs=(ImageFile.LOAD_TRUNCATED_IMAGES,))
+            decoded = pool.imap(_decode, tasks, chunksize=16)
+        else:
+            decoded = map(_decode, tasks)
+        for i, pixels in enumerate(decoded):
+            images[i] = pixels
+            if (i + 1) % log_interval == 0:
+                log(f"Decoded {i + 1}/{count} images")
+        images.flush()
+    finally:
+        if pool is not None:
+            pool.terminate()
+        del images
+    os.replace(tmp_path, data_path)
+
+    # The index is written last, so a cache without one is never used
+    index = {
+        "version": CACHE_VERSION,
+        "root": os.path.abspath(root),
+        "resize_size": resize_size,
+        "fingerprint": fingerprint,
+        "classes": folder.classes,
+        "class_to_idx": folder.class_to_idx,
+        "paths": [os.path.relpath(path, root) for path, _ in folder.samples],
+        "targets": folder.targets,
+    }
+    with open(f"{index_path}.{os.getpid()}.tmp", "w") as f:
+        json.dump(index, f)
+    os.replace(f"{index_path}.{os.getpid()}.tmp", index_path)
+    return index_path
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    """
+    ImageFolder replacement reading images decoded by build_cache()
+
+    Returns (transformed image, label) pairs and exposes the same classes,
+    class_to_idx, targets and samples attributes as ImageFolder.
+    """
+
+    def __init__(self, index_path, transform=None, target_transform=None):
+        with open(index_path) as f:
+            index = json.load(f)
+        self.data_path = os.path.splitext(index_path)[0] + ".npy"
+        self.root = index["root"]
+        self.classes = index["classes"]
+        self.class_to_idx = index["class_to_idx"]
+        self.targets = index["targets"]
+        self.samples = [(os.path.join(self.root, path), target) for path, target in zip(index["paths"], self.targets)]
+        self.transform = transform
+        self.target_transform = target_transform
+        self._images = None
+
+    @property
+    def images(self):
+        # Mapped on first use, so DataLoader workers each map the file instead of receiving a pickled copy
+        if self._images is None:
+            self._images = np.load(self.data_path, mmap_mode="r")
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        image = Image.fromarray(self.images[index])
+        target = self.targets[index]
+        if self.transform is not None:
+            image = self.transform(image)
+        if self.target_transform is not None:
+            target = self.target_transform(target)
+        return image, target
+
+def cached_image_folder(root, cache_dir, resize_size, transform=None, num_workers=0, progress_callback=None):
+    """Builds the cache for a split if needed and returns a dataset reading from it"""
+    index_path = build_cache(root, cache_dir, resize_size, num_workers, progress_callback)
+    return CachedImageFolder(index_path, transform)
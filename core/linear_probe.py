@@ -0,0 +1,448 @@
+import argparse
+import copy
+import os
+import json
+import hashlib
+import numpy as np
+import torch
+import timm
+import torch.nn as nn
+import torch.nn.functional as F
+from torchvision import datasets
+from timm.loss import LabelSmoothingCrossEntropy
+from PIL import ImageFile
+from image_cache import cached_image_folder
+from shards import has_shards, SHARD_INDEX
+from shard_dataset import ShardDataset
+from finetune import build_transforms, build_optimizer, save_checkpoint
+
+# Linear probe: fine-tune only the classifier head of a timm model.
+#
+# The backbone is frozen, so its output for an image never changes and does
+# not need recomputing every epoch. The backbone runs once over each split
+# and the pooled features (the classifier's input) are stored as a float16
+# .npy array of shape (views, N, num_features), memory-mapped for training,
+# with a JSON index of labels and classes next to it. View 0 uses the
+# evaluation transform. For the training split, augment_views extra views
+# use the training augmentations with fixed seeds, so the head still sees
+# augmented images while the cache stays deterministic. Training the head on
+# the cached features takes seconds. The files are named after a
+# fingerprint of the model weights, the transforms and the split's files, so
+# changing any of them extracts features again.
+#
+# The trained head is copied into the model's classifier and saved with
+# finetune.save_checkpoint(), so the backend loads it like any fine-tuned model.
+
+FEATURE_CACHE_VERSION = 1
+
+def dataset_fingerprint(dataset, split_dir):
+    """Hash of the files a split is read from: shards.json for shards, else every image's path, label, size and mtime"""
+    digest = hashlib.sha1()
+    if isinstance(dataset, ShardDataset):
+        with open(os.path.join(split_dir, SHARD_INDEX), 'rb') as f:
+            digest.update(f.read())
+    else:
+        for path, label in dataset.samples:
+            stat = os.stat(path)
+            digest.update(f"{os.path.relpath(path, split_dir)}:{label}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+def load_backbone(model_name, num_classes, load_path=None, device='cpu', pretrained=True, progress_callback=None):
+    """
+    Creates a timm model with a num_classes head and optionally loads weights into it
+
+    Classifier weights in load_path whose shape does not fit the new head (e.g. a
+    checkpoint trained on fewer classes) are skipped, so the backbone of any
+    fine-tuned checkpoint of the same architecture can be reused.
+    """
+    model = timm.create_model(model_name, pretrained=pretrained, num_classes=num_classes)
+    if not isinstance(model.get_classifier(), nn.Linear):
+        raise ValueError(f"{model_name} does not end in a linear classifier, which the linear probe trains")
+    if load_path:
+        state = torch.load(load_path, map_location='cpu')
+        if 'model' in state and 'class_to_idx' in state:
+            state = state['model']
+        own_state = model.state_dict()
+        skipped = [key for key, value in state.items() if key in own_state and own_state[key].shape != value.shape]
+        for key in skipped:
+            del state[key]
+        model.load_state_dict(state, strict=False)
+        if skipped and progress_callback:
+            progress_callback(f"Not loading {', '.join(skipped)} from {load_path}: the shapes differ from the new classifier")
+    model.eval()
+    for param in model.parameters():
+        param.requires_grad_(False)
+    return model.to(device)
+
+def pooled_features(model, inputs):
+    """The features the model's classifier sees"""
+    return model.forward_head(model.forward_features(inputs), pre_logits=True)
+
+def feature_cache_paths(cache_dir, split_name, fingerprint):
+    stem = os.path.join(cache_dir, f"{split_name}-features-{fingerprint}")
+    return stem + ".json", stem + ".npy"
+
+def build_feature_cache(model, dataset, split_dir, transforms_per_view, cache_dir, settings, batch_size=32, num_workers=0, device='cpu', seed=0, use_amp=False, progress_callback=None, cancel_event=None):
+    """
+    Runs the frozen backbone over a split once per view and stores the pooled features, unless an up-to-date cache exists
+
+    Args:
+        model (nn.Module): The frozen timm model, in eval mode
+        dataset (Dataset): The split, its transform is replaced by each view's
+        split_dir (str): Directory the split is read from
+        transforms_per_view (list): Transform of each view, the first being the evaluation transform
+        cache_dir (str): Directory holding the feature caches
+        settings (dict): Everything else the features depend on (model, weights, ...), hashed into the file name
+        batch_size (int): Images per backbone forward pass
+        num_workers (int): Data loader workers
+        device (torch.device): Device the model is on
+        seed (int): Seeds the augmentations of view v with seed + v
+        use_amp (bool): Run the backbone in mixed precision
+        progress_callback (function, optional): A function to call with progress updates
+        cancel_event (threading.Event, optional): Stops extraction when set
+    Returns:
+        str: Path to the cache's JSON index, or None if cancelled
+    """
+    def log(message):
+        if progress_callback:
+            progress_callback(message)
+
+    split_name = os.path.basename(os.path.normpath(split_dir))
+    digest = hashlib.sha1(json.dumps({
+        'version': FEATURE_CACHE_VERSION,
+        'settings': settings,
+        'transforms': [repr(transform) for transform in transforms_per_view],
+        'seed': seed if len(transforms_per_view) > 1 else None,
+        'data': dataset_fingerprint(dataset, split_dir),
+    }, sort_keys=True).encode())
+    fingerprint = digest.hexdigest()[:16]
+    index_path, data_path = feature_cache_paths(cache_dir, split_name, fingerprint)
+    if os.path.exists(index_path) and os.path.exists(data_path):
+        log(f"Using cached features {data_path}")
+        return index_path
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stale_prefix = f"{split_name}-features-"
+    for name in os.listdir(cache_dir):
+        if name.startswith(stale_prefix) and not name.startswith(stale_prefix + fingerprint):
+            os.remove(os.path.join(cache_dir, name))
+
+    count = len(dataset)
+    views = len(transforms_per_view)
+    with torch.no_grad():
+        num_features = pooled_features(model, torch.zeros(1, 3, *settings['input_size'], device=device)).shape[1]
+    log(f"Extracting {views} view(s) of {num_features} features for {count} images from {split_dir} into {data_path}")
+    # Unique per process, since machines sharing cache_dir may each build it at the same time
+    tmp_path = f"{data_path}.{os.getpid()}.tmp"
+    features = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float16, shape=(views, count, num_features))
+    labels = np.zeros((views, count), dtype=np.int64)
+    try:
+        for view, transform in enumerate(transforms_per_view):
+            dataset.transform = transform
+            torch.manual_seed(seed + view)
+            loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=num_workers)
+            start = 0
+            for inputs, targets in loader:
+                if cancel_event and cancel_event.is_set():
+                    del features
+                    os.remove(tmp_path)
+                    return None
+                with torch.no_grad(), torch.autocast(device.type, enabled=use_amp):
+                    batch_features = pooled_features(model, inputs.to(device))
+                end = start + len(targets)
+                features[view, start:end] = batch_features.float().cpu().numpy()
+                labels[view, start:end] = targets.numpy()
+                start = end
+            if start != count:
+                raise RuntimeError(f"Expected {count} images in {split_dir}, read {start}")
+            log(f"Extracted view {view + 1}/{views} of {split_name}")
+        features.flush()
+    finally:
+        dataset.transform = transforms_per_view[0]
+    del features
+    os.replace(tmp_path, data_path)
+
+    # The index is written last, so a cache without one is never used
+    index = {
+        'version': FEATURE_CACHE_VERSION,
+        'fingerprint': fingerprint,
+        'num_features': num_features,
+        'classes': dataset.classes,
+        'class_to_idx': dataset.class_to_idx,
+        'labels': labels.tolist(),
+    }
+    with open(f"{index_path}.{os.getpid()}.tmp", 'w') as f:
+        json.dump(index, f)
+    os.replace(f"{index_path}.{os.getpid()}.tmp", index_path)
+    return index_path
+
+def load_feature_cache(index_path):
+    """
+    Returns:
+        tuple: (features memory-mapped as (views, N, num_features), labels as (views, N), the JSON index)
+    """
+    with open(index_path) as f:
+        index = json.load(f)
+    features = np.load(os.path.splitext(index_path)[0] + '.npy', mmap_mode='r')
+    return features, np.asarray(index['labels'], dtype=np.int64), index
+
+def _evaluate(head, features, labels, criterion, device, chunk_size=4096):
+    """Loss and accuracy of the head on view 0 of a split"""
+    running_loss = 0.0
+    running_corrects = 0
+    count = features.shape[1]
+    with torch.no_grad():
+        for start in range(0, count, chunk_size):
+            inputs = torch.from_numpy(np.asarray(features[0, start:start + chunk_size], dtype=np.float32)).to(device)
+            targets = torch.from_numpy(labels[0, start:start + chunk_size]).to(device)
+            outputs = head(inputs)
+            running_loss += criterion(outputs, targets).item() * len(targets)
+            running_corrects += torch.sum(outputs.argmax(1) == targets).item()
+    return running_loss / count, running_corrects / count
+
+def main(args, progress_callback=None):
+    """Trains the classifier head of a frozen timm model on cached backbone features"""
+
+    def log(message):
+        if progress_callback:
+            progress_callback(message)
+        else:
+            print(message)
+
+    log("Starting linear probe")
+
+    ImageFile.LOAD_TRUNCATED_IMAGES = args.get('load_truncated_images', True)
+
+    cancel_event = args.get('cancel_event')
+    data_dir = args['data_dir']
+    model_name = args.get('model_name', 'resnet18')
+    num_epochs = args.get('num_epochs', 25)
+    batch_size = args.get('batch_size', 32)
+    dropout_rate = args.get('dropout_rate', 0.0)
+    loss_function = args.get('loss_function', 'cross_entropy')
+    label_smoothing_factor = args.get('label_smoothing_factor', 0.1)
+    load_path = args.get('load_path')
+    save_path = args.get('save_path')
+    early_stopping_patience = args.get('early_stopping_patience', 0)
+    early_stopping_min_delta = args.get('early_stopping_min_delta', 0.0)
+    early_stopping_metric = args.get('early_stopping_metric', 'loss')
+    mixed_precision = args.get('mixed_precision', False)
+    input_size = args.get('input_size', 224)
+    resize_size = args.get('resize_size') or int(input_size / 224 * 256)
+    num_workers = args.get('num_workers', 0)
+    cache_dir = args.get('cache_dir')
+    feature_cache_dir = args.get('feature_cache_dir') or os.path.join(cache_dir or data_dir, 'features')
+    augment_views = args.get('augment_views', 0)
+    train_from_scratch = args.get('train_from_scratch', False)
+    train_dir_name = args.get('train_dir_name', 'train')
+    val_dir_name = args.get('val_dir_name', 'val')
+    test_dir_name = args.get('test_dir_name', 'test')
+    device_str = args.get('device', 'auto')
+    seed = args.get('seed')
+
+    if seed is not None:
+        torch.manual_seed(seed)
+        log(f"Using random seed: {seed}")
+
+    # 1. Set up data transforms and datasets, read in a fixed order for extraction
+    train_transform, eval_transform, (mean, std) = build_transforms(args)
+    phases = [train_dir_name, val_dir_name]
+    if os.path.isdir(os.path.join(data_dir, test_dir_name)):
+        phases.append(test_dir_name)
+
+    def create_dataset(phase):
+        split_dir = os.path.join(data_dir, phase)
+        if has_shards(split_dir):
+            return ShardDataset(split_dir, eval_transform, shuffle_buffer=0)
+        if cache_dir:
+            return cached_image_folder(split_dir, cache_dir, resize_size, eval_transform, num_workers, log)
+        return datasets.ImageFolder(split_dir, eval_transform)
+
+    image_datasets = {x: create_dataset(x) for x in phases}
+    class_to_idx = image_datasets[train_dir_name].class_to_idx
+    num_classes = len(class_to_idx)
+
+    if device_str == 'auto':
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    else:
+        device = torch.device(device_str)
+    log(f"Using device: {device}")
+    use_amp = mixed_precision and device.type == 'cuda'
+
+    # 2. Extract the frozen backbone's features once per split
+    model = load_backbone(model_name, num_classes, load_path, device, not train_from_scratch, log)
+    weights = 'pretrained'
+    if train_from_scratch:
+        # A random backbone is only reproducible from the seed; without one, never reuse another run's features
+        weights = f"random:{seed}" if seed is not None else f"random:{os.urandom(8).hex()}"
+    if load_path:
+        stat = os.stat(load_path)
+        weights = f"{os.path.abspath(load_path)}:{stat.st_size}:{stat.st_mtime_ns}"
+    settings = {'model_name': model_name, 'weights': weights, 'input_size': [input_size, input_size]}
+
+    features, labels = {}, {}
+    for phase in phases:
+        views = [eval_transform]
+        if phase == train_dir_name:
+            views += [train_transform] * augment_views
+        index_path = build_feature_cache(model, image_datasets[phase], os.path.join(data_dir, phase), views, feature_cache_dir, settings, batch_size, num_workers, device, seed or 0, use_amp, log, cancel_event)
+        if index_path is None:
+            log("Linear probe cancelled")
+            return {'val_acc': 0.0, 'test_acc': None}
+        features[phase], labels[phase], index = load_feature_cache(index_path)
+        if index['class_to_idx'] != class_to_idx:
+            raise ValueError(f"The classes of {phase} differ from those of {train_dir_name}")
+    num_features = features[train_dir_name].shape[2]
+
+    # 3. Train the head on every cached view of the training images
+    head = nn.Linear(num_features, num_classes).to(device)
+    if loss_function == 'cross_entropy':
+        criterion = nn.CrossEntropyLoss()
+    elif loss_function == 'label_smoothing':
+        criterion = LabelSmoothingCrossEntropy(smoothing=label_smoothing_factor)
+    else:
+        raise ValueError(f"Unsupported loss function: {loss_function}")
+    optimizer = build_optimizer(head.parameters(), args)
+
+    train_features = features[train_dir_name].reshape(-1, num_features)
+    train_labels = labels[train_dir_name].reshape(-1)
+    num_samples = len(train_labels)
+
+    best_head_state = copy.deepcopy(head.state_dict())
+    final_epoch_val_acc = 0.0
+    best_val_loss = float('inf')
+    best_val_acc = 0.0
+    epochs_no_improve = 0
+
+    for epoch in range(num_epochs):
+        if cancel_event and cancel_event.is_set():
+            log("Linear probe cancelled")
+            return {'val_acc': final_epoch_val_acc, 'test_acc': None}
+
+        head.train()
+        running_loss = 0.0
+        running_corrects = 0
+        order = torch.randperm(num_samples).numpy()
+        for start in range(0, num_samples, batch_size):
+            # Sorted indices read the memory-mapped rows front to back
+            batch = np.sort(order[start:start + batch_size])
+            inputs = torch.from_numpy(train_features[batch].astype(np.float32)).to(device)
+            targets = torch.from_numpy(train_labels[batch]).to(device)
+            inputs = F.dropout(inputs, p=dropout_rate, training=True)
+
+            optimizer.zero_grad()
+            outputs = head(inputs)
+            loss = criterion(outputs, targets)
+            loss.backward()
+            optimizer.step()
+
+            running_loss += loss.item() * len(batch)
+            running_corrects += torch.sum(outputs.argmax(1) == targets).item()
+
+        head.eval()
+        val_loss, val_acc = _evaluate(head, features[val_dir_name], labels[val_dir_name], criterion, device)
+        final_epoch_val_acc = val_acc
+        log(f'Epoch {epoch}/{num_epochs - 1} train Loss: {running_loss / num_samples:.4f} Acc: {running_corrects / num_samples:.4f} val Loss: {val_loss:.4f} Acc: {val_acc:.4f}')
+
+        if early_stopping_patience > 0:
+            if early_stopping_metric == 'loss':
+                if val_loss < best_val_loss - early_stopping_min_delta:
+                    best_val_loss = val_loss
+                    best_head_state = copy.deepcopy(head.state_dict())
+                    epochs_no_improve = 0
+                else:
+                    epochs_no_improve += 1
+            elif early_stopping_metric == 'accuracy':
+                if val_acc > best_val_acc + early_stopping_min_delta:
+                    best_val_acc = val_acc
+                    best_head_state = copy.deepcopy(head.state_dict())
+                    epochs_no_improve = 0
+                else:
+                    epochs_no_improve += 1
+
+            if epochs_no_improve >= early_stopping_patience:
+                log(f"Early stopping triggered after {epochs_no_improve} epochs with no improvement.")
+                break
+
+    if early_stopping_patience > 0:
+        log("Loading best head state.")
+        head.load_state_dict(best_head_state)
+
+    # 4. Put the head into the model and save it like a fine-tuned one
+    model.get_classifier().load_state_dict(head.state_dict())
+    if save_path:
+        save_checkpoint(save_path, model, class_to_idx, model_name, input_size, mean, std)
+        log(f"Saved model to {save_path}")
+
+    # 5. Evaluate on test set if it exists
+    test_acc_value = None
+    if test_dir_name in features:
+        head.eval()
+        test_loss, test_acc_value = _evaluate(head, features[test_dir_name], labels[test_dir_name], criterion, device)
+        log(f'Test Loss: {test_loss:.4f} Acc: {test_acc_value:.4f}')
+
+    log("Linear probe finished")
+    return {'val_acc': final_epoch_val_acc, 'test_acc': test_acc_value}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train only the classifier head of a pretrained model on cached backbone features')
+
+    parser.add_argument('--data_dir', type=str, required=True, help='Path to the dataset directory')
+    parser.add_argument('--model_name', type=str, default='resnet18', help='Name of the timm model whose head is trained')
+    parser.add_argument('--num_epochs', type=int, default=25, help='Number of epochs to train the head for')
+    parser.add_argument('--batch_size', type=int, default=32, help='Batch size for feature extraction and head training')
+    parser.add_argument('--learning_rate', type=float, default=0.001, help='Learning rate for the head')
+    parser.add_argument('--dropout_rate', type=float, default=0.0, help='Dropout rate on the features during training')
+    parser.add_argument('--optimiser', type=str, default='adamw', choices=['adam', 'adamw', 'sgd'], help='Optimiser to use for the head')
+    parser.add_argument('--sgd_momentum', type=float, default=0.9, help='Momentum for SGD optimizer')
+    parser.add_argument('--adam_beta1', type=float, default=0.9, help='Beta1 for Adam/AdamW optimizers')
+    parser.add_argument('--adam_beta2', type=float, default=0.999, help='Beta2 for Adam/AdamW optimizers')
+    parser.add_argument('--adam_eps', type=float, default=1e-8, help='Epsilon for Adam/AdamW optimizers')
+    parser.add_argument('--weight_decay', type=float, default=0.0, help='Weight decay for the head')
+    parser.add_argument('--loss_function', type=str, default='cross_entropy', choices=['cross_entropy', 'label_smoothing'], help='Loss function to use')
+    parser.add_argument('--label_smoothing_factor', type=float, default=0.1, help='Label smoothing factor')
+    parser.add_argument('--early_stopping_patience', type=int, default=0, help='Patience for early stopping (0 to disable)')
+    parser.add_argument('--early_stopping_min_delta', type=float, default=0.0, help='Minimum delta for early stopping')
+    parser.add_argument('--early_stopping_metric', type=str, default='loss', choices=['loss', 'accuracy'], help='Metric for early stopping')
+    parser.add_argument('--mixed_precision', action='store_true', help='Extract features in mixed precision (CUDA)')
+    parser.set_defaults(use_imagenet_norm=True)
+    parser.add_argument('--no-imagenet-norm', dest='use_imagenet_norm', action='store_false', help='Disable ImageNet normalization')
+    parser.add_argument('--norm_mean', type=str, default='0.485, 0.456, 0.406', help='Custom normalization mean')
+    parser.add_argument('--norm_std', type=str, default='0.229, 0.224, 0.225', help='Custom normalization standard deviation')
+    parser.add_argument('--input_size', type=int, default=224, help='Input image size')
+    parser.add_argument('--resize_size', type=int, default=None, help='Size to resize images to before cropping (defaults to 256 for 224 input)')
+    parser.add_argument('--num_workers', type=int, default=0, help='Number of data loader workers')
+    parser.add_argument('--cache_dir', type=str, default=None, help='Decode images once into a memory-mapped cache in this directory and extract features from it')
+    parser.add_argument('--feature_cache_dir', type=str, default=None, help='Directory for the cached features (defaults to features/ in cache_dir or data_dir)')
+    parser.add_argument('--augment_views', type=int, default=0, help='Augmented views of every training image to extract features for, besides the unaugmented one')
+    parser.add_argument('--train_dir_name', type=str, default='train', help='Name of the training directory')
+    parser.add_argument('--val_dir_name', type=str, default='val', help='Name of the validation directory')
+    parser.add_argument('--test_dir_name', type=str, default='test', help='Name of the test directory')
+    parser.add_argument('--device', type=str, default='auto', help='Device to use (e.g., "cpu", "cuda:0")')
+    parser.add_argument('--train_from_scratch', action='store_true', help='Probe a randomly initialised backbone instead of the pretrained one')
+    parser.add_argument('--load_path', type=str, default=None, help='Checkpoint to take the backbone weights from, e.g. a model fine-tuned on other classes')
+    parser.add_argument('--save_path', type=str, default=None, help='Path to save the model with the trained head')
+
+    # Augmentations of the extra views
+    parser.set_defaults(aug_random_resized_crop=True, aug_horizontal_flip=True, aug_rotation=True, aug_color_jitter=True)
+    parser.add_argument('--no-random-resized-crop', dest='aug_random_resized_crop', action='store_false', help='Disable random resized crop and zoom')
+    parser.add_argument('--no-horizontal-flip', dest='aug_horizontal_flip', action='store_false', help='Disable random horizontal flip')
+    parser.add_argument('--no-rotation', dest='aug_rotation', action='store_false', help='Disable random rotation augmentation')
+    parser.add_argument('--no-color-jitter', dest='aug_color_jitter', action='store_false', help='Disable color jitter augmentation')
+    parser.add_argument('--aug_rotation_degrees', type=int, default=15, help='Max rotation degrees for augmentation')
+    parser.add_argument('--aug_color_jitter_brightness', type=float, default=0.2, help='Brightness for color jitter augmentation')
+    parser.add_argument('--aug_color_jitter_contrast', type=float, default=0.2, help='Contrast for color jitter augmentation')
+    parser.add_argument('--aug_color_jitter_saturation', type=float, default=0.2, help='Saturation for color jitter augmentation')
+    parser.add_argument('--aug_color_jitter_hue', type=float, default=0.1, help='Hue for color jitter augmentation')
+    parser.add_argument('--aug_crop_scale_min', type=float, default=0.08, help='Min scale for random resized crop')
+    parser.add_argument('--aug_crop_scale_max', type=float, default=1.0, help='Max scale for random resized crop')
+    parser.add_argument('--aug_crop_ratio_min', type=float, default=0.75, help='Min aspect ratio for random resized crop')
+    parser.add_argument('--aug_crop_ratio_max', type=float, default=1.33, help='Max aspect ratio for random resized crop')
+
+    parser.add_argument('--seed', type=int, default=None, help='Random seed for reproducibility')
+
+    parser.set_defaults(load_truncated_images=True)
+    parser.add_argument('--no-load-truncated-images', dest='load_truncated_images', action='store_false', help='Do not attempt to load truncated images')
+
+    args = parser.parse_args()
+    main(vars(args))
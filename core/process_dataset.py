@@ -3,8 +3,11 @@ import shutil
 import random
 import pathlib
 from PIL import Image, ImageFile
+from shards import write_shards
 
-def process_dataset(source_dir, dest_dir, train_ratio=0.8, val_ratio=0.1, test_ratio=0.1, resolution=None, seed=None, progress_callback=None, cancel_event=None, image_extensions=None, color_mode='RGB', overwrite_dest=False, load_truncated_images=True, train_dir_name='train', val_dir_name='val', test_dir_name='test'):
+OUTPUT_FORMATS = ('folders', 'shards')
+
+def process_dataset(source_dir, dest_dir, train_ratio=0.8, val_ratio=0.1, test_ratio=0.1, resolution=None, seed=None, progress_callback=None, cancel_event=None, image_extensions=None, color_mode='RGB', overwrite_dest=False, load_truncated_images=True, train_dir_name='train', val_dir_name='val', test_dir_name='test', output_format='folders', shard_size_mb=128):
     """
     Processes an image dataset by splitting it into training, validation, and test sets
 
@@ -21,7 +24,12 @@ def process_dataset(source_dir, dest_dir, train_ratio=0.8, val_ratio=0.1, test_r
         progress_callback (function, optional): A function to call with progress updates
         image_extensions (str, optional): Comma-separated string of image extensions to include.
         color_mode (str, optional): The color mode to convert images to (e.g., 'RGB', 'L').
+        output_format (str, optional): 'folders' copies images into <split>/<class>/ folders, 'shards' writes
+            each split as tar shards with a shards.json index (see shards.py) for streaming with finetune.py
+        shard_size_mb (float, optional): Approximate size of each tar shard when output_format is 'shards'
     """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}. Choose from {', '.join(OUTPUT_FORMATS)}")
     ImageFile.LOAD_TRUNCATED_IMAGES = load_truncated_images
     if progress_callback:
         progress_callback("Starting dataset processing")
@@ -80,6 +88,8 @@ def process_dataset(source_dir, dest_dir, train_ratio=0.8, val_ratio=0.1, test_r
         return
 
     processed_class_names = set()
+    # With output_format='shards' the samples of each split are collected here and written after the scan
+    split_samples = {train_dest_path: [], val_dest_path: [], test_dest_path: []}
 
     # Process each class directory
     for class_dir in class_dirs:
@@ -116,7 +126,12 @@ def process_dataset(source_dir, dest_dir, train_ratio=0.8, val_ratio=0.1, test_r
         train_images = images[:train_count]
         val_images = images[train_count : train_count + val_count]
         test_images = images[train_count + val_count : train_count + val_count + test_count]
-        
+
+        if output_format == 'shards':
+            for split_path, split_images in ((train_dest_path, train_images), (val_dest_path, val_images), (test_dest_path, test_images)):
+                split_samples[split_path].extend((str(img), class_name) for img in split_images)
+            continue
+
         # Create destination class directories and copy files
         if train_images:
             (train_dest_path / class_name).mkdir()
@@ -163,6 +178,19 @@ def process_dataset(source_dir, dest_dir, train_ratio=0.8, val_ratio=0.1, test_r
                 else:
                     shutil.copy(img, test_dest_path / class_name / img.name)
 
+    if output_format == 'shards':
+        # Shuffled across classes so each shard, and each shuffle buffer reading it, holds a mix of classes
+        class_to_idx = {name: i for i, name in enumerate(sorted(processed_class_names))}
+        for split_path, samples in split_samples.items():
+            if not samples:
+                continue
+            random.shuffle(samples)
+            if progress_callback:
+                progress_callback(f'Writing {len(samples)} images to shards in {split_path}')
+            if write_shards(samples, str(split_path), class_to_idx, shard_size_mb, resolution, color_mode, progress_callback, cancel_event) is None:
+                progress_callback("Processing cancelled")
+                return
+
     # Final progress message
     if progress_callback:
         progress_callback("Dataset processing complete")
@@ -184,6 +212,8 @@ if __name__ == '__main__':
     parser.add_argument('--train_dir_name', type=str, default='train', help='Name for the training directory')
     parser.add_argument('--val_dir_name', type=str, default='val', help='Name for the validation directory')
     parser.add_argument('--test_dir_name', type=str, default='test', help='Name for the test directory')
+    parser.add_argument('--output_format', type=str, default='folders', choices=OUTPUT_FORMATS, help='Write class folders, or tar shards that finetune.py streams with sequential reads')
+    parser.add_argument('--shard_size_mb', type=float, default=128, help='Approximate size of each tar shard')
     
     parser.set_defaults(load_truncated_images=True)
     parser.add_argument('--no-load-truncated-images', dest='load_truncated_images', action='store_false', help='Do not attempt to load truncated images')
@@ -193,4 +223,4 @@ if __name__ == '__main__':
     def print_progress(message):
         print(message)
 
-    process_dataset(args.source_dir, args.dest_dir, train_ratio=args.train_ratio, val_ratio=args.val_ratio, test_ratio=args.test_ratio, resolution=args.resolution, seed=args.seed, progress_callback=print_progress, image_extensions=args.image_extensions, color_mode=args.color_mode, overwrite_dest=args.overwrite_dest, load_truncated_images=args.load_truncated_images, train_dir_name=args.train_dir_name, val_dir_name=args.val_dir_name, test_dir_name=args.test_dir_name)
+    process_dataset(args.source_dir, args.dest_dir, train_ratio=args.train_ratio, val_ratio=args.val_ratio, test_ratio=args.test_ratio, resolution=args.resolution, seed=args.seed, progress_callback=print_progress, image_extensions=args.image_extensions, color_mode=args.color_mode, overwrite_dest=args.overwrite_dest, load_truncated_images=args.load_truncated_images, train_dir_name=args.train_dir_name, val_dir_name=args.val_dir_name, test_dir_name=args.test_dir_name, output_format=args.output_format, shard_size_mb=args.shard_size_mb)
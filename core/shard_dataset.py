@@ -0,0 +1,91 @@
+import io
+import os
+import random
+import torch
+from PIL import Image
+from shards import load_index, iter_shard
+
+class ShardDataset(torch.utils.data.IterableDataset):
+    """
+    Streams a split written as tar shards by process_dataset.py (see shards.py)
+
+    Shards are divided between distributed ranks and then between the
+    DataLoader workers of each rank, so every sample is read once per epoch
+    with sequential I/O. Within a worker, samples pass through a shuffle
+    buffer of raw image bytes and are only decoded when they leave it.
+    Call set_epoch() before each epoch to reshuffle the shard order.
+
+    Args:
+        split_dir (str): Directory holding the shards and shards.json
+        transform (callable, optional): Applied to each decoded PIL image
+        shuffle_buffer (int): Samples held for shuffling (0 or 1 keeps shard order)
+        seed (int): Base seed of the shard order and buffer shuffles
+        rank (int, optional): This process's rank. Defaults to torch.distributed's, or 0
+        world_size (int, optional): Number of ranks. Defaults to torch.distributed's, or 1
+    """
+
+    def __init__(self, split_dir, transform=None, shuffle_buffer=0, seed=0, rank=None, world_size=None):
+        index = load_index(split_dir)
+        self.split_dir = split_dir
+        self.classes = index['classes']
+        self.class_to_idx = index['class_to_idx']
+        self.shards = index['shards']
+        self.num_samples = index['num_samples']
+        self.transform = transform
+        self.shuffle_buffer = shuffle_buffer
+        self.seed = seed
+        self.rank = rank
+        self.world_size = world_size
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def _rank_and_world_size(self):
+        if self.rank is not None:
+            return self.rank, self.world_size or 1
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            return torch.distributed.get_rank(), torch.distributed.get_world_size()
+        return 0, 1
+
+    def rank_shards(self):
+        """The shards this rank reads this epoch, in the same shuffled order on every rank"""
+        rank, world_size = self._rank_and_world_size()
+        shards = list(self.shards)
+        if self.shuffle_buffer > 1:
+            random.Random(self.seed + self.epoch).shuffle(shards)
+        return shards[rank::world_size]
+
+    def __len__(self):
+        return sum(shard['samples'] for shard in self.rank_shards())
+
+    def _decode(self, image_bytes, label):
+        image = Image.open(io.BytesIO(image_bytes)).convert('RGB')
+        if self.transform is not None:
+            image = self.transform(image)
+        return image, label
+
+    def __iter__(self):
+        rank, _ = self._rank_and_world_size()
+        shards = self.rank_shards()
+        worker = torch.utils.data.get_worker_info()
+        worker_id = worker.id if worker else 0
+        if worker:
+            shards = shards[worker.id::worker.num_workers]
+        rng = random.Random(f"{self.seed}-{self.epoch}-{rank}-{worker_id}")
+
+        buffer = []
+        for shard in shards:
+            for sample in iter_shard(os.path.join(self.split_dir, shard['name'])):
+                if self.shuffle_buffer <= 1:
+                    yield self._decode(*sample)
+                    continue
+                if len(buffer) < self.shuffle_buffer:
+                    buffer.append(sample)
+                    continue
+                i = rng.randrange(len(buffer))
+                buffer[i], sample = sample, buffer[i]
+                yield self._decode(*sample)
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self._decode(*sample)
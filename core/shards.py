@@ -0,0 +1,134 @@
+import io
+import os
+import json
+import tarfile
+from PIL import Image
+
+# Sharded sequential dataset format.
+#
+# A split written with output_format='shards' by process_dataset.py is a
+# directory of tar files (shard-000000.tar, ...) and a shards.json index.
+# Every sample is two consecutive tar members sharing a key: the encoded
+# image (<key>.jpg, <key>.png, ...) and its label index as text (<key>.cls),
+# the same layout WebDataset reads. Samples are shuffled across classes
+# before writing, so one shard holds a mix of classes. Reading a shard is a
+# single sequential pass over one large file, which is much faster than
+# opening thousands of small files on network filesystems, and a split is
+# copied between machines as a handful of files.
+
+SHARD_INDEX = "shards.json"
+SHARD_PATTERN = "shard-{:06d}.tar"
+LABEL_EXTENSION = ".cls"
+FORMAT_VERSION = 1
+
+def has_shards(split_dir):
+    return os.path.exists(os.path.join(split_dir, SHARD_INDEX))
+
+def load_index(split_dir):
+    """Reads a split's shards.json: classes, class_to_idx, num_samples and [{'name', 'samples', 'bytes'}] shards"""
+    with open(os.path.join(split_dir, SHARD_INDEX)) as f:
+        return json.load(f)
+
+def encode_image(path, resolution=None, color_mode='RGB'):
+    """Returns (bytes, extension) for an image, resized and re-encoded in its own format when resolution is set"""
+    extension = os.path.splitext(path)[1].lower()
+    if not resolution:
+        with open(path, 'rb') as f:
+            return f.read(), extension
+    with Image.open(path) as image:
+        image = image.convert(color_mode).resize((resolution, resolution))
+        buffer = io.BytesIO()
+        image.save(buffer, format=Image.registered_extensions().get(extension, 'PNG'))
+        return buffer.getvalue(), extension
+
+def _add_member(archive, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mode = 0o644
+    archive.addfile(info, io.BytesIO(data))
+
+def write_shards(samples, split_dir, class_to_idx, shard_size_mb=128, resolution=None, color_mode='RGB', progress_callback=None, cancel_event=None):
+    """
+    Writes (image_path, class_name) samples as tar shards of about shard_size_mb each, in the given order
+
+    Args:
+        samples (list): (image_path, class_name) pairs, already shuffled
+        split_dir (str): Directory for the shards and their index
+        class_to_idx (dict): Label index of every class name
+        shard_size_mb (float): Size at which a new shard is started
+        resolution (int, optional): Resize images to this square size before storing them
+        color_mode (str): Color mode to convert resized images to
+        progress_callback (function, optional): A function to call with progress updates
+        cancel_event (threading.Event, optional): Stops writing when set
+    Returns:
+        dict: The index written to shards.json, or None if cancelled
+    """
+    os.makedirs(split_dir, exist_ok=True)
+    max_bytes = int(shard_size_mb * 1024 * 1024)
+    shards = []
+    archive = None
+
+    def close_shard():
+        archive.close()
+        tmp_path = os.path.join(split_dir, shards[-1]['name'] + '.tmp')
+        os.replace(tmp_path, os.path.join(split_dir, shards[-1]['name']))
+        if progress_callback:
+            progress_callback(f"Wrote {shards[-1]['name']} with {shards[-1]['samples']} images")
+
+    for i, (path, class_name) in enumerate(samples):
+        if cancel_event and cancel_event.is_set():
+            if archive is not None:
+                archive.close()
+                os.remove(os.path.join(split_dir, shards[-1]['name'] + '.tmp'))
+            return None
+        data, extension = encode_image(path, resolution, color_mode)
+        if archive is None or shards[-1]['bytes'] >= max_bytes:
+            if archive is not None:
+                close_shard()
+            shards.append({'name': SHARD_PATTERN.format(len(shards)), 'samples': 0, 'bytes': 0})
+            archive = tarfile.open(os.path.join(split_dir, shards[-1]['name'] + '.tmp'), 'w', format=tarfile.USTAR_FORMAT)
+
+        key = f"{i:08d}"
+        _add_member(archive, key + extension, data)
+        _add_member(archive, key + LABEL_EXTENSION, str(class_to_idx[class_name]).encode())
+        shards[-1]['samples'] += 1
+        shards[-1]['bytes'] += len(data)
+    if archive is not None:
+        close_shard()
+
+    classes = sorted(class_to_idx, key=class_to_idx.get)
+    index = {
+        'version': FORMAT_VERSION,
+        'classes': classes,
+        'class_to_idx': class_to_idx,
+        'num_samples': len(samples),
+        'shards': shards,
+    }
+    with open(os.path.join(split_dir, SHARD_INDEX + '.tmp'), 'w') as f:
+        json.dump(index, f, indent=2)
+    os.replace(os.path.join(split_dir, SHARD_INDEX + '.tmp'), os.path.join(split_dir, SHARD_INDEX))
+    return index
+
+def iter_shard(path, read_buffer_mb=8):
+    """
+    Streams one shard front to back
+
+    Yields:
+        tuple: (image_bytes, label_idx) for each sample
+    """
+    with open(path, 'rb', buffering=int(read_buffer_mb * 1024 * 1024)) as f:
+        # 'r|' reads the archive as a stream without seeking back for a member table
+        with tarfile.open(fileobj=f, mode='r|') as archive:
+            key, image = None, None
+            for member in archive:
+                if not member.isfile():
+                    continue
+                name, extension = os.path.splitext(member.name)
+                data = archive.extractfile(member).read()
+                if extension == LABEL_EXTENSION:
+                    if name != key or image is None:
+                        raise ValueError(f"Label without an image for sample {name} in {path}")
+                    yield image, int(data)
+                    key, image = None, None
+                else:
+                    key, image = name, data